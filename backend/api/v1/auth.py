@@ -3,7 +3,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from backend.db import get_db
 from backend.models.user import User
-from backend.services.auth_service import AuthService
+from backend.services.auth_service import AuthService, Principal, principal_cache
 from pydantic import BaseModel
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError
@@ -35,11 +35,17 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    result = await db.execute(select(User).where(User.email == email))
-    user = result.scalars().first()
-    if user is None:
+    principal = principal_cache.get(email)
+    if principal is None:
+        result = await db.execute(select(User).where(User.email == email))
+        user = result.scalars().first()
+        if user is None:
+            raise credentials_exception
+        principal = Principal.from_user(user)
+        principal_cache.put(email, principal)
+    if not principal.is_active:
         raise credentials_exception
-    return user
+    return principal
 
 @router.post("/register", response_model=Token)
 async def register(user_create: UserCreate, db: AsyncSession = Depends(get_db)):
@@ -47,7 +53,7 @@ async def register(user_create: UserCreate, db: AsyncSession = Depends(get_db)):
     user = result.scalars().first()
     if user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = AuthService.hash_password(user_create.password)
+    hashed_password = await AuthService.hash_password_async(user_create.password)
     new_user = User(email=user_create.email, hashed_password=hashed_password)
     db.add(new_user)
     await db.commit()
@@ -59,13 +65,13 @@ async def register(user_create: UserCreate, db: AsyncSession = Depends(get_db)):
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(User).where(User.email == form_data.username))
     user = result.scalars().first()
-    if not user or not AuthService.verify_password(form_data.password, str(user.hashed_password)):
+    if not user or not await AuthService.verify_password_async(form_data.password, str(user.hashed_password)):
         raise HTTPException(status_code=400, detail="Incorrect email or password")
     access_token = AuthService.create_access_token({"sub": user.email}, role=str(user.role))
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.get("/me")
-async def me(current_user: User = Depends(get_current_user)):
+async def me(current_user: Principal = Depends(get_current_user)):
     return {
         "id": current_user.id,
         "email": current_user.email,
@@ -1,17 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from backend.db import get_db
+from backend.db import AsyncSessionLocal, get_db
 from backend.api.v1.auth import get_current_user
-from backend.models.user import User
+from backend.services.auth_service import Principal
 from backend.models.chat import Chat
 from backend.models.media import Media
 from sqlalchemy.future import select
 from typing import List, Optional
-import json
+from datetime import datetime
 import logging
 from backend.config import settings
 from pydantic import BaseModel
-from backend.services.agent_service import process_chat_message
+from backend.services.agent_service import process_chat_message, stream_chat_message
+from backend.api.v1.pagination import apply_keyset, split_page
+from backend.api.v1.serialization import FastJSONResponse, ndjson_response
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -22,34 +25,106 @@ router = APIRouter(prefix="/chat", tags=["chat"])
 class ChatRequest(BaseModel):
     message: str
 
-@router.get("/history")
+class ChatHistoryItem(BaseModel):
+    id: int
+    message: str
+    response: Optional[str]
+    media_ids: List[int]
+    created_at: Optional[datetime]
+
+def _history_query(user_id, created_after, created_before):
+    # Only the columns the API returns, loaded as rows rather than entities
+    stmt = (
+        select(Chat.id, Chat.message, Chat.response, Chat.media_ids, Chat.created_at)
+        .where(Chat.user_id == user_id)
+    )
+    if created_after:
+        stmt = stmt.where(Chat.created_at >= created_after)
+    if created_before:
+        stmt = stmt.where(Chat.created_at < created_before)
+    return stmt
+
+def _history_item(row) -> dict:
+    return {
+        "id": row.id,
+        "message": row.message,
+        "response": row.response,
+        "media_ids": row.media_ids or [],
+        "created_at": row.created_at
+    }
+
+@router.get("/history", response_model=List[ChatHistoryItem])
 async def get_chat_history(
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user),
-    limit: int = Query(50, ge=1, le=100)
+    current_user: Principal = Depends(get_current_user),
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page, to load older chats"),
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None
 ):
-    result = await db.execute(
-        select(Chat)
-        .where(Chat.user_id == current_user.id)
-        .order_by(Chat.created_at.asc())  # Order by date ascending
-        .limit(limit)
+    """
+    The most recent `limit` chats, oldest first within the page. When there
+    are older chats, the X-Next-Cursor header holds the cursor for them.
+    """
+    stmt = _history_query(current_user.id, created_after, created_before)
+    result = await db.execute(apply_keyset(stmt, Chat.created_at, Chat.id, cursor, limit))
+    rows, next_cursor = split_page(result.all(), limit)
+    return FastJSONResponse(
+        [_history_item(row) for row in reversed(rows)],  # Order by date ascending
+        headers={"X-Next-Cursor": next_cursor} if next_cursor else None
     )
-    chats = result.scalars().all()
-    return [
-        {
-            "id": chat.id,
-            "message": chat.message,
-            "response": chat.response,
-            "media_ids": json.loads(getattr(chat, 'media_ids', '') or '[]'),
-            "created_at": getattr(chat, "created_at", None)
-        }
-        for chat in chats
-    ]
+
+@router.get("/history/export")
+async def export_chat_history(
+    current_user: Principal = Depends(get_current_user),
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None
+):
+    """
+    The whole history as NDJSON (one chat per line), oldest first. Rows are
+    streamed from a server-side cursor, so memory use doesn't grow with the
+    history.
+    """
+    stmt = _history_query(current_user.id, created_after, created_before).order_by(Chat.created_at, Chat.id)
+
+    async def batches():
+        # Own session: the export outlives the request's dependency scope
+        async with AsyncSessionLocal() as session:
+            result = await session.stream(stmt.execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+            async for partition in result.partitions():
+                yield [_history_item(row) for row in partition]
+
+    return ndjson_response(batches(), filename="chat-history.ndjson")
 
 @router.post("")
 async def chat(
     req: ChatRequest,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_user)
 ):
-    return await process_chat_message(db, current_user, req.message)
\ No newline at end of file
+    return await process_chat_message(db, current_user, req.message)
+
+@router.post("/stream")
+async def chat_stream(
+    req: ChatRequest,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    events = await stream_chat_message(db, current_user, req.message)
+
+    async def event_stream():
+        try:
+            async for event in events:
+                if await request.is_disconnected():
+                    logger.info("Chat stream client disconnected, cancelling completion")
+                    break
+                yield event
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
\ No newline at end of file
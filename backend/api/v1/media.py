@@ -1,105 +1,557 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Request, Query, Header
 from sqlalchemy.ext.asyncio import AsyncSession
-from backend.db import get_db
+from backend.db import AsyncSessionLocal, get_db
 from backend.api.v1.auth import get_current_user
 from backend.models.user import User
+from backend.services.auth_service import Principal
 from backend.models.media import Media
+from backend.models.upload_session import UploadSession
+from sqlalchemy import exists, update
 from sqlalchemy.future import select
 from backend.services.media_service import MediaService
-from typing import List, Union
-from fastapi.responses import StreamingResponse
-import io
+from backend.services.media_cache import get_media_cache
+from backend.services.media_store import acquire_existing, add_blob, release
+from backend.services.document_service import (
+    discard_staged,
+    forget_media,
+    stage_upload,
+    submit_stored_upload,
+    submit_upload
+)
+from backend.services.resumable_upload import (
+    CHUNK_GRANULARITY,
+    DriveUploadError,
+    cancel_drive_session,
+    create_drive_session,
+    parse_content_range,
+    put_chunk,
+    query_drive_offset
+)
+from backend.api.v1.pagination import apply_keyset, split_page
+from backend.api.v1.serialization import FastJSONResponse, ndjson_response
+from backend.config import settings
+from typing import List, Union, Optional
+from fastapi.responses import StreamingResponse, FileResponse
+from starlette.requests import ClientDisconnect
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime
+from email.utils import format_datetime
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/media", tags=["media"])
 
-def admin_required(current_user: User = Depends(get_current_user)):
+def admin_required(current_user: Principal = Depends(get_current_user)):
     if str(current_user.role) != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+async def _release_references(db, hashes):
+    """Give back references taken for an upload that failed, deleting Drive objects left unreferenced."""
+    orphans = [gdrive_id for gdrive_id in [await release(db, h) for h in hashes] if gdrive_id]
+    await db.commit()
+    await MediaService.delete_many_from_gdrive(orphans)
+
 @router.post("/upload")
 async def upload_media(
     files: Union[List[UploadFile], UploadFile] = File(...),
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(admin_required)
+    current_user: Principal = Depends(admin_required)
 ):
     # Support both single and multiple file upload
     if isinstance(files, UploadFile):
         files = [files]
-    results = []
-    for file in files:
-        gdrive_id = await MediaService.upload_to_gdrive(file)
-        if not gdrive_id:
-            raise HTTPException(status_code=404, detail="Upload failed")
-        file.file.seek(0, 2)  # Move to end of file
-        file_size = None
-        try:
-            file_size = file.file.tell()
-        except Exception:
-            pass
-        file.file.seek(0)  # Move back to start
-        media = Media(
-            user_id=current_user.id,
-            filename=file.filename,
-            filetype=file.content_type,
-            gdrive_id=gdrive_id,
-            file_size=file_size
-        )
-        db.add(media)
+    # Documents are copied for indexing while they are hashed
+    staged = await asyncio.gather(*(stage_upload(file) for file in files))
+    hashes = [h for h, _ in staged]
+    counts = Counter(hashes)
+    # Content already on Drive is referenced, not uploaded again. The
+    # references are committed first so the blobs can't be deleted meanwhile.
+    existing = await acquire_existing(db, counts)
+    await db.commit()
+    reused = [h for h in hashes if h in existing]
+
+    first_file = {}
+    for file, h in zip(files, hashes):
+        if h not in existing:
+            first_file.setdefault(h, file)
+    uploads = await MediaService.upload_many(list(first_file.values()))
+    uploaded_ids = [u["gdrive_id"] for u in uploads if u["gdrive_id"]]
+    if any(u["error"] for u in uploads):
+        # All or nothing: remove what already reached Drive
+        await MediaService.delete_many_from_gdrive(uploaded_ids)
+        await _release_references(db, reused)
+        discard_staged(path for _, path in staged)
+        errors = {h: u["error"] for h, u in zip(first_file, uploads)}
+        raise HTTPException(status_code=502, detail={
+            "message": "Upload failed",
+            "results": [
+                {
+                    "filename": file.filename,
+                    "status": "failed" if errors.get(h) else "rolled_back",
+                    "error": errors.get(h)
+                }
+                for file, h in zip(files, hashes)
+            ]
+        })
+
+    stored = dict(existing)
+    redundant = []
+    transferred = set()  # Files whose own Drive upload is kept
+    try:
+        for (h, file), u in zip(first_file.items(), uploads):
+            gdrive_id = await add_blob(db, h, u["gdrive_id"], u["file_size"], counts[h])
+            if gdrive_id == u["gdrive_id"]:
+                transferred.add(id(file))
+            else:
+                redundant.append(u["gdrive_id"])  # Same content was stored concurrently
+            stored[h] = (gdrive_id, u["file_size"])
+        media_rows = [
+            Media(
+                user_id=current_user.id,
+                filename=file.filename,
+                filetype=file.content_type,
+                gdrive_id=stored[h][0],
+                file_size=stored[h][1],
+                content_hash=h
+            )
+            for file, h in zip(files, hashes)
+        ]
+        db.add_all(media_rows)
         await db.commit()
-        await db.refresh(media)
-        results.append({
+    except Exception as e:
+        await db.rollback()
+        await MediaService.delete_many_from_gdrive(uploaded_ids)
+        await _release_references(db, reused)
+        discard_staged(path for _, path in staged)
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    await MediaService.delete_many_from_gdrive(redundant)
+    # Documents are indexed for chat retrieval in the background
+    for media, file, (h, path) in zip(media_rows, files, staged):
+        await submit_upload(current_user.id, media.id, file, h, path)
+    return [
+        {
             "id": media.id,
             "filename": media.filename,
             "filetype": media.filetype,
             "file_size": media.file_size,
-            "created_at": media.created_at
-        })
-    return results
+            "created_at": media.created_at,
+            "deduplicated": id(file) not in transferred
+        }
+        for media, file in zip(media_rows, files)
+    ]
 
-@router.get("/list", response_model=List[dict])
-async def list_media(
+# Resumable uploads: create a session, PUT chunks with Content-Range, GET the
+# status to find where to resume, then POST /complete to create the Media
+# row. Chunks are relayed straight into a Drive resumable session (see
+# services/resumable_upload.py). The DB connection is released while a
+# chunk is in flight. Status changes are conditional UPDATEs on the current
+# status, so concurrent requests (or the expiry sweep) never undo each other
+# and only one /complete creates the Media row.
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    filetype: str = "application/octet-stream"
+    file_size: int = Field(gt=0)
+
+def _upload_status(upload: UploadSession) -> dict:
+    return {
+        "id": upload.id,
+        "filename": upload.filename,
+        "file_size": upload.file_size,
+        "offset": upload.offset,
+        "status": upload.status,
+        "media_id": upload.media_id,
+        "chunk_granularity": CHUNK_GRANULARITY
+    }
+
+async def _get_upload(db, upload_id: str, current_user) -> UploadSession:
+    upload = await db.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return upload
+
+async def _transition(db, upload: UploadSession, statuses, **values) -> bool:
+    """Update the session if its status is still one of `statuses`; False when another request moved it."""
+    result = await db.execute(
+        update(UploadSession)
+        .where(UploadSession.id == upload.id, UploadSession.status.in_(statuses))
+        .values(**values)
+    )
+    return result.rowcount == 1
+
+async def _record_progress(db, upload: UploadSession, offset: int, gdrive_id):
+    """Store what Drive acknowledged, unless the upload left "open" in the meantime."""
+    values = {"offset": offset}
+    if gdrive_id:
+        values.update(gdrive_id=gdrive_id, status="uploaded")
+    await _transition(db, upload, ("open",), **values)
+    await db.commit()
+    await db.refresh(upload)
+
+async def _finalize(db, upload: UploadSession):
+    """Create the Media row of an uploaded session, unless a concurrent /complete claimed it first."""
+    # Drive computes the SHA-256; content that was already stored keeps its
+    # existing Drive object and this copy is deleted. Fetched before the
+    # claim, with no transaction open, so no row lock waits on Drive.
+    await db.commit()
+    meta = await MediaService.get_gdrive_metadata(upload.gdrive_id)
+    content_hash = (meta or {}).get("sha256Checksum")
+    # The claim's row lock is held until the commit, so a concurrent claim
+    # waits and then finds the session complete
+    if not await _transition(db, upload, ("uploaded",), status="finalizing"):
+        await db.rollback()
+        await db.refresh(upload)
+        return
+    gdrive_id = upload.gdrive_id
+    if content_hash:
+        gdrive_id = await add_blob(db, content_hash, upload.gdrive_id, upload.file_size, 1)
+    media = Media(
+        user_id=upload.user_id,
+        filename=upload.filename,
+        filetype=upload.filetype,
+        gdrive_id=gdrive_id,
+        file_size=upload.file_size,
+        content_hash=content_hash
+    )
+    db.add(media)
+    await db.flush()
+    upload.media_id = media.id
+    upload.status = "complete"
+    await db.commit()
+    if gdrive_id != upload.gdrive_id:
+        await MediaService.delete_from_gdrive(upload.gdrive_id)
+    await submit_stored_upload(
+        media.user_id, media.id, media.filename, media.filetype, media.file_size, gdrive_id, content_hash
+    )
+
+@router.post("/uploads", status_code=201)
+async def create_upload(
+    body: UploadSessionCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(admin_required)
+):
+    if body.file_size > settings.UPLOAD_MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail="File is larger than UPLOAD_MAX_FILE_SIZE")
+    try:
+        session_uri = await create_drive_session(body.filename, body.filetype, body.file_size)
+    except DriveUploadError as e:
+        raise HTTPException(status_code=e.status, detail=str(e))
+    upload = UploadSession(
+        user_id=current_user.id,
+        filename=body.filename,
+        filetype=body.filetype,
+        file_size=body.file_size,
+        drive_session_uri=session_uri,
+        offset=0,
+        status="open"
+    )
+    db.add(upload)
+    await db.commit()
+    return _upload_status(upload)
+
+@router.put("/uploads/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    content_range: str = Header(..., description="bytes start-end/total"),
+    content_length: Optional[int] = Header(None),
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(admin_required)
+    current_user: Principal = Depends(admin_required)
 ):
-    result = await db.execute(select(Media))
-    media_list = result.scalars().all()
-    user_ids = list(set(m.user_id for m in media_list))
-    users = {}
-    if user_ids:
-        user_result = await db.execute(select(User).where(User.id.in_(user_ids)))
-        for u in user_result.scalars().all():
-            users[u.id] = u.email
-    return [{
+    """Relay one chunk starting at the current offset; returns the new status."""
+    upload = await _get_upload(db, upload_id, current_user)
+    if upload.status != "open":
+        raise HTTPException(status_code=409, detail=f"Upload is {upload.status}")
+    try:
+        start, end = parse_content_range(content_range, upload.file_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if content_length is not None and content_length != end - start + 1:
+        raise HTTPException(status_code=400, detail="Content-Length does not match Content-Range")
+    if start != upload.offset:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Chunk does not start at the acknowledged offset", "offset": upload.offset}
+        )
+    await db.commit()  # Don't hold a pooled connection for the transfer
+    try:
+        offset, gdrive_id = await put_chunk(
+            upload.drive_session_uri, request.stream(), start, end, upload.file_size
+        )
+    except ClientDisconnect:
+        logger.info(f"Client went away during a chunk of upload {upload_id}")
+        raise HTTPException(status_code=400, detail="Client disconnected")
+    except DriveUploadError as e:
+        raise HTTPException(status_code=e.status, detail=str(e))
+    await _record_progress(db, upload, offset, gdrive_id)
+    return _upload_status(upload)
+
+@router.get("/uploads/{upload_id}")
+async def get_upload_status(
+    upload_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(admin_required)
+):
+    """The offset to resume from, as acknowledged by Drive."""
+    upload = await _get_upload(db, upload_id, current_user)
+    if upload.status == "open":
+        await db.commit()
+        try:
+            offset, gdrive_id = await query_drive_offset(upload.drive_session_uri, upload.file_size)
+        except DriveUploadError as e:
+            raise HTTPException(status_code=e.status, detail=str(e))
+        await _record_progress(db, upload, offset, gdrive_id)
+    return _upload_status(upload)
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload(
+    upload_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(admin_required)
+):
+    """Create the Media row once Drive has the whole file. Safe to repeat."""
+    upload = await _get_upload(db, upload_id, current_user)
+    if upload.status == "open":
+        await db.commit()
+        try:
+            offset, gdrive_id = await query_drive_offset(upload.drive_session_uri, upload.file_size)
+        except DriveUploadError as e:
+            raise HTTPException(status_code=e.status, detail=str(e))
+        await _record_progress(db, upload, offset, gdrive_id)
+        if upload.status == "open":
+            raise HTTPException(
+                status_code=409,
+                detail={"message": "Upload is not finished", "offset": upload.offset}
+            )
+    if upload.status == "uploaded":
+        await _finalize(db, upload)
+    if upload.status != "complete":
+        raise HTTPException(status_code=409, detail=f"Upload is {upload.status}")
+    media = await db.get(Media, upload.media_id)
+    return {
+        "id": media.id,
+        "filename": media.filename,
+        "filetype": media.filetype,
+        "file_size": media.file_size,
+        "created_at": media.created_at
+    }
+
+@router.delete("/uploads/{upload_id}")
+async def cancel_upload(
+    upload_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(admin_required)
+):
+    upload = await _get_upload(db, upload_id, current_user)
+    if upload.status == "complete":
+        raise HTTPException(status_code=409, detail="Upload is complete, delete the media instead")
+    previous = upload.status
+    if previous in ("open", "uploaded"):
+        cancelled = await _transition(db, upload, (previous,), status="cancelled")
+        await db.commit()
+        await db.refresh(upload)
+        if not cancelled:
+            raise HTTPException(status_code=409, detail=f"Upload is {upload.status}")
+        if previous == "open":
+            await cancel_drive_session(upload.drive_session_uri)
+        else:
+            await MediaService.delete_from_gdrive(upload.gdrive_id)
+    return _upload_status(upload)
+
+class MediaItem(BaseModel):
+    id: int
+    filename: str
+    filetype: str
+    gdrive_id: str
+    file_size: Optional[int]
+    created_at: Optional[datetime]
+    owner: str
+
+def _media_query(owner, filetype, created_after, created_before):
+    stmt = (
+        select(
+            Media.id,
+            Media.filename,
+            Media.filetype,
+            Media.gdrive_id,
+            Media.file_size,
+            Media.created_at,
+            User.email.label("owner")
+        )
+        .outerjoin(User, User.id == Media.user_id)
+    )
+    if owner:
+        stmt = stmt.where(User.email == owner)
+    if filetype:
+        stmt = stmt.where(Media.filetype == filetype)
+    if created_after:
+        stmt = stmt.where(Media.created_at >= created_after)
+    if created_before:
+        stmt = stmt.where(Media.created_at < created_before)
+    return stmt
+
+def _media_item(m) -> dict:
+    return {
         "id": m.id,
         "filename": m.filename,
         "filetype": m.filetype,
         "gdrive_id": m.gdrive_id,
         "file_size": m.file_size,
         "created_at": m.created_at,
-        "owner": users.get(m.user_id, "")
-    } for m in media_list]
+        "owner": m.owner or ""
+    }
+
+@router.get("/list", response_model=List[MediaItem])
+async def list_media(
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(admin_required),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    owner: Optional[str] = Query(None, description="Owner email"),
+    filetype: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None
+):
+    """Newest first; the X-Next-Cursor header is set when more pages follow."""
+    stmt = _media_query(owner, filetype, created_after, created_before)
+    result = await db.execute(apply_keyset(stmt, Media.created_at, Media.id, cursor, limit))
+    rows, next_cursor = split_page(result.all(), limit)
+    return FastJSONResponse(
+        [_media_item(m) for m in rows],
+        headers={"X-Next-Cursor": next_cursor} if next_cursor else None
+    )
+
+@router.get("/export")
+async def export_media(
+    current_user: Principal = Depends(admin_required),
+    owner: Optional[str] = Query(None, description="Owner email"),
+    filetype: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None
+):
+    """Every matching media record as NDJSON, newest first, streamed from a server-side cursor."""
+    stmt = _media_query(owner, filetype, created_after, created_before).order_by(
+        Media.created_at.desc(), Media.id.desc()
+    )
+
+    async def batches():
+        async with AsyncSessionLocal() as session:
+            result = await session.stream(stmt.execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+            async for partition in result.partitions():
+                yield [_media_item(m) for m in partition]
+
+    return ndjson_response(batches(), filename="media.ndjson")
 
 
+def parse_range_header(range_header: str, size: int):
+    """
+    Parse a single `bytes=` range into inclusive (start, end) offsets.
+    Returns None for headers we don't handle (other units, multiple ranges),
+    in which case the full file is served. Raises ValueError when the range
+    cannot be satisfied.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise ValueError("unsatisfiable range")
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        raise ValueError("unsatisfiable range")
+    if start >= size or end < start:
+        raise ValueError("unsatisfiable range")
+    return start, min(end, size - 1)
+
+def _if_range_matches(if_range, etag, last_modified):
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Weak validators never match for byte ranges
+        return etag is not None and if_range == etag
+    return last_modified is not None and if_range == last_modified
+
 @router.get("/download/{media_id}")
 async def download_media(
     media_id: int,
+    request: Request,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(admin_required)
+    current_user: Principal = Depends(admin_required)
 ):
     result = await db.execute(select(Media).where(Media.id == media_id))
     media = result.scalars().first()
     if not media:
         raise HTTPException(status_code=404, detail="Media not found")
-    file_bytes = await MediaService.download_from_gdrive(media.gdrive_id)
-    if not file_bytes:
+    meta = await MediaService.get_gdrive_metadata(media.gdrive_id)
+    if not meta or "size" not in meta:
         raise HTTPException(status_code=404, detail="File not found in Google Drive")
+    size = int(meta["size"])
+    etag = f'"{meta["md5Checksum"]}"' if meta.get("md5Checksum") else None
+    last_modified = None
+    if meta.get("modifiedTime"):
+        modified = datetime.fromisoformat(meta["modifiedTime"].replace("Z", "+00:00"))
+        last_modified = format_datetime(modified, usegmt=True)
+
     headers = {
         "Content-Disposition": f'attachment; filename=\"{media.filename}\"',
-        "Content-Length": str(len(file_bytes)),  # Enables browser progress bar!
+        "Accept-Ranges": "bytes",
     }
+    if etag:
+        headers["ETag"] = etag
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+
+    cache = get_media_cache()
+    if cache is not None:
+        cached_path = cache.lookup(media.gdrive_id, meta)
+        if cached_path is not None:
+            # FileResponse handles Range/If-Range itself and uses the server's
+            # zero-copy path (http.response.pathsend) when available
+            return FileResponse(
+                cached_path,
+                media_type=media.filetype or "application/octet-stream",
+                headers=headers
+            )
+        # A miss doesn't hold up the first byte: fill the cache on the side
+        # and stream this response from Drive
+        cache.prefetch(media.gdrive_id, meta)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and _if_range_matches(request.headers.get("if-range"), etag, last_modified):
+        try:
+            byte_range = parse_range_header(range_header, size)
+        except ValueError:
+            raise HTTPException(
+                status_code=416,
+                detail="Requested range not satisfiable",
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    else:
+        start, end = 0, size - 1
+        status_code = 200
+    headers["Content-Length"] = str(end - start + 1)  # Enables browser progress bar!
     return StreamingResponse(
-        io.BytesIO(file_bytes),
+        MediaService.stream_from_gdrive(media.gdrive_id, start, end),
+        status_code=status_code,
         media_type=media.filetype or "application/octet-stream",
         headers=headers
     )
@@ -108,15 +560,31 @@ async def download_media(
 async def delete_media(
     media_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(admin_required)
+    current_user: Principal = Depends(admin_required)
 ):
     result = await db.execute(select(Media).where(Media.id == media_id))
     media = result.scalars().first()
     if not media:
         raise HTTPException(status_code=404, detail="Media not found")
-    await MediaService.delete_from_gdrive(media.gdrive_id)
+    gdrive_id = media.gdrive_id
+    content_kept = False
     await db.delete(media)
+    if media.content_hash:
+        await db.flush()
+        # None while other media still reference the same content
+        gdrive_id = await release(db, media.content_hash)
+        # The user's copies of this content share its search chunks
+        content_kept = await db.scalar(
+            select(exists().where(Media.user_id == media.user_id, Media.content_hash == media.content_hash))
+        )
     await db.commit()
+    if not content_kept:
+        await forget_media(media.user_id, media_id, media.content_hash)
+    if gdrive_id:
+        await MediaService.delete_from_gdrive(gdrive_id)
+        cache = get_media_cache()
+        if cache is not None:
+            cache.invalidate(gdrive_id)
     return {"success": True}
 
 @router.put("/rename/{media_id}")
@@ -124,13 +592,18 @@ async def rename_media(
     media_id: int,
     new_name: str,
     db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(admin_required)
+    current_user: Principal = Depends(admin_required)
 ):
     result = await db.execute(select(Media).where(Media.id == media_id))
     media = result.scalars().first()
     if not media:
         raise HTTPException(status_code=404, detail="Media not found")
-    await MediaService.rename_gdrive_file(media.gdrive_id, new_name)
+    # A deduplicated Drive object may back other media; their names live on the rows
+    if not media.content_hash:
+        await MediaService.rename_gdrive_file(media.gdrive_id, new_name)
+        cache = get_media_cache()
+        if cache is not None:
+            cache.invalidate(media.gdrive_id)
     media.filename = new_name
     await db.commit()
     await db.refresh(media)
@@ -1,21 +1,40 @@
-from fastapi import APIRouter, Request, Depends
+from fastapi import APIRouter, Request, Depends, HTTPException
+from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from backend.db import get_db
+from backend.db import AsyncSessionLocal, get_db
 from backend.models.user import User
+from backend.models.webhook_job import WebhookJob
+from backend.services.auth_service import Principal
 from backend.services.agent_service import process_chat_message
+from backend.services import job_service
+from backend.services.idempotency import IdempotencyInProgress, get_idempotency_guard, webhook_idempotency_key
 from backend.api.v1.auth import get_current_user
 from backend.config import settings
 import httpx
+import logging
 import re
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/n8n", tags=["n8n"])
 
 @router.post("/webhook")
 async def n8n_webhook(
     request: Request,
+    mode: str = None,
     db: AsyncSession = Depends(get_db)
 ):
+    """
+    Reply to an incoming message. In "async" mode (N8N_WEBHOOK_MODE, or
+    ?mode=async) the message is queued and the call returns 202 with a job
+    id; the reply is POSTed to N8N_WEBHOOK_URL and can be polled from
+    GET /n8n/jobs/{job_id}.
+
+    Repeated deliveries (same Idempotency-Key header or message_id, or the
+    same sender and text within a few minutes) get the first result back
+    with an Idempotent-Replayed header instead of being processed again.
+    """
     data = await request.json()
     email = data.get("email")
     message = data.get("message", "Hello from webhook!")
@@ -27,18 +46,65 @@ async def n8n_webhook(
     if not user:
         return {"error": "User not found"}
 
-    reply = await process_chat_message(db, user, message)
-    return reply
+    async def handle():
+        # Runs shielded and outlives this request if the caller disconnects, so it
+        # must not use the request's session, which is closed when the request ends
+        async with AsyncSessionLocal() as session:
+            if (mode or settings.N8N_WEBHOOK_MODE) == "async":
+                if not await job_service.has_capacity():
+                    raise HTTPException(status_code=503, detail="Too many pending jobs, retry later", headers={"Retry-After": "5"})
+                job = WebhookJob(user_id=user.id, email=user.email, message=message)
+                session.add(job)
+                await session.commit()
+                job_service.submit(job.id, user.id)
+                return {
+                    "status_code": 202,
+                    "body": {
+                        "job_id": job.id,
+                        "status": job.status,
+                        "status_url": str(request.url_for("n8n_job_status", job_id=job.id))
+                    }
+                }
+            reply = await process_chat_message(session, await session.get(User, user.id), message)
+            return {"status_code": 200, "body": reply}
+
+    # n8n retries on timeout: duplicates share one computation and replay its result
+    key, ttl = webhook_idempotency_key(
+        request.headers.get("Idempotency-Key"),
+        email,
+        message,
+        data.get("message_id") or data.get("messageId")
+    )
+    try:
+        outcome, replayed = await get_idempotency_guard().run(key, handle, ttl)
+    except IdempotencyInProgress:
+        raise HTTPException(status_code=409, detail="This delivery is still being processed", headers={"Retry-After": "5"})
+    response = JSONResponse(status_code=outcome["status_code"], content=outcome["body"])
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+@router.get("/jobs/{job_id}", name="n8n_job_status")
+async def n8n_job_status(
+    job_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    """A job's status and reply; only its user (or an admin) can read it."""
+    job = await db.get(WebhookJob, job_id)
+    if not job or (job.user_id != current_user.id and str(current_user.role) != "admin"):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_service.job_payload(job)
 
 @router.get("/webhook")
 async def n8n_webhook1(request: Request):
     # data = await request.json()
-    print("Received n8n webhook data:")
+    logger.info("Received n8n webhook GET request")
     # Process incoming n8n webhook data
     return {"received": "GET request to n8n webhook"}
 
 @router.post("/trigger")
-async def trigger_n8n(current_user: User = Depends(get_current_user)):
+async def trigger_n8n(current_user: Principal = Depends(get_current_user)):
     # Example: trigger n8n workflow via HTTP
     if not settings.N8N_WEBHOOK_URL:
         return {"error": "n8n webhook URL not configured"}
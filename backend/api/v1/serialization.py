@@ -0,0 +1,29 @@
+from fastapi.responses import Response, StreamingResponse
+from pydantic_core import to_json
+
+# Read endpoints return plain dicts/rows straight from column-only queries.
+# pydantic-core's serializer turns them into JSON bytes in one native call
+# (datetimes included), skipping jsonable_encoder and response-model
+# validation; the response models on the routes document the shape.
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return to_json(content)
+
+def ndjson_response(batches, filename: str) -> StreamingResponse:
+    """
+    Stream an async iterator of row-dict batches as newline-delimited JSON,
+    one write per batch.
+    """
+    async def body():
+        async for batch in batches:
+            if batch:
+                yield b"\n".join(to_json(row) for row in batch) + b"\n"
+
+    return StreamingResponse(
+        body(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
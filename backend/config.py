@@ -3,17 +3,139 @@ from pathlib import Path
 
 class Settings(BaseSettings):
     DATABASE_URL: str = ""
+    DB_POOL_SIZE: int = 10             # Connections kept open per worker process
+    DB_MAX_OVERFLOW: int = 10          # Extra connections per worker under burst
+    DB_POOL_TIMEOUT: float = 30.0      # Seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800        # Reconnect connections older than this (seconds)
+    DB_POOL_PRE_PING: bool = True
+    DB_STATEMENT_CACHE_SIZE: int = 100  # asyncpg prepared statements per connection; 0 behind pgbouncer
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 8000
+    SERVER_WORKERS: int = 0            # Worker processes; 0 sizes to the CPUs available to the container
+    SERVER_PROCESSES: int = 1          # Set by backend.server for its workers; org-wide limits and CPUs are split between them
+    SERVER_RELOAD: bool = False        # Single process with autoreload, for development
+    SERVER_KEEPALIVE: int = 5
+    SERVER_GRACEFUL_TIMEOUT: int = 30  # Seconds in-flight requests get after SIGTERM before shutdown hooks run
     JWT_SECRET_KEY: str = ""
     GOOGLE_CLIENT_ID: str = ""
     GOOGLE_CLIENT_SECRET: str = ""
     GOOGLE_REFRESH_TOKEN: str = ""
     GOOGLE_DRIVE_FOLDER_ID: str = ""   # Optional, can be left empty
     N8N_WEBHOOK_URL: str = ""          # Optional
+    N8N_WEBHOOK_MODE: str = "sync"     # "async" answers webhooks with 202 + job id; ?mode= overrides per call
+    N8N_JOB_CONCURRENCY: int = 8       # Jobs processed at once (never two for the same user)
+    N8N_JOB_MAX_PENDING: int = 10000   # Webhooks get 503 above this many unfinished jobs
+    N8N_JOB_STALE_AFTER: float = 600.0  # Seconds before a "running" job left by a dead process is retried
+    N8N_JOB_POLL_INTERVAL: float = 1.0  # Seconds between idle checks for jobs queued by other processes
+    N8N_CALLBACK_TIMEOUT: float = 10.0
+    N8N_CALLBACK_RETRIES: int = 3
+    N8N_JOB_SHUTDOWN_TIMEOUT: float = 10.0
+    N8N_JOB_RETENTION: float = 7 * 24 * 3600  # Seconds finished jobs (and their replies) are kept
+    N8N_JOB_PURGE_INTERVAL: float = 3600.0  # Seconds between deletions of jobs past N8N_JOB_RETENTION
+    IDEMPOTENCY_REDIS_URL: str = ""      # e.g. redis://redis:6379/0; empty keeps results in-process
+    IDEMPOTENCY_TTL: float = 86400.0     # Seconds a webhook result is replayed for a key or message id
+    IDEMPOTENCY_CONTENT_TTL: float = 300.0  # Same, for keys derived from sender + message text only
+    IDEMPOTENCY_MAX_ENTRIES: int = 10000   # In-process store bound
+    IDEMPOTENCY_LOCK_TIMEOUT: float = 120.0  # Redis lock expiry if a process dies mid-request
+    IDEMPOTENCY_WAIT_TIMEOUT: float = 30.0   # How long a duplicate waits on another process before 409
     JWT_ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
     JWT_ALGORITHM: str = "HS256"
+    BCRYPT_MAX_WORKERS: int = 4        # Concurrent password hashes/verifications
+    AUTH_CACHE_TTL: float = 30.0       # Seconds a resolved user is reused; other workers see role changes after at most this
+    AUTH_CACHE_MAX_SIZE: int = 10000
     OPENAI_API_KEY: str = ""
+    OPENAI_BASE_URL: str = ""          # Optional, overrides the OpenAI API endpoint
+    LLM_FALLBACK_MODELS: str = "gpt-4o-mini"  # Comma-separated, tried in order once the chat model keeps failing
+    LLM_RPM_LIMIT: int = 0             # Org requests/minute, split evenly between worker processes; calls queue client-side above a worker's share (0: no limit)
+    LLM_TPM_LIMIT: int = 0             # Org tokens/minute, split the same way; charged with an estimate then the real usage (0: no limit)
+    LLM_MAX_CONCURRENCY: int = 32      # In-flight completions per process; more wait in line
+    LLM_QUEUE_TIMEOUT: float = 10.0    # Max wait for rate budget and a slot before answering 503
+    LLM_TIMEOUT: float = 10.0          # Per attempt
+    LLM_DEADLINE: float = 30.0         # No retry is started that would end past this, per call
+    LLM_MAX_RETRIES: int = 2           # Per model, on 429/5xx/timeouts
+    LLM_RETRY_BASE_DELAY: float = 0.5  # Full-jitter exponential backoff; Retry-After wins if longer
+    LLM_RETRY_MAX_DELAY: float = 8.0
+    LLM_COMPLETION_TOKEN_ESTIMATE: int = 500  # Reply tokens assumed when admitting a call
+    LLM_HEDGE_ENABLED: bool = False    # Send a second request when the first is slower than usual
+    LLM_HEDGE_PERCENTILE: float = 95.0 # Hedge after this percentile of the model's recent latency
+    LLM_HEDGE_MIN_DELAY: float = 1.0
+    LLM_HEDGE_DELAY: float = 4.0       # Used until LLM_HEDGE_MIN_SAMPLES latencies are known
+    LLM_HEDGE_MIN_SAMPLES: int = 20
+    LLM_LATENCY_WINDOW: int = 500      # Recent latencies kept per model
+    PROMPT_TOKEN_BUDGET: int = 3000    # Max input tokens per completion (instructions + history + message)
+    PROMPT_RECENT_SHARE: float = 0.6   # Part of the history budget reserved for recent exchanges
+    PROMPT_TOKENIZER_ENCODING: str = "o200k_base"  # tiktoken encoding of the chat model
+    SEMANTIC_CACHE_ENABLED: bool = False       # Reuse replies to near-identical messages (opt-in)
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95     # Min cosine similarity for a hit
+    SEMANTIC_CACHE_TTL: float = 3600.0         # Seconds
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 10000
+    SEMANTIC_CACHE_MAX_PER_USER: int = 500
+    EMBEDDING_BACKEND: str = "transformers"    # "transformers" (t2v-transformers service) or "local"
+    T2V_TRANSFORMERS_URL: str = "http://t2v-transformers:8080"
+    EMBEDDING_TIMEOUT: float = 2.0
+    LOCAL_EMBEDDING_DIM: int = 384
     GOOGLE_SERVICE_ACCOUNT_FILE: Path = Path(__file__).resolve().parent / "service_account.json"
+    GDRIVE_MAX_WORKERS: int = 8              # Threads (each with its own Drive service) for blocking Drive calls
+    GDRIVE_TOKEN_REFRESH_MARGIN: int = 300   # Seconds before expiry to refresh the access token
+    GDRIVE_DOWNLOAD_CHUNK_SIZE: int = 4 * 1024 * 1024  # Bytes per ranged Drive request when streaming downloads
+    MEDIA_UPLOAD_CONCURRENCY: int = 4        # Files uploaded to Drive in parallel per request
+    UPLOAD_MAX_FILE_SIZE: int = 100 * 1024 ** 3  # Largest resumable upload accepted
+    UPLOAD_CHUNK_TIMEOUT: float = 300.0      # Seconds without progress before a relayed chunk is abandoned
+    UPLOAD_MAX_CONNECTIONS: int = 64         # Concurrent chunk relays to Drive per worker process
+    UPLOAD_SESSION_TTL: float = 7 * 24 * 3600  # Resumable uploads untouched this long are expired (Drive drops its sessions after a week)
+    UPLOAD_SWEEP_INTERVAL: float = 3600.0    # Seconds between sweeps for expired upload sessions
+    MEDIA_CACHE_ENABLED: bool = True
+    MEDIA_CACHE_DIR: Path = Path("/tmp/ccc_media_cache")
+    MEDIA_CACHE_MAX_BYTES: int = 2 * 1024 ** 3        # LRU-evicted above this total, across all workers
+    MEDIA_CACHE_MAX_ENTRY_BYTES: int = 256 * 1024 ** 2  # Larger files are streamed from Drive uncached
     WEAVIATE_URL:  str = "http://weaviate:8080"
+    STARTUP_RETRY_BASE_DELAY: float = 0.5  # First backoff while a dependency comes up, doubled per attempt
+    STARTUP_RETRY_MAX_DELAY: float = 30.0  # Backoff cap; startup keeps retrying until ready
+    WEAVIATE_MAX_WORKERS: int = 8      # Threads running blocking Weaviate client calls
+    CHAT_MEMORY_COLLECTION: str = "ChatMemory"     # Multi-tenant collection, one tenant per user
+    LEGACY_CHAT_COLLECTION: str = "ChatMessage"    # Pre-tenancy collection, source of the backfill
+    FILE_INFO_COLLECTION: str = "FileInfo"         # Text chunks of uploaded documents, filtered by user_id
+    WEAVIATE_TENANT_IDLE_SECONDS: float = 3600.0   # Tenants unused this long are taken out of memory
+    WEAVIATE_TENANT_IDLE_STATUS: str = "INACTIVE"  # Or "OFFLOADED" when an offload module is configured
+    WEAVIATE_TENANT_SWEEP_INTERVAL: float = 300.0  # Seconds between idle-tenant sweeps
+    RECENT_HISTORY_TIMEOUT: float = 2.0  # Seconds; chat continues without recent history past this
+    VECTOR_SEARCH_TIMEOUT: float = 2.0   # Seconds; chat continues without relevant memories past this
+    METRICS_ENABLED: bool = True         # Serve Prometheus metrics at /metrics
+    METRICS_DIR: str = "/tmp/ccc_metrics"  # Worker snapshots merged by /metrics; "" for per-process metrics
+    METRICS_SNAPSHOT_INTERVAL: float = 5.0
+    METRICS_LOOP_LAG_INTERVAL: float = 0.5  # Event-loop lag probe period
+    TRACING_ENABLED: bool = False        # Emit OpenTelemetry spans (needs opentelemetry-sdk and an exporter)
+    LOG_QUEUE_SIZE: int = 10000          # Records buffered for the log writer thread; more are dropped
+    EXPORT_BATCH_SIZE: int = 1000        # Rows fetched per round trip and written per chunk by NDJSON exports
+    LOG_PAYLOAD_SAMPLE_RATE: float = 0.01  # Share of chat calls whose retrieved context is logged
+    LOCAL_INDEX_MODE: str = "failover"   # "off", "failover" (Weaviate first) or "primary" (local first)
+    LOCAL_INDEX_DIR: Path = Path("/tmp/ccc_memory_index")
+    LOCAL_INDEX_MAX_PER_USER: int = 20000     # Newest memories searched per user
+    LOCAL_INDEX_CACHED_USERS: int = 1024      # Per-user indexes kept mapped in memory
+    LOCAL_INDEX_FAILOVER_TIMEOUT: float = 0.5  # Seconds to wait for Weaviate before answering locally
+    MEMORY_INGEST_QUEUE_SIZE: int = 1000       # Memories buffered in-process before producers wait
+    MEMORY_INGEST_BATCH_SIZE: int = 64
+    MEMORY_INGEST_FLUSH_INTERVAL: float = 1.0  # Seconds a partial batch may wait
+    MEMORY_INGEST_MAX_RETRIES: int = 3
+    MEMORY_INGEST_RETRY_BASE_DELAY: float = 0.5
+    MEMORY_ENQUEUE_TIMEOUT: float = 0.5        # Backpressure wait before deferring to the outbox sweep
+    MEMORY_OUTBOX_SWEEP_INTERVAL: float = 60.0
+    MEMORY_OUTBOX_MIN_AGE: float = 30.0        # Sweep leaves newer rows to the worker process that wrote them
+    MEMORY_INGEST_SHUTDOWN_TIMEOUT: float = 10.0
+    DOCUMENT_INDEXING_ENABLED: bool = True     # Extract uploaded PDFs / text files into FILE_INFO_COLLECTION
+    DOCUMENT_EXTRACT_WORKERS: int = 0          # Text extraction processes per server worker; 0 splits the available CPUs between them
+    DOCUMENT_INDEX_CONCURRENCY: int = 8        # Documents hashed, extracted or inserted at once
+    DOCUMENT_QUEUE_SIZE: int = 1000            # Uploaded documents waiting for the indexer; more are skipped
+    DOCUMENT_MAX_BYTES: int = 50 * 1024 * 1024  # Larger uploads are stored but not indexed
+    DOCUMENT_CHUNK_SIZE: int = 1500            # Characters per chunk
+    DOCUMENT_CHUNK_OVERLAP: int = 200          # Characters repeated between neighbouring chunks
+    DOCUMENT_INSERT_BATCH_SIZE: int = 200
+    DOCUMENT_SEARCH_TOP_K: int = 4             # Document chunks offered to the prompt next to chat memories
+    DOCUMENT_STAGING_DIR: Path = Path("/tmp/ccc_document_staging")
+    CHAT_RETENTION_MONTHS: int = 0             # Months of chats kept in Postgres and Weaviate; 0 keeps everything
+    CHAT_PARTITION_PREMAKE_MONTHS: int = 3     # Monthly chats partitions created ahead of time
+    CHAT_RETENTION_INTERVAL: float = 6 * 3600.0
+    CHAT_ARCHIVE_DIR: Path = Path(__file__).resolve().parent.parent / "chat_archive"  # gzip JSONL of dropped months
     class Config:
         env_file = Path(__file__).resolve().parent / ".env"
         env_file_encoding = 'utf-8'
@@ -1,11 +1,33 @@
+import os
+import logging
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from backend.config import settings
+from backend.services.metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 DATABASE_URL = settings.DATABASE_URL
-from backend.config import settings
-print("Loaded DATABASE_URL:", repr(settings.DATABASE_URL))
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+logger.info(f"Database: {make_url(DATABASE_URL).render_as_string(hide_password=True)}")
+
+def _engine_options(url: str) -> dict:
+    options = {"echo": False, "future": True, "pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if make_url(url).get_backend_name() == "postgresql":
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            connect_args={"statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+        )
+    return options
+
+# One pool per worker process. Each uvicorn worker imports this module itself;
+# if the app is instead loaded before forking (e.g. gunicorn --preload), the
+# child drops the inherited connections without closing the parent's.
+engine = create_async_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
 
 AsyncSessionLocal = sessionmaker(
     bind=engine,
@@ -13,6 +35,22 @@ AsyncSessionLocal = sessionmaker(
     expire_on_commit=False
 )
 
+os.register_at_fork(after_in_child=lambda: engine.sync_engine.dispose(close=False))
+
+@registry.collector
+def _pool_metrics():
+    pool = engine.sync_engine.pool
+    if not hasattr(pool, "checkedout"):
+        return []  # Pools without a fixed size (sqlite)
+    return [
+        ("ccc_db_pool_connections", "gauge", "Connections in this worker's pool by state.", ("state",), {
+            ("checked_out",): pool.checkedout(),
+            ("idle",): pool.checkedin(),
+            ("overflow",): max(pool.overflow(), 0),
+        }),
+        ("ccc_db_pool_size", "gauge", "Configured pool size per worker.", (), {(): pool.size()}),
+    ]
+
 async def get_db() -> AsyncSession:
     async with AsyncSessionLocal() as session:
-        yield session 
\ No newline at end of file
+        yield session
@@ -1,13 +1,28 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from backend.api.v1 import auth, media, n8n, chat
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from backend.db import engine, AsyncSessionLocal
 from backend.models import Base
 from backend.config import settings
 from backend.models.user import User
 from backend.services.auth_service import AuthService
-from backend.services.weaviate_service import setup_schema
+from backend.services.readiness import readiness
+from backend.services.weaviate_service import connect_weaviate, shutdown, start_tenant_sweeper, stop_tenant_sweeper
+from backend.services.ingest_service import start_ingest_worker, stop_ingest_worker
+from backend.services.gdrive_client import close_drive_client
+from backend.services.embedding_service import close_embedding_client
+from backend.services.job_service import start_job_workers, stop_job_workers
+from backend.services.idempotency import close_idempotency_store
+from backend.services.llm_gateway import close_llm_gateway
+from backend.services.resumable_upload import close_upload_client, start_upload_sweeper, stop_upload_sweeper
+from backend.services.metrics import MetricsMiddleware, collect_all, render, start_metrics_tasks, stop_metrics_tasks
+from backend.services.log_queue import start_queue_logging, stop_queue_logging
+from backend.services.chat_retention import start_retention_worker, stop_retention_worker
+from backend.services.document_service import start_document_indexer, stop_document_indexer
 
 app = FastAPI()
 
@@ -23,29 +38,84 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
-@app.on_event("startup")
-async def on_startup():
-    setup_schema()
-    engine = create_async_engine(settings.DATABASE_URL, echo=True)
+async def init_database():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     # Seed default admin user
-    async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
-    async with async_session() as session:
-        result = await session.execute(
-            User.__table__.select().where(User.email == "admin@example.com")
-        )
-        admin = result.first()
-        if not admin:
-            admin_user = User(
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(User.id).where(User.email == "admin@example.com"))
+        if result.first() is None:
+            session.add(User(
                 email="admin@example.com",
-                hashed_password=AuthService.hash_password("admin123"),
+                hashed_password=await AuthService.hash_password_async("admin123"),
                 is_active=True,
                 role="admin"
-            )
-            session.add(admin_user)
-            await session.commit()
+            ))
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()  # Seeded by another worker process
+    start_ingest_worker()
+    await start_job_workers()
+    start_retention_worker()
+    start_document_indexer()
+    start_upload_sweeper()
+
+async def init_weaviate():
+    await asyncio.to_thread(connect_weaviate)
+    start_tenant_sweeper()
+
+@app.on_event("startup")
+async def on_startup():
+    start_queue_logging()
+    start_metrics_tasks()
+    # Dependencies come up in the background, retried with backoff, so the
+    # server answers /healthz right away and /readyz reports progress.
+    readiness.start("database", init_database)
+    # Chat falls back to the local memory index until Weaviate is reachable
+    readiness.start("weaviate", init_weaviate, required=False)
+
+@app.get("/healthz", tags=["health"])
+async def healthz():
+    """Liveness: the process is up and serving."""
+    return {"status": "ok"}
+
+@app.get("/readyz", tags=["health"])
+async def readyz():
+    """Readiness: 200 once every required dependency is up, 503 until then."""
+    ready, dependencies = readiness.report()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "starting", "dependencies": dependencies}
+    )
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus text format, summed over the worker processes."""
+    if not settings.METRICS_ENABLED:
+        return PlainTextResponse("metrics disabled\n", status_code=404)
+    families = await asyncio.to_thread(collect_all)
+    return PlainTextResponse(render(families), media_type="text/plain; version=0.0.4")
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await readiness.stop()
+    await stop_job_workers()
+    await stop_retention_worker()
+    await stop_document_indexer()
+    await stop_upload_sweeper()
+    await stop_ingest_worker()
+    await stop_tenant_sweeper()
+    shutdown()
+    close_drive_client()
+    await close_embedding_client()
+    await close_idempotency_store()
+    await close_llm_gateway()
+    await close_upload_client()
+    await stop_metrics_tasks()
+    stop_queue_logging()
 
 app.include_router(auth.router, prefix="/api/v1")
 app.include_router(media.router, prefix="/api/v1")
@@ -0,0 +1,81 @@
+"""
+Backfill chat memories from the single-tenant ChatMessage collection into the
+multi-tenant ChatMemory collection, one tenant per user.
+
+Objects keep their UUIDs and vectors, so nothing is re-vectorized and the
+script can be re-run safely (batch writes upsert by UUID). Run it once after
+deploying tenant-scoped retrieval:
+
+    python -m backend.migrations.chat_tenants [--drop-legacy]
+"""
+import argparse
+import logging
+from collections import Counter
+from backend.config import settings
+from backend.services.weaviate_service import (
+    get_weaviate_client,
+    setup_schema,
+    shutdown,
+    tenant_name
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def backfill(wclient, batch_size=200):
+    """Copy every legacy object into its owner's tenant. Returns (copied per tenant, skipped, failed)."""
+    if not wclient.collections.exists(settings.LEGACY_CHAT_COLLECTION):
+        logger.info(f"No {settings.LEGACY_CHAT_COLLECTION} collection, nothing to backfill")
+        return Counter(), 0, 0
+    legacy = wclient.collections.get(settings.LEGACY_CHAT_COLLECTION)
+    copied = Counter()
+    skipped = 0
+    with wclient.batch.fixed_size(batch_size=batch_size) as batch:
+        for obj in legacy.iterator(include_vector=True):
+            user_id = obj.properties.get("user_id")
+            if not user_id:
+                skipped += 1
+                continue
+            tenant = tenant_name(user_id)
+            batch.add_object(
+                collection=settings.CHAT_MEMORY_COLLECTION,
+                properties=obj.properties,
+                uuid=obj.uuid,
+                vector=obj.vector or None,
+                tenant=tenant
+            )
+            copied[tenant] += 1
+    failed = len(wclient.batch.failed_objects)
+    for failure in wclient.batch.failed_objects[:10]:
+        logger.warning(f"Backfill failed for {failure.object_.uuid}: {failure.message}")
+    return copied, skipped, failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument(
+        "--drop-legacy",
+        action="store_true",
+        help=f"Delete {settings.LEGACY_CHAT_COLLECTION} once every object has been copied"
+    )
+    args = parser.parse_args()
+
+    setup_schema()  # Creates the multi-tenant collection if needed
+    wclient = get_weaviate_client()
+    try:
+        copied, skipped, failed = backfill(wclient, batch_size=args.batch_size)
+        logger.info(
+            f"Copied {sum(copied.values())} memories into {len(copied)} tenants "
+            f"({skipped} without a user_id skipped, {failed} failed)"
+        )
+        if args.drop_legacy:
+            if failed or skipped:
+                logger.warning(f"Keeping {settings.LEGACY_CHAT_COLLECTION}: not every object was copied")
+            else:
+                wclient.collections.delete(settings.LEGACY_CHAT_COLLECTION)
+                logger.info(f"Deleted {settings.LEGACY_CHAT_COLLECTION}")
+    finally:
+        shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Composite (user_id, created_at) indexes for keyset-paginated media and chat history
+
+Tables are still created by create_all at startup, so this revision only
+adds indexes and tolerates databases where they already exist.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CONCURRENTLY cannot run inside a transaction; large tables stay writable
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_media_user_id_created_at", "media", ["user_id", "created_at"],
+            if_not_exists=True, postgresql_concurrently=True
+        )
+        op.create_index(
+            "ix_chats_user_id_created_at", "chats", ["user_id", "created_at"],
+            if_not_exists=True, postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_chats_user_id_created_at", table_name="chats", if_exists=True, postgresql_concurrently=True)
+        op.drop_index("ix_media_user_id_created_at", table_name="media", if_exists=True, postgresql_concurrently=True)
@@ -0,0 +1,46 @@
+"""Store chats.media_ids as JSONB instead of a JSON (or comma-separated) string
+
+Databases created by create_all after this change already have the JSONB
+column, so the conversion is skipped when it is in place.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def _media_ids_type():
+    columns = sa.inspect(op.get_bind()).get_columns("chats")
+    return next(c["type"] for c in columns if c["name"] == "media_ids")
+
+
+def upgrade():
+    if isinstance(_media_ids_type(), JSONB):
+        return
+    # A subquery can't go in ALTER ... USING, so convert through a new column
+    op.add_column("chats", sa.Column("media_ids_jsonb", JSONB, nullable=True))
+    op.execute(
+        """
+        UPDATE chats SET media_ids_jsonb = CASE
+            WHEN media_ids IS NULL OR btrim(media_ids) = '' THEN '[]'::jsonb
+            WHEN btrim(media_ids) LIKE '[%' THEN media_ids::jsonb
+            ELSE to_jsonb(string_to_array(regexp_replace(media_ids, '\\s', '', 'g'), ',')::int[])
+        END
+        """
+    )
+    op.drop_column("chats", "media_ids")
+    op.alter_column("chats", "media_ids_jsonb", new_column_name="media_ids")
+
+
+def downgrade():
+    op.alter_column(
+        "chats", "media_ids", type_=sa.Text(), postgresql_using="media_ids::text", existing_nullable=True
+    )
@@ -0,0 +1,127 @@
+"""Range-partition chats by month on created_at
+
+The existing table is renamed, a partitioned `chats` takes its place with
+monthly partitions from the oldest row up to a few months ahead plus a
+default partition, the rows are copied over and the old table is dropped.
+The primary key becomes (id, created_at) because unique constraints on a
+partitioned table must include the partition key; ids still come from
+chats_id_seq. Skipped when chats is already partitioned. Further months are
+created by the retention job (backend/services/chat_retention.py).
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from datetime import date, datetime, timezone
+from alembic import op
+from sqlalchemy import text
+from backend.config import settings
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+# Same naming as backend/services/chat_retention.py; kept here so the
+# revision doesn't change when the service does
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _month_of(ts):
+    return date(ts.year, ts.month, 1)
+
+
+def _relkind():
+    return op.get_bind().scalar(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('chats')"))
+
+
+def _rename_old_table():
+    op.execute("ALTER TABLE chats RENAME TO chats_unpartitioned")
+    op.execute("ALTER TABLE chats_unpartitioned RENAME CONSTRAINT chats_pkey TO chats_unpartitioned_pkey")
+    op.execute("ALTER INDEX IF EXISTS ix_chats_id RENAME TO ix_chats_unpartitioned_id")
+    op.execute(
+        "ALTER INDEX IF EXISTS ix_chats_user_id_created_at RENAME TO ix_chats_unpartitioned_user_id_created_at"
+    )
+
+
+def _create_indexes():
+    op.execute("CREATE INDEX ix_chats_id ON chats (id)")
+    op.execute("CREATE INDEX ix_chats_user_id_created_at ON chats (user_id, created_at)")
+
+
+def upgrade():
+    if _relkind() == "p":
+        return
+    _rename_old_table()
+    op.execute(
+        """
+        CREATE TABLE chats (
+            id INTEGER NOT NULL DEFAULT nextval('chats_id_seq'),
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            message VARCHAR NOT NULL,
+            response TEXT,
+            media_ids JSONB,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            CONSTRAINT chats_pkey PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+        """
+    )
+    op.execute("ALTER SEQUENCE chats_id_seq OWNED BY chats.id")
+    _create_indexes()
+    op.execute("CREATE TABLE chats_default PARTITION OF chats DEFAULT")
+
+    now = datetime.now(timezone.utc)
+    oldest = op.get_bind().scalar(text("SELECT min(created_at) FROM chats_unpartitioned"))
+    month = _month_of(oldest or now)
+    last = _add_months(_month_of(now), settings.CHAT_PARTITION_PREMAKE_MONTHS)
+    while month <= last:
+        op.execute(
+            f"CREATE TABLE chats_p{month.year}_{month.month:02d} PARTITION OF chats "
+            f"FOR VALUES FROM (timestamptz '{month.isoformat()} 00:00:00+00') "
+            f"TO (timestamptz '{_add_months(month, 1).isoformat()} 00:00:00+00')"
+        )
+        month = _add_months(month, 1)
+
+    op.execute(
+        """
+        INSERT INTO chats (id, user_id, message, response, media_ids, created_at)
+        SELECT id, user_id, message, response, media_ids, coalesce(created_at, now())
+        FROM chats_unpartitioned
+        """
+    )
+    op.execute("DROP TABLE chats_unpartitioned")
+
+
+def downgrade():
+    if _relkind() != "p":
+        return
+    op.execute("ALTER TABLE chats RENAME TO chats_partitioned")
+    op.execute("ALTER TABLE chats_partitioned RENAME CONSTRAINT chats_pkey TO chats_partitioned_pkey")
+    op.execute("ALTER INDEX ix_chats_id RENAME TO ix_chats_partitioned_id")
+    op.execute("ALTER INDEX ix_chats_user_id_created_at RENAME TO ix_chats_partitioned_user_id_created_at")
+    op.execute(
+        """
+        CREATE TABLE chats (
+            id INTEGER NOT NULL DEFAULT nextval('chats_id_seq'),
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            message VARCHAR NOT NULL,
+            response TEXT,
+            media_ids JSONB,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            CONSTRAINT chats_pkey PRIMARY KEY (id)
+        )
+        """
+    )
+    op.execute("ALTER SEQUENCE chats_id_seq OWNED BY chats.id")
+    _create_indexes()
+    op.execute(
+        """
+        INSERT INTO chats (id, user_id, message, response, media_ids, created_at)
+        SELECT id, user_id, message, response, media_ids, created_at FROM chats_partitioned
+        """
+    )
+    # Dropping the parent drops every partition with it
+    op.execute("DROP TABLE chats_partitioned")
@@ -0,0 +1,24 @@
+"""Widen media.file_size to BIGINT for files of 2 GiB and more
+
+Resumable uploads accept files far past the INTEGER range. The
+upload_sessions table itself is created by create_all at startup.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column("media", "file_size", type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=True)
+
+
+def downgrade():
+    op.alter_column("media", "file_size", type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=True)
@@ -0,0 +1,43 @@
+"""Content-addressed media storage: media_blobs and media.content_hash
+
+media_blobs holds one row per distinct content (SHA-256) with its Drive
+object and reference count. Existing media keep a NULL content_hash and
+their own Drive object; only new uploads are deduplicated. Both steps are
+skipped when create_all has already built them.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("media_blobs"):
+        op.create_table(
+            "media_blobs",
+            sa.Column("sha256", sa.String(64), primary_key=True),
+            sa.Column("gdrive_id", sa.String(), nullable=False),
+            sa.Column("file_size", sa.BigInteger(), nullable=True),
+            sa.Column("refcount", sa.Integer(), nullable=False, server_default="0"),
+            sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        )
+    if "content_hash" not in {c["name"] for c in inspector.get_columns("media")}:
+        op.add_column(
+            "media",
+            sa.Column("content_hash", sa.String(64), sa.ForeignKey("media_blobs.sha256"), nullable=True)
+        )
+    op.create_index("ix_media_content_hash", "media", ["content_hash"], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index("ix_media_content_hash", table_name="media", if_exists=True)
+    op.drop_column("media", "content_hash")
+    op.drop_table("media_blobs")
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func, Text
+from sqlalchemy import JSON, Column, Integer, String, ForeignKey, DateTime, func, Text, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from backend.models import Base
 
 class Chat(Base):
@@ -8,5 +9,10 @@ class Chat(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     message = Column(String, nullable=False)
     response = Column(Text, nullable=True)
-    media_ids = Column(Text, nullable=True)  # Comma-separated or JSON string of Media IDs
-    created_at = Column(DateTime(timezone=True), server_default=func.now()) 
\ No newline at end of file
+    media_ids = Column(JSON().with_variant(JSONB, "postgresql"), nullable=True)  # List of Media IDs
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)  # Partition key on Postgres
+
+    __table_args__ = (
+        # Per-user history, newest first (recent messages, /chat/history pages)
+        Index("ix_chats_user_id_created_at", "user_id", "created_at"),
+    )
\ No newline at end of file
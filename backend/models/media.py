@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func
+from sqlalchemy import BigInteger, Column, Integer, String, ForeignKey, DateTime, func, Index
 from backend.models import Base
+from backend.models.media_blob import MediaBlob  # noqa: F401  (target of content_hash)
 
 class Media(Base):
     __tablename__ = "media"
@@ -9,5 +10,12 @@ class Media(Base):
     filename = Column(String, nullable=False)
     filetype = Column(String, nullable=False)
     gdrive_id = Column(String, nullable=False)
-    file_size = Column(Integer, nullable=True)  # size in bytes
-    created_at = Column(DateTime(timezone=True), server_default=func.now()) 
\ No newline at end of file
+    file_size = Column(BigInteger, nullable=True)  # size in bytes
+    content_hash = Column(String(64), ForeignKey("media_blobs.sha256"), nullable=True, index=True)  # None for legacy rows
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Load created_at from INSERT ... RETURNING, so batch inserts need no refresh
+    __mapper_args__ = {"eager_defaults": True}
+    __table_args__ = (
+        Index("ix_media_user_id_created_at", "user_id", "created_at"),
+    )
\ No newline at end of file
@@ -0,0 +1,12 @@
+from sqlalchemy import BigInteger, Column, Integer, String, DateTime, func
+from backend.models import Base
+
+class MediaBlob(Base):
+    """One Drive object per distinct file content, shared by every Media row with that content."""
+    __tablename__ = "media_blobs"
+
+    sha256 = Column(String(64), primary_key=True)  # Hex digest of the content; unique by construction
+    gdrive_id = Column(String, nullable=False)
+    file_size = Column(BigInteger, nullable=True)
+    refcount = Column(Integer, default=0, nullable=False)  # Media rows pointing here; the Drive object goes at 0
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
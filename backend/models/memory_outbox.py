@@ -0,0 +1,13 @@
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, func, Text
+from backend.models import Base
+
+class MemoryOutbox(Base):
+    """Chat memories committed with their Chat row and waiting for Weaviate ingestion."""
+    __tablename__ = "memory_outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    text = Column(Text, nullable=False)
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,20 @@
+import uuid
+from sqlalchemy import BigInteger, Column, Integer, String, ForeignKey, DateTime, func, Text
+from backend.models import Base
+
+class UploadSession(Base):
+    """A resumable upload relayed chunk by chunk into a Google Drive resumable session."""
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    filename = Column(String, nullable=False)
+    filetype = Column(String, nullable=False)
+    file_size = Column(BigInteger, nullable=False)
+    drive_session_uri = Column(Text, nullable=False)
+    offset = Column(BigInteger, default=0, nullable=False)  # Bytes Drive has acknowledged
+    status = Column(String(16), default="open", nullable=False)  # open, uploaded, finalizing, complete, cancelled, expired
+    gdrive_id = Column(String, nullable=True)  # Set once Drive has the whole file
+    media_id = Column(Integer, ForeignKey("media.id"), nullable=True)  # Set by finalize
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,25 @@
+import uuid
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func, Text, Index
+from backend.models import Base
+
+class WebhookJob(Base):
+    """An n8n webhook message accepted for asynchronous processing."""
+    __tablename__ = "webhook_jobs"
+
+    id = Column(String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    email = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    status = Column(String(16), default="queued", nullable=False)  # queued, running, done, failed
+    result = Column(Text, nullable=True)  # JSON reply, same shape as the synchronous webhook response
+    error = Column(Text, nullable=True)
+    callback_status = Column(Integer, nullable=True)  # HTTP status of the last callback attempt
+    # Set in Python for sub-second precision on every backend: workers claim a user's jobs in this order
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # Workers claim unfinished jobs in arrival order
+        Index("ix_webhook_jobs_status_created_at", "status", "created_at"),
+    )
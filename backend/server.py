@@ -0,0 +1,63 @@
+import logging
+import os
+import uvicorn
+from backend.config import settings
+from backend.services.processes import available_cpus
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Production entry point: `python -m backend.server`.
+#
+# Runs the app in SERVER_WORKERS processes (sized to the CPUs the container
+# may use when 0). Each worker builds its own DB pool, HTTP clients and
+# background workers in the startup hooks; module-level clients are reset
+# after fork (see services/forksafe.py) so nothing created in a parent is
+# shared. State the workers must agree on lives outside them: webhook jobs
+# are claimed from the database, webhook results are deduplicated in Redis
+# (IDEMPOTENCY_REDIS_URL, required for more than one worker) and the
+# semantic cache keys replies on the retrieved context, which every worker
+# reads from the same stores. On SIGTERM uvicorn stops accepting connections,
+# gives in-flight requests SERVER_GRACEFUL_TIMEOUT seconds, then runs the
+# shutdown hooks, which flush the memory ingest queue and wait for running
+# webhook jobs.
+
+def worker_count() -> int:
+    if settings.SERVER_WORKERS > 0:
+        return settings.SERVER_WORKERS
+    return available_cpus()
+
+def process_count() -> int:
+    """
+    worker_count(), or one process when webhook deduplication would not be
+    shared: the in-process idempotency store only sees its own requests.
+    """
+    workers = worker_count()
+    if workers > 1 and not settings.IDEMPOTENCY_REDIS_URL:
+        if settings.SERVER_WORKERS > 1:
+            raise SystemExit("SERVER_WORKERS > 1 needs IDEMPOTENCY_REDIS_URL so webhook retries are deduplicated across workers")
+        logger.warning("IDEMPOTENCY_REDIS_URL is not set, starting a single worker")
+        return 1
+    return workers
+
+def main():
+    options = dict(
+        host=settings.SERVER_HOST,
+        port=settings.SERVER_PORT,
+        proxy_headers=True,
+        forwarded_allow_ips="*",
+        timeout_keep_alive=settings.SERVER_KEEPALIVE,
+        timeout_graceful_shutdown=settings.SERVER_GRACEFUL_TIMEOUT,
+    )
+    if settings.SERVER_RELOAD:
+        logger.info("Starting a single reloading worker")
+        uvicorn.run("backend.main:app", reload=True, **options)
+        return
+    workers = process_count()
+    # Inherited by the workers, which split the org-wide LLM rate limits by it
+    os.environ["SERVER_PROCESSES"] = str(workers)
+    logger.info(f"Starting {workers} worker processes")
+    uvicorn.run("backend.main:app", workers=workers, **options)
+
+if __name__ == "__main__":
+    main()
@@ -1,146 +1,436 @@
 import json
 import logging
 import asyncio
+import time
 from fastapi import HTTPException
-from openai import AsyncOpenAI
 from backend.models.chat import Chat
 from backend.config import settings
 
 from backend.services.weaviate_service import (
     get_weaviate_client,
-    save_message_to_weaviate,
     get_recent_messages,
-    search_relevant_messages
+    search_documents
 )
+from backend.services.local_index import search_memories
+from backend.services.ingest_service import new_outbox_entry, enqueue_memory
+from backend.services.embedding_service import embed_text, embedding_backend_id
+from backend.services.response_cache import get_response_cache
+from backend.services.llm_gateway import LLMOverloaded, get_llm_gateway
+from backend.services.metrics import CHAT_STAGE_SECONDS, stage
+from backend.services.log_queue import log_payload
+from backend.services.forksafe import reset_after_fork
+import hashlib
 
 wclient = None
-client = None
+reset_after_fork(globals(), wclient=None)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def build_prompt(history, current_message):
-    recent_msgs = [msg for msg in history if msg.get("source") == "recent"]
-    relevant_msgs = [msg for msg in history if msg.get("source") == "relevant"]
-
-    def format_history(msgs):
-        formatted = []
-        for msg in msgs:
-            other = msg.get("text", "")
-            mine = msg.get("my_message", "")
-            timestamp = msg.get("timestamp", "")
-            formatted.append(f"{{{other}, {mine}, {timestamp}}}")
-        return "\n".join(formatted)
-
-    def format_history1(msgs):
-        formatted = []
-        for msg in msgs:
-            other = msg.get("text", "")
-            timestamp = msg.get("timestamp", "")
-            formatted.append(f"{{{other}, {timestamp}}}")
-        return "\n".join(formatted)
-
-    recent_history_str = format_history(recent_msgs)
-    relevant_history_str = format_history(relevant_msgs)
-
-    system_instruction = (
-        "I am an entrepreneur.\n"
-        "Below is a conversation between me and another person.\n"
-        "Each exchange is written in the format: {the other person's message, my message, timestamp}.\n"
-        f"{recent_history_str}\n"
-        "And this is chat histories you have to refer.\n"
-        "Each history is written in the format: {history, timestamp}.\n"
-        f"{relevant_history_str}\n"
-        "Role: Think as me (a real human, not an assistant)"
-        "Analyze: Tone, intent, emotion of the latest message"
-        "Use: Only relevant past context"
-        "Consider: Relationship type (casual/professional), emotional flow (trust, humor, tension)"
-        "Goal: Respond naturally to move the conversation forward"
-        "Style: Output only my next message"
-        "Use human, realistic tone (casual, warm, witty, or empathetic)"
-        "Avoid robotic or scripted language"
-        "Reminder: This is real conversation, not chatbot interaction"
-        "Message Type: May be a question or statement — respond accordingly"
-    )
-    prompt = [
-        {"role": "system", "content": system_instruction},
-        {"role": "user", "content": current_message},
-    ]
-    return prompt
+# Fixed instructions go first and never change, so the provider's prompt
+# prefix cache can reuse them across every call. Variable context follows.
+SYSTEM_INSTRUCTION = (
+    "I am an entrepreneur.\n"
+    "Role: Think as me (a real human, not an assistant)\n"
+    "Analyze: Tone, intent, emotion of the latest message\n"
+    "Use: Only relevant past context\n"
+    "Consider: Relationship type (casual/professional), emotional flow (trust, humor, tension)\n"
+    "Goal: Respond naturally to move the conversation forward\n"
+    "Style: Output only my next message\n"
+    "Use human, realistic tone (casual, warm, witty, or empathetic)\n"
+    "Avoid robotic or scripted language\n"
+    "Reminder: This is real conversation, not chatbot interaction\n"
+    "Message Type: May be a question or statement — respond accordingly\n"
+    "The next message holds the conversation so far. "
+    "Each exchange is written in the format: {the other person's message, my message, timestamp}. "
+    "It may also hold chat histories you have to refer, "
+    "each written in the format: {history, timestamp}; "
+    "histories starting with [a file name] are excerpts from my documents."
+)
+CHAT_MODEL = "gpt-4o"
+CHAT_TEMPERATURE = 0.9
+RECENT_HEADER = "Below is a conversation between me and another person."
+RELEVANT_HEADER = "And this is chat histories you have to refer."
+MESSAGE_OVERHEAD_TOKENS = 4  # Per-message framing tokens in the chat format
 
-async def process_chat_message(db, user, message: str):
-    global client
-    if client is None:
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    """Token count with the model's tiktoken encoding, or a ~4 chars/token estimate without it."""
+    global _encoding
+    if _encoding is None:
         try:
-            client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+            import tiktoken
+            _encoding = tiktoken.get_encoding(settings.PROMPT_TOKENIZER_ENCODING)
         except Exception as e:
-            logger.error(f"Failed to create OpenAI client: {e}")
-            raise HTTPException(status_code=500, detail=f"OpenAI client error: {e}")
+            logger.warning(f"tiktoken unavailable ({e}), estimating prompt tokens from length")
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def _format_recent(msg):
+    return f"{{{msg.get('text', '')}, {msg.get('my_message', '')}, {msg.get('timestamp', '')}}}"
+
+def _format_relevant(msg):
+    return f"{{{msg.get('text', '')}, {msg.get('timestamp', '')}}}"
+
+def select_history(history, budget):
+    """
+    Pick the history that fits in `budget` tokens.
+
+    Recent exchanges are taken newest first, up to PROMPT_RECENT_SHARE of the
+    budget; relevant memories then fill the rest, best score first (newest
+    first on ties). Relevant memories that repeat a recent exchange or each
+    other are dropped. Returns (recent, relevant), each oldest first.
+    """
+    recent = sorted(
+        (m for m in history if m.get("source") == "recent"),
+        key=lambda m: m.get("timestamp", ""), reverse=True
+    )
+    seen = set()
+    for m in recent:
+        seen.add(_normalize(m.get("text", "")))
+        # Memories are stored as "Other:<message>, me:<response>"
+        seen.add(_normalize(f"Other:{m.get('text', '')}, me:{m.get('my_message', '')}"))
+    relevant = []
+    for m in sorted(
+        (m for m in history if m.get("source") == "relevant"),
+        key=lambda m: (m.get("score") or 0.0, m.get("timestamp", "")), reverse=True
+    ):
+        key = _normalize(m.get("text", ""))
+        if key not in seen:
+            seen.add(key)
+            relevant.append(m)
+
+    chosen_recent, chosen_relevant = [], []
+    used = 0
+    recent_budget = int(budget * settings.PROMPT_RECENT_SHARE)
+    for m in recent:
+        cost = count_tokens(_format_recent(m)) + 1
+        if used + cost > recent_budget:
+            break
+        chosen_recent.append(m)
+        used += cost
+    for m in relevant:
+        cost = count_tokens(_format_relevant(m)) + 1
+        if used + cost > budget:
+            continue  # a shorter, lower-scored memory may still fit
+        chosen_relevant.append(m)
+        used += cost
+    chronological = lambda msgs: sorted(msgs, key=lambda m: m.get("timestamp", ""))
+    return chronological(chosen_recent), chronological(chosen_relevant)
+
+def build_prompt(history, current_message, token_budget=None):
+    """
+    Assemble the chat messages within `token_budget` (PROMPT_TOKEN_BUDGET)
+    input tokens: the static instructions, then one context message with
+    recent exchanges (oldest first, so consecutive turns share a prefix)
+    and relevant memories, then the incoming message. The incoming message
+    is never truncated; history is dropped to make room.
+    """
+    token_budget = token_budget or settings.PROMPT_TOKEN_BUDGET
+    fixed = (
+        count_tokens(SYSTEM_INSTRUCTION)
+        + count_tokens(current_message)
+        + count_tokens(RECENT_HEADER) + count_tokens(RELEVANT_HEADER)
+        + 3 * MESSAGE_OVERHEAD_TOKENS
+    )
+    recent_msgs, relevant_msgs = select_history(history, max(token_budget - fixed, 0))
+
+    prompt = [{"role": "system", "content": SYSTEM_INSTRUCTION}]
+    sections = []
+    if recent_msgs:
+        sections.append(RECENT_HEADER + "\n" + "\n".join(_format_recent(m) for m in recent_msgs))
+    if relevant_msgs:
+        sections.append(RELEVANT_HEADER + "\n" + "\n".join(_format_relevant(m) for m in relevant_msgs))
+    if sections:
+        prompt.append({"role": "system", "content": "\n".join(sections)})
+    prompt.append({"role": "user", "content": current_message})
+    return prompt
+
+def _estimate_tokens(prompt_messages) -> int:
+    """Prompt tokens plus the expected reply, for the gateway's TPM budget."""
+    prompt = sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in prompt_messages)
+    return prompt + settings.LLM_COMPLETION_TOKEN_ESTIMATE
+
+def _ensure_clients():
+    try:
+        get_llm_gateway()
+    except Exception as e:
+        logger.error(f"Failed to create OpenAI client: {e}")
+        raise HTTPException(status_code=500, detail=f"OpenAI client error: {e}")
 
     global wclient
     if wclient is None:
         try:
             wclient = get_weaviate_client()
         except RuntimeError as e:
-            logger.error(f"Weaviate client error: {e}")
-            raise HTTPException(status_code=500, detail=str(e))
+            # Still starting up: answer from the local memory index meanwhile
+            logger.warning(f"Weaviate client error: {e}")
 
-    recent_objs = await get_recent_messages(db, user.id, N=10)
-    recent_messages = [
-        {"text": obj.message, "my_message": obj.response, "timestamp": str(obj.created_at), "source": "recent"}
-        for obj in recent_objs
-    ]
+def _similarity(obj):
+    distance = getattr(getattr(obj, "metadata", None), "distance", None)
+    return 1.0 - distance if distance is not None else None
 
-    # Use text search for relevant messages
-    relevant_objs = await search_relevant_messages(wclient, message, top_k=10)
-    recent_texts = set(msg["text"] for msg in relevant_objs)
-    relevant_messages = [
-        {"text": obj.properties["text"], "timestamp": obj.properties.get("timestamp", ""), "source": "relevant"}
-        for obj in relevant_objs if obj.properties["text"] not in recent_texts
-    ]
-    logger.info(f"relevant message: {relevant_messages}")
+async def _fetch_with_timeout(coro, timeout, source, on_timeout=None):
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"{source} timed out after {timeout}s, continuing without it")
+        if on_timeout is not None:
+            await on_timeout()
+        return []
+
+async def _in_stage(name, coro):
+    # Timed inside the task, so a stage cut off by its timeout is still measured
+    with stage(name):
+        return await coro
+
+async def _search_documents(user_id, message: str):
+    if wclient is None or not settings.DOCUMENT_INDEXING_ENABLED:
+        return []
+    return await search_documents(wclient, user_id, message, top_k=settings.DOCUMENT_SEARCH_TOP_K)
 
+async def _retrieve_context(db, user, message: str):
+    """(recent chats, relevant memories, document chunks) for the prompt."""
+    _ensure_clients()
 
-    prompt_history = (
-        sorted(recent_messages, key=lambda x: x["timestamp"], reverse=True)
-        +
-        sorted(relevant_messages, key=lambda x: x["timestamp"], reverse=True)
+    # Postgres history and vector searches are independent; run them together
+    # and carry on without whichever source misses its deadline.
+    recent_objs, relevant_objs, document_objs = await asyncio.gather(
+        _fetch_with_timeout(
+            _in_stage("recent_history", get_recent_messages(db, user.id, N=10)),
+            settings.RECENT_HISTORY_TIMEOUT,
+            "Recent history fetch",
+            on_timeout=db.rollback
+        ),
+        _fetch_with_timeout(
+            _in_stage("vector_search", search_memories(wclient, user.id, message, top_k=10)),
+            settings.VECTOR_SEARCH_TIMEOUT,
+            "Vector search"
+        ),
+        _fetch_with_timeout(
+            _in_stage("document_search", _search_documents(user.id, message)),
+            settings.VECTOR_SEARCH_TIMEOUT,
+            "Document search"
+        ),
     )
+    return recent_objs, relevant_objs, document_objs
 
-    prompt_messages = build_prompt(prompt_history, message)
-    # logger.info(f"Prompt: {prompt_messages}")
+def _prepare_prompt(user, message: str, context):
+    recent_objs, relevant_objs, document_objs = context
+    with stage("prompt_build"):
+        prompt_messages = _build_prompt_from(recent_objs, relevant_objs, message, document_objs)
+    log_payload("Prompt context for user %s: %s", user.id, prompt_messages[1:-1])
+    return prompt_messages
 
-    try:
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=prompt_messages,
-            temperature=0.9,
-            timeout=10
-        )
-        response_text = response.choices[0].message.content
-    except Exception as e:
-        logger.error(f"OpenAI API error: {e}")
-        raise HTTPException(status_code=500, detail=f"OpenAI error: {e}")
+def _build_prompt_from(recent_objs, relevant_objs, message: str, document_objs=()):
+    recent_messages = [
+        {"text": obj.message, "my_message": obj.response, "timestamp": str(obj.created_at), "source": "recent"}
+        for obj in recent_objs
+    ]
+    relevant_messages = [
+        {
+            "text": obj.properties["text"],
+            "timestamp": obj.properties.get("timestamp", ""),
+            "score": _similarity(obj),
+            "source": "relevant"
+        }
+        for obj in relevant_objs
+    ]
+    # Document chunks compete with memories for the same budget, by score
+    document_messages = [
+        {
+            "text": f"[{obj.properties.get('filename', '')}] {obj.properties['filedetail']}",
+            "timestamp": obj.properties.get("timestamp", ""),
+            "score": _similarity(obj),
+            "source": "relevant"
+        }
+        for obj in document_objs
+    ]
+    return build_prompt(recent_messages + relevant_messages + document_messages, message)
 
+async def _save_exchange(db, user, message: str, response_text: str):
     try:
         chat = Chat(
             user_id=user.id,
             message=message,
             response=response_text,
-            media_ids=json.dumps([])
+            media_ids=[]
         )
+        # The memory is committed with the chat and written to Weaviate in the background
+        memory = new_outbox_entry(user.id, f"Other:{message}, me:{response_text}")
         db.add(chat)
-        await db.commit()
-        await db.refresh(chat)
+        db.add(memory)
+        with stage("db_commit"):
+            await db.commit()
+            await db.refresh(chat)
     except Exception as e:
         logger.error(f"Database error: {e}")
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
-    # Save response to Weaviate (no embedding needed)
-    await save_message_to_weaviate(wclient, user.id, f"Other:{message}, me:{response_text}")
+    await enqueue_memory(memory)
+    return chat
+
+def _prompt_fingerprint():
+    # Replies produced under different instructions, model or vector space are never reused
+    instructions = hashlib.sha1(SYSTEM_INSTRUCTION.encode()).hexdigest()
+    return f"{CHAT_MODEL}|{CHAT_TEMPERATURE}|{instructions}|{embedding_backend_id()}"
+
+def _context_fingerprint(context):
+    # The retrieved memories and documents the prompt is built from; they
+    # change once an exchange or document relevant to the message is stored
+    _, relevant_objs, document_objs = context
+    retrieved = sorted(
+        [obj.properties["text"] for obj in relevant_objs]
+        + [f"{obj.properties.get('filename', '')}|{obj.properties['filedetail']}" for obj in document_objs]
+    )
+    digest = hashlib.sha1("\n".join(retrieved).encode()).hexdigest()
+    return f"{_prompt_fingerprint()}|{digest}"
+
+async def _lookup_cached_response(user, message: str, context):
+    """
+    Returns (cached reply or None, probe). `probe` is passed to
+    _store_cached_response after a fresh completion; it is None when the
+    semantic cache is off or the message could not be embedded. A reply is
+    only reused while retrieval for the message finds the same memories and
+    documents; indexed or deleted documents also bump the context version.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return None, None
+    with stage("cache_lookup"):
+        vector = await embed_text(message)
+        if vector is None:
+            return None, None
+        context_key = cache.context_key(user.id, _context_fingerprint(context))
+        return cache.lookup(user.id, vector, context_key), (cache, vector, context_key)
+
+def _store_cached_response(probe, user, response_text: str):
+    # Keyed to the context looked up before the completion: a document
+    # indexed meanwhile bumped the version, so this reply won't be served
+    if probe is not None and response_text:
+        cache, vector, context_key = probe
+        cache.store(user.id, vector, response_text, context_key)
+
+async def process_chat_message(db, user, message: str):
+    context = await _retrieve_context(db, user, message)
+    cached, probe = await _lookup_cached_response(user, message, context)
+    if cached is not None:
+        await _save_exchange(db, user, message, cached)
+        return {
+            "type": "text",
+            "text": cached,
+            "media": None
+        }
+
+    prompt_messages = _prepare_prompt(user, message, context)
+
+    try:
+        with stage("llm"):
+            response = await get_llm_gateway().complete(
+                prompt_messages,
+                model=CHAT_MODEL,
+                estimated_tokens=_estimate_tokens(prompt_messages),
+                temperature=CHAT_TEMPERATURE
+            )
+        response_text = response.choices[0].message.content
+    except LLMOverloaded as e:
+        logger.warning(f"Chat completion not admitted: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Chat model is busy, try again shortly",
+            headers={"Retry-After": str(max(1, round(e.retry_after)))}
+        )
+    except Exception as e:
+        logger.error(f"OpenAI API error: {e}")
+        raise HTTPException(status_code=500, detail=f"OpenAI error: {e}")
+
+    await _save_exchange(db, user, message, response_text)
+    _store_cached_response(probe, user, response_text)
 
     return {
         "type": "text",
         "text": response_text,
         "media": None
-    }
\ No newline at end of file
+    }
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_chat_message(db, user, message: str):
+    """
+    Same pipeline as process_chat_message, but streams the completion.
+    Retrieval and client errors are raised here, before the response starts;
+    the returned async generator yields Server-Sent Events:
+    `token` for each content delta, then `done` (after the exchange is
+    persisted) or `error`. Closing the generator early (client disconnect)
+    closes the upstream OpenAI stream and skips persistence.
+    """
+    context = await _retrieve_context(db, user, message)
+    cached, probe = await _lookup_cached_response(user, message, context)
+    if cached is not None:
+        async def cached_stream():
+            chat = await _save_exchange(db, user, message, cached)
+            yield _sse_event("token", {"text": cached})
+            yield _sse_event("done", {"type": "text", "text": cached, "media": None, "chat_id": chat.id})
+        return cached_stream()
+
+    prompt_messages = _prepare_prompt(user, message, context)
+
+    async def event_stream():
+        started = time.perf_counter()
+        try:
+            stream = await get_llm_gateway().open_stream(
+                prompt_messages,
+                model=CHAT_MODEL,
+                estimated_tokens=_estimate_tokens(prompt_messages),
+                temperature=CHAT_TEMPERATURE
+            )
+        except LLMOverloaded as e:
+            logger.warning(f"Chat completion not admitted: {e}")
+            yield _sse_event("error", {"detail": "Chat model is busy, try again shortly"})
+            return
+        except Exception as e:
+            logger.error(f"OpenAI API error: {e}")
+            yield _sse_event("error", {"detail": f"OpenAI error: {e}"})
+            return
+
+        parts = []
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield _sse_event("token", {"text": delta})
+        except Exception as e:
+            logger.error(f"OpenAI stream error: {e}")
+            yield _sse_event("error", {"detail": f"OpenAI error: {e}"})
+            return
+        finally:
+            # Runs on normal completion as well as on cancellation / aclose()
+            await stream.close()
+
+        # Stream start to last token; a span can't follow a generator across yields
+        CHAT_STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_stream")
+        response_text = "".join(parts)
+        try:
+            chat = await _save_exchange(db, user, message, response_text)
+        except HTTPException as e:
+            yield _sse_event("error", {"detail": e.detail})
+            return
+        _store_cached_response(probe, user, response_text)
+        yield _sse_event("done", {
+            "type": "text",
+            "text": response_text,
+            "media": None,
+            "chat_id": chat.id
+        })
+
+    return event_stream()
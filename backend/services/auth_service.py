@@ -2,9 +2,94 @@ from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import jwt
 from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+from backend.models.user import User
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+import asyncio
+import threading
+import time
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt is deliberately slow (~100-300 ms) and releases the GIL, so hashing
+# runs on a small dedicated pool; its size caps concurrent hashes.
+def _new_bcrypt_executor():
+    return ThreadPoolExecutor(
+        max_workers=settings.BCRYPT_MAX_WORKERS,
+        thread_name_prefix="bcrypt"
+    )
+
+_bcrypt_executor = _new_bcrypt_executor()
+reset_after_fork(globals(), _bcrypt_executor=_new_bcrypt_executor)
+
+@dataclass(frozen=True)
+class Principal:
+    """The authenticated user as seen by request handlers."""
+    id: int
+    email: str
+    role: str
+    is_active: bool
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            id=user.id,
+            email=user.email,
+            role=str(user.role) if user.role is not None else "user",
+            is_active=bool(user.is_active)
+        )
+
+class PrincipalCache:
+    """
+    In-process TTL cache of resolved principals, keyed by token subject
+    (email). Committed changes to a User evict it in the process that made
+    them; other worker processes pick them up once their entry expires, so
+    AUTH_CACHE_TTL bounds how long a demoted or deactivated user keeps access.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, subject):
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is None:
+                return None
+            expires_at, principal = entry
+            if expires_at < time.monotonic():
+                del self._entries[subject]
+                return None
+            return principal
+
+    def put(self, subject, principal):
+        with self._lock:
+            if len(self._entries) >= self._max_size:
+                # Drop expired entries first, then the oldest ones
+                now = time.monotonic()
+                for key in [k for k, (exp, _) in self._entries.items() if exp < now]:
+                    del self._entries[key]
+                while len(self._entries) >= self._max_size:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[subject] = (time.monotonic() + self._ttl, principal)
+
+    def invalidate(self, subject):
+        with self._lock:
+            self._entries.pop(subject, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+principal_cache = PrincipalCache(ttl=settings.AUTH_CACHE_TTL, max_size=settings.AUTH_CACHE_MAX_SIZE)
+# The lock may have been held by another thread at fork time
+reset_after_fork(vars(principal_cache), _lock=threading.Lock, _entries=dict)
+
 class AuthService:
     @staticmethod
     def hash_password(password: str) -> str:
@@ -14,6 +99,25 @@ class AuthService:
     def verify_password(plain_password: str, hashed_password: str) -> bool:
         return pwd_context.verify(plain_password, hashed_password)
 
+    @staticmethod
+    async def hash_password_async(password: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_bcrypt_executor, pwd_context.hash, password)
+
+    @staticmethod
+    async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_bcrypt_executor, pwd_context.verify, plain_password, hashed_password)
+
+    @staticmethod
+    def invalidate_user(email: str):
+        """
+        Drop a cached principal. ORM updates and deletes of User rows do this
+        automatically once committed; call it after committing bulk
+        UPDATE/DELETE statements.
+        """
+        principal_cache.invalidate(email)
+
     @staticmethod
     def create_access_token(data: dict, expires_delta: timedelta = None, role: str = None):
         to_encode = data.copy()
@@ -30,4 +134,30 @@ class AuthService:
             payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
             return payload
         except Exception:
-            return None 
\ No newline at end of file
+            return None 
+
+# Flushed User changes are collected on the session and evicted on commit,
+# so a rolled-back change keeps the cached principal
+def _pending_invalidations(target) -> set:
+    return object_session(target).info.setdefault("principal_invalidations", set())
+
+@event.listens_for(User, "after_update")
+def _invalidate_on_update(mapper, connection, target):
+    state = inspect(target)
+    for attr in ("email", "role", "is_active", "hashed_password"):
+        history = state.attrs[attr].history
+        if history.has_changes():
+            _pending_invalidations(target).update(list(history.deleted or []) + [target.email])
+
+@event.listens_for(User, "after_delete")
+def _invalidate_on_delete(mapper, connection, target):
+    _pending_invalidations(target).add(target.email)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session):
+    for email in session.info.pop("principal_invalidations", ()):
+        principal_cache.invalidate(email)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_on_rollback(session):
+    session.info.pop("principal_invalidations", None)
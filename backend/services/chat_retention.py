@@ -0,0 +1,242 @@
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime, timezone
+from pathlib import Path
+from pydantic_core import to_json
+from sqlalchemy import text
+from backend.config import settings
+from backend.db import engine
+from backend.services.forksafe import reset_after_fork
+from backend.services.local_index import get_local_index
+from backend.services.weaviate_service import get_weaviate_client, prune_memories_before, run_in_weaviate_executor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Storage lifecycle for chats.
+#
+# On Postgres, `chats` is range-partitioned by month on created_at (see
+# migration 0003): chats_pYYYY_MM per month, plus chats_default for rows
+# outside every partition. This job keeps CHAT_PARTITION_PREMAKE_MONTHS of
+# partitions ready ahead of time and, when CHAT_RETENTION_MONTHS is set,
+# archives each month that fell out of retention to a gzip JSONL file in
+# CHAT_ARCHIVE_DIR, then detaches and drops that partition (no row-by-row
+# DELETE, so no vacuum debt) and deletes the matching memories from Weaviate
+# (active tenants now, cold ones before they next leave memory, see
+# weaviate_service) and from the local index (LOCAL_INDEX_DIR). Only one
+# worker process runs it at a time (advisory lock). The local index files
+# live on the host running the pass, so deployments spread over several
+# hosts need a shared LOCAL_INDEX_DIR or LOCAL_INDEX_MODE=off to honour
+# retention everywhere.
+# Rows already sitting in chats_default when their month's partition is
+# created are moved into the new partition.
+
+PARTITION_RE = re.compile(r"^chats_p(\d{4})_(\d{2})$")
+ARCHIVE_COLUMNS = "id, user_id, message, response, media_ids, created_at"
+_LOCK_KEY = 0x63686174  # pg_try_advisory_lock key, "chat"
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def month_of(ts: datetime) -> date:
+    return date(ts.year, ts.month, 1)
+
+def partition_name(month: date) -> str:
+    return f"chats_p{month.year}_{month.month:02d}"
+
+def partition_month(name: str):
+    match = PARTITION_RE.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+def partition_bounds(month: date) -> str:
+    """FOR VALUES clause of `month`'s partition, in UTC whatever the session TimeZone."""
+    end = add_months(month, 1)
+    return f"FROM (timestamptz '{month.isoformat()} 00:00:00+00') TO (timestamptz '{end.isoformat()} 00:00:00+00')"
+
+def retention_cutoff(now: datetime, months: int) -> date:
+    """First day of the oldest month still kept; whole months are kept or archived."""
+    return add_months(month_of(now), -months)
+
+def expired_partitions(names, cutoff: date):
+    """Monthly partitions lying entirely before `cutoff`, oldest first."""
+    months = sorted((partition_month(n), n) for n in names if partition_month(n) is not None)
+    return [name for month, name in months if add_months(month, 1) <= cutoff]
+
+async def is_partitioned(conn) -> bool:
+    relkind = await conn.scalar(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('chats')"))
+    return relkind == "p"
+
+async def ensure_chat_partitions(conn, now: datetime):
+    """
+    Create this month's and the next CHAT_PARTITION_PREMAKE_MONTHS partitions
+    if missing. Postgres refuses a new partition while chats_default holds
+    rows in its range, so those rows are moved into it before it is attached.
+    """
+    existing = set(await list_partitions(conn))
+    first = month_of(now)
+    for offset in range(settings.CHAT_PARTITION_PREMAKE_MONTHS + 1):
+        month = add_months(first, offset)
+        name = partition_name(month)
+        if name in existing:
+            continue
+        end = add_months(month, 1)
+        bounds = partition_bounds(month)
+        params = {
+            "start": datetime(month.year, month.month, 1, tzinfo=timezone.utc),
+            "end": datetime(end.year, end.month, 1, tzinfo=timezone.utc)
+        }
+        stray = await conn.scalar(text(
+            "SELECT EXISTS (SELECT 1 FROM chats_default WHERE created_at >= :start AND created_at < :end)"
+        ), params)
+        if not stray:
+            await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF chats FOR VALUES {bounds}"))
+            continue
+        await conn.execute(text(f"CREATE TABLE {name} (LIKE chats INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        moved = await conn.execute(text(
+            f"WITH moved AS (DELETE FROM chats_default WHERE created_at >= :start AND created_at < :end "
+            f"RETURNING *) INSERT INTO {name} SELECT * FROM moved"
+        ), params)
+        await conn.execute(text(f"ALTER TABLE chats ATTACH PARTITION {name} FOR VALUES {bounds}"))
+        logger.info(f"Moved {moved.rowcount} chats from chats_default into the new partition {name}")
+
+async def list_partitions(conn):
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('chats')"
+    ))
+    return [row[0] for row in result]
+
+def _close_archive(fh, tmp: Path, path: Path):
+    """Flush and close the gzip stream, then give it its final name; it only appears once complete."""
+    with fh:
+        fh.flush()
+        os.fsync(fh.fileno())
+    tmp.replace(path)
+
+async def archive_query(conn, sql: str, path: Path, params=None) -> int:
+    """Stream the rows of `sql` into a gzip JSONL archive at `path`. Returns the row count."""
+    result = await conn.stream(
+        text(sql).execution_options(yield_per=settings.EXPORT_BATCH_SIZE), params or {}
+    )
+    tmp = path.with_name(path.name + ".tmp")
+    fh = await asyncio.to_thread(gzip.open, tmp, "wb")
+    rows = 0
+    try:
+        # One batch in memory at a time; compression runs off the event loop
+        async for partition in result.partitions():
+            await asyncio.to_thread(fh.write, b"".join(to_json(dict(row._mapping)) + b"\n" for row in partition))
+            rows += len(partition)
+        await asyncio.to_thread(_close_archive, fh, tmp, path)
+    except BaseException:
+        fh.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    return rows
+
+async def _archive_partition(conn, name: str, archive_dir: Path) -> int:
+    rows = await archive_query(
+        conn, f"SELECT {ARCHIVE_COLUMNS} FROM {name} ORDER BY created_at, id", archive_dir / f"{name}.jsonl.gz"
+    )
+    await conn.execute(text(f"ALTER TABLE chats DETACH PARTITION {name}"))
+    await conn.execute(text(f"DROP TABLE {name}"))
+    await conn.commit()
+    return rows
+
+async def _archive_default_partition(conn, cutoff: date, archive_dir: Path) -> int:
+    """Old rows that landed in chats_default (before the first monthly partition)."""
+    params = {"cutoff": datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc)}
+    count = await conn.scalar(text("SELECT count(*) FROM chats_default WHERE created_at < :cutoff"), params)
+    if not count:
+        return 0
+    path = archive_dir / f"chats_default_before_{cutoff.year}_{cutoff.month:02d}.jsonl.gz"
+    rows = await archive_query(
+        conn, f"SELECT {ARCHIVE_COLUMNS} FROM chats_default WHERE created_at < :cutoff ORDER BY created_at, id",
+        path, params
+    )
+    await conn.execute(text("DELETE FROM chats_default WHERE created_at < :cutoff"), params)
+    await conn.commit()
+    return rows
+
+async def _prune_weaviate(cutoff: date) -> int:
+    try:
+        wclient = get_weaviate_client()
+    except RuntimeError:
+        logger.warning("Weaviate not connected, memory pruning waits for the next retention run")
+        return 0
+    moment = datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc)
+    return await run_in_weaviate_executor(prune_memories_before, wclient, moment)
+
+async def _prune_local_index(cutoff: date) -> int:
+    index = get_local_index()
+    if index is None:
+        return 0
+    return await asyncio.to_thread(index.prune_before, datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc))
+
+async def run_retention(now: datetime = None) -> dict:
+    """
+    One maintenance pass: premake partitions, then archive and drop what is
+    past retention. Returns a summary; does nothing outside Postgres or when
+    another worker holds the lock.
+    """
+    now = now or datetime.now(timezone.utc)
+    summary = {"archived_partitions": [], "archived_rows": 0, "pruned_memories": 0}
+    if engine.dialect.name != "postgresql":
+        return summary
+    async with engine.connect() as conn:
+        if not await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": _LOCK_KEY}):
+            return summary
+        try:
+            if not await is_partitioned(conn):
+                logger.warning("chats is not partitioned yet, run the 0003 migration to enable retention")
+                return summary
+            await ensure_chat_partitions(conn, now)
+            await conn.commit()
+            if settings.CHAT_RETENTION_MONTHS <= 0:
+                return summary
+            cutoff = retention_cutoff(now, settings.CHAT_RETENTION_MONTHS)
+            archive_dir = Path(settings.CHAT_ARCHIVE_DIR)
+            archive_dir.mkdir(parents=True, exist_ok=True)
+            for name in expired_partitions(await list_partitions(conn), cutoff):
+                rows = await _archive_partition(conn, name, archive_dir)
+                summary["archived_partitions"].append(name)
+                summary["archived_rows"] += rows
+                logger.info(f"Archived {rows} chats from {name} and dropped the partition")
+            summary["archived_rows"] += await _archive_default_partition(conn, cutoff, archive_dir)
+            summary["pruned_memories"] = await _prune_weaviate(cutoff) + await _prune_local_index(cutoff)
+            return summary
+        finally:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY})
+            await conn.commit()
+
+async def _retention_worker():
+    while True:
+        try:
+            summary = await run_retention()
+            if summary["archived_rows"] or summary["pruned_memories"]:
+                logger.info(f"Chat retention: {summary}")
+        except Exception as e:
+            logger.warning(f"Chat retention error: {e}")
+        await asyncio.sleep(settings.CHAT_RETENTION_INTERVAL)
+
+_retention_task = None
+reset_after_fork(globals(), _retention_task=None)
+
+def start_retention_worker():
+    global _retention_task
+    if _retention_task is None:
+        _retention_task = asyncio.create_task(_retention_worker())
+
+async def stop_retention_worker():
+    global _retention_task
+    if _retention_task is not None:
+        _retention_task.cancel()
+        await asyncio.gather(_retention_task, return_exceptions=True)
+        _retention_task = None
+
+if __name__ == "__main__":
+    print(asyncio.run(run_retention()))
@@ -0,0 +1,357 @@
+import asyncio
+import hashlib
+import html
+import io
+import logging
+import multiprocessing
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+from backend.services.media_store import hash_upload
+from backend.services.metrics import stage
+from backend.services.processes import available_cpus, process_gone
+from backend.services.response_cache import get_response_cache
+from backend.services.weaviate_service import (
+    delete_document_chunks,
+    document_indexed,
+    get_weaviate_client,
+    replace_document_chunks,
+    run_in_weaviate_executor
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Indexing of uploaded documents for retrieval.
+#
+# upload_media hashes each upload with stage_upload(), which copies PDF / text
+# uploads to DOCUMENT_STAGING_DIR in the same pass (the UploadFile is gone once
+# the request ends), and queues the staged copies with submit_upload() once
+# the Media rows exist; completed resumable uploads are queued with
+# submit_stored_upload() and downloaded from Drive by the worker.
+# DOCUMENT_INDEX_CONCURRENCY workers then skip
+# files whose content hash the user already has in FileInfo, extract and
+# chunk the text in a process pool (PDF parsing is CPU-bound and would hold
+# the GIL), and batch-insert the chunks. A changed file replaces the chunks
+# of the previous upload with the same name. process_chat_message searches
+# the chunks next to chat memories. `python -m backend.services.document_service`
+# indexes media that is already on Drive.
+
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".markdown", ".rst", ".csv", ".tsv", ".json", ".xml", ".yaml", ".yml",
+    ".log", ".html", ".htm",
+}
+_TAG_RE = re.compile(r"<(script|style)\b.*?</\1>|<[^>]+>", re.IGNORECASE | re.DOTALL)
+
+@dataclass
+class DocumentJob:
+    user_id: int
+    media_id: int
+    filename: str
+    content_type: str
+    path: Path
+    content_hash: str
+    gdrive_id: str = None  # Set when the file is still on Drive only; the worker downloads it to `path`
+
+def _is_pdf(filename, content_type) -> bool:
+    return content_type == "application/pdf" or Path(filename or "").suffix.lower() == ".pdf"
+
+def is_extractable(filename, content_type) -> bool:
+    return (
+        _is_pdf(filename, content_type)
+        or (content_type or "").startswith("text/")
+        or Path(filename or "").suffix.lower() in TEXT_EXTENSIONS
+    )
+
+def extract_text(path, filename, content_type) -> str:
+    if _is_pdf(filename, content_type):
+        from PyPDF2 import PdfReader
+        reader = PdfReader(str(path))
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+    text = Path(path).read_bytes().decode("utf-8-sig", errors="replace")
+    if Path(filename or "").suffix.lower() in (".html", ".htm") or content_type == "text/html":
+        text = html.unescape(_TAG_RE.sub(" ", text))
+    return text
+
+def chunk_text(text: str, size: int, overlap: int):
+    """
+    Split on whitespace into chunks of at most `size` characters (a single
+    longer word is cut), each starting with about `overlap` characters from
+    the end of the previous one.
+    """
+    words = []
+    for word in text.split():
+        words.extend(word[i:i + size] for i in range(0, len(word), size))
+    chunks, current, length = [], [], 0
+    for word in words:
+        if current and length + 1 + len(word) > size:
+            chunks.append(" ".join(current))
+            kept, kept_length = [], 0
+            for previous in reversed(current):
+                if kept_length + len(previous) + 1 > overlap:
+                    break
+                kept.insert(0, previous)
+                kept_length += len(previous) + 1
+            current, length = kept, max(kept_length - 1, 0)
+        length += len(word) + (1 if current else 0)
+        current.append(word)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def extract_chunks(path, filename, content_type, size, overlap):
+    """Process pool entry point."""
+    return chunk_text(extract_text(path, filename, content_type), size, overlap)
+
+def stage_file(fd, dest: Path) -> str:
+    """Copy a file object to `dest` from the start and rewind it; returns its sha256 hex digest."""
+    digest = hashlib.sha256()
+    fd.seek(0)
+    with open(dest, "wb") as out:
+        while True:
+            block = fd.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+            out.write(block)
+    fd.seek(0)
+    return digest.hexdigest()
+
+_pool = None
+_queue = None
+_workers = []
+reset_after_fork(globals(), _pool=None, _queue=None, _workers=list)
+
+def _staging_path() -> Path:
+    return Path(settings.DOCUMENT_STAGING_DIR) / f"{os.getpid()}-{uuid.uuid4().hex}"
+
+def _clean_staging_dir():
+    """Remove files staged by processes that exited before indexing them."""
+    root = Path(settings.DOCUMENT_STAGING_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    for path in root.iterdir():
+        if process_gone(path.name.split("-", 1)[0]):
+            path.unlink(missing_ok=True)
+
+def is_running() -> bool:
+    return _queue is not None
+
+async def stage_upload(file):
+    """
+    Hash an upload, copying it to the staging directory in the same pass when
+    it will be indexed: a document, not too large, with the indexer running.
+    Returns (content_hash, staged path or None); the file is rewound.
+    """
+    if _queue is None or not is_extractable(file.filename, file.content_type):
+        return await hash_upload(file), None
+    if file.size is not None and file.size > settings.DOCUMENT_MAX_BYTES:
+        logger.info(f"Not indexing {file.filename}: larger than DOCUMENT_MAX_BYTES")
+        return await hash_upload(file), None
+    path = _staging_path()
+    return await asyncio.to_thread(stage_file, file.file, path), path
+
+def discard_staged(paths):
+    """Remove copies made by stage_upload for uploads that will not be indexed."""
+    for path in paths:
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+async def submit_upload(user_id, media_id, file, content_hash, path) -> bool:
+    """
+    Queue an upload staged by stage_upload for indexing. Returns False when
+    it was not staged, or the indexer stopped or is full.
+    """
+    if path is None:
+        return False
+    if _queue is None:
+        path.unlink(missing_ok=True)
+        return False
+    job = DocumentJob(user_id, media_id, file.filename, file.content_type, path, content_hash)
+    try:
+        _queue.put_nowait(job)
+        return True
+    except asyncio.QueueFull:
+        logger.warning(f"Document queue full, {file.filename} is not indexed")
+        path.unlink(missing_ok=True)
+        return False
+
+async def submit_stored_upload(user_id, media_id, filename, content_type, file_size, gdrive_id, content_hash) -> bool:
+    """
+    Queue a file that only exists on Drive (a completed resumable upload) for
+    indexing; the worker downloads it. Returns False like submit_upload.
+    """
+    if _queue is None or not is_extractable(filename, content_type):
+        return False
+    if file_size > settings.DOCUMENT_MAX_BYTES:
+        logger.info(f"Not indexing {filename}: larger than DOCUMENT_MAX_BYTES")
+        return False
+    job = DocumentJob(user_id, media_id, filename, content_type, _staging_path(), content_hash, gdrive_id)
+    try:
+        _queue.put_nowait(job)
+        return True
+    except asyncio.QueueFull:
+        logger.warning(f"Document queue full, {filename} is not indexed")
+        return False
+
+async def _download(job: DocumentJob):
+    from backend.services.media_service import MediaService
+    data = await MediaService.download_from_gdrive(job.gdrive_id)
+    if data is None:
+        raise RuntimeError(f"could not download {job.gdrive_id} from Drive")
+    job.content_hash = await asyncio.to_thread(stage_file, io.BytesIO(data), job.path)
+
+async def index_document(job: DocumentJob) -> str:
+    """Returns "unchanged", "empty" or "indexed"."""
+    wclient = get_weaviate_client()
+    if job.content_hash and await run_in_weaviate_executor(document_indexed, wclient, job.user_id, job.content_hash):
+        return "unchanged"
+    if job.gdrive_id is not None:
+        with stage("document_download"):
+            await _download(job)
+    with stage("document_extract"):
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(
+            _pool, extract_chunks, str(job.path), job.filename, job.content_type,
+            settings.DOCUMENT_CHUNK_SIZE, settings.DOCUMENT_CHUNK_OVERLAP
+        )
+    if not chunks:
+        return "empty"
+    with stage("document_insert"):
+        await run_in_weaviate_executor(
+            replace_document_chunks, wclient, job.user_id, job.filename, job.media_id, job.content_hash, chunks
+        )
+    # Cached replies were produced without this document
+    cache = get_response_cache()
+    if cache is not None:
+        cache.bump_context(job.user_id)
+    return "indexed"
+
+async def forget_media(user_id, media_id, content_hash=None):
+    """
+    Remove a deleted media item's chunks so searches stop returning them.
+    Chunks are indexed once per user and content (whichever upload came
+    first), so they are deleted by `content_hash` and callers only call this
+    once no media of the user has that content left. Media without a hash
+    are matched by id.
+    """
+    try:
+        wclient = get_weaviate_client()
+    except RuntimeError:
+        logger.warning(f"Weaviate not connected, chunks of media {media_id} stay indexed")
+        return
+    match = {"content_hash": content_hash} if content_hash else {"media_id": media_id}
+    try:
+        removed = await run_in_weaviate_executor(delete_document_chunks, wclient, user_id, **match)
+    except Exception as e:
+        logger.warning(f"Could not delete the chunks of media {media_id}: {e}")
+        return
+    if removed:
+        # Cached replies may quote the deleted document
+        cache = get_response_cache()
+        if cache is not None:
+            cache.bump_context(user_id)
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        try:
+            status = await index_document(job)
+            logger.info(f"Document {job.filename} for user {job.user_id}: {status}")
+        except Exception as e:
+            logger.warning(f"Document indexing error for {job.filename}: {e}")
+        finally:
+            job.path.unlink(missing_ok=True)
+            _queue.task_done()
+
+def _extract_worker_count() -> int:
+    # Every server worker runs its own pool; together they fit the container's CPUs
+    return settings.DOCUMENT_EXTRACT_WORKERS or max(1, available_cpus() // max(1, settings.SERVER_PROCESSES))
+
+def _new_pool():
+    # spawn: a forked child would inherit this process's event loop and client threads
+    return ProcessPoolExecutor(max_workers=_extract_worker_count(), mp_context=multiprocessing.get_context("spawn"))
+
+def start_document_indexer():
+    global _pool, _queue
+    if not settings.DOCUMENT_INDEXING_ENABLED or _queue is not None:
+        return
+    _clean_staging_dir()
+    _pool = _new_pool()
+    _queue = asyncio.Queue(maxsize=settings.DOCUMENT_QUEUE_SIZE)
+    _workers.extend(asyncio.create_task(_worker()) for _ in range(settings.DOCUMENT_INDEX_CONCURRENCY))
+
+async def stop_document_indexer():
+    """Drop what is still queued (re-run the backfill to index it) and stop the pool."""
+    global _pool, _queue
+    if _queue is None:
+        return
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    while not _queue.empty():
+        _queue.get_nowait().path.unlink(missing_ok=True)
+    _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = _queue = None
+
+async def backfill():
+    """Index every document already stored on Drive. Returns counts by status."""
+    from sqlalchemy import select
+    from backend.db import AsyncSessionLocal
+    from backend.models.media import Media
+    from backend.services.media_service import MediaService
+    global _pool
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(Media.id, Media.user_id, Media.filename, Media.filetype, Media.gdrive_id, Media.file_size)
+        )
+        rows = [
+            m for m in result.all()
+            if is_extractable(m.filename, m.filetype) and (m.file_size or 0) <= settings.DOCUMENT_MAX_BYTES
+        ]
+    _clean_staging_dir()
+    _pool = _new_pool()
+    semaphore = asyncio.Semaphore(settings.DOCUMENT_INDEX_CONCURRENCY)
+    counts = {}
+
+    async def index(m):
+        async with semaphore:
+            path = _staging_path()
+            try:
+                data = await MediaService.download_from_gdrive(m.gdrive_id)
+                if data is None:
+                    status = "failed"
+                else:
+                    content_hash = await asyncio.to_thread(stage_file, io.BytesIO(data), path)
+                    status = await index_document(
+                        DocumentJob(m.user_id, m.id, m.filename, m.filetype, path, content_hash)
+                    )
+            except Exception as e:
+                logger.warning(f"Document indexing error for {m.filename}: {e}")
+                status = "failed"
+            finally:
+                path.unlink(missing_ok=True)
+            counts[status] = counts.get(status, 0) + 1
+
+    try:
+        await asyncio.gather(*(index(m) for m in rows))
+    finally:
+        _pool.shutdown()
+        _pool = None
+    return counts
+
+def main():
+    from backend.services.weaviate_service import setup_schema, shutdown
+    setup_schema()
+    try:
+        logger.info(f"Document backfill: {asyncio.run(backfill())}")
+    finally:
+        shutdown()
+
+if __name__ == "__main__":
+    main()
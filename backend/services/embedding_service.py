@@ -0,0 +1,69 @@
+import hashlib
+import logging
+import re
+import httpx
+import numpy as np
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_http = None
+reset_after_fork(globals(), _http=None)
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def embed_local(text: str, dim: int = None) -> np.ndarray:
+    """
+    Dependency-free embedding: hashed bag of words plus character trigrams,
+    L2-normalized. Catches near-duplicates and shared vocabulary, not
+    paraphrases; used when no vectorizer service is configured
+    (EMBEDDING_BACKEND="local").
+    """
+    dim = dim or settings.LOCAL_EMBEDDING_DIM
+    vector = np.zeros(dim, dtype=np.float32)
+    words = _TOKEN_RE.findall(text.lower())
+    features = words + [f"#{w[i:i + 3]}" for w in words for i in range(max(len(w) - 2, 1))]
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[index] += sign
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+async def _embed_transformers(text: str) -> np.ndarray:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(base_url=settings.T2V_TRANSFORMERS_URL, timeout=settings.EMBEDDING_TIMEOUT)
+    resp = await _http.post("/vectors", json={"text": text})
+    resp.raise_for_status()
+    vector = np.asarray(resp.json()["vector"], dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+async def embed_text(text: str):
+    """
+    Unit-length embedding from the configured backend (EMBEDDING_BACKEND):
+    "transformers" calls the same t2v-transformers service Weaviate uses,
+    "local" uses embed_local. Returns None if the vectorizer is unavailable.
+    """
+    if settings.EMBEDDING_BACKEND == "local":
+        return embed_local(text)
+    try:
+        return await _embed_transformers(text)
+    except Exception as e:
+        logger.warning(f"Embedding service error: {e}")
+        return None
+
+def embedding_backend_id() -> str:
+    """Identifies the vector space, so vectors from different backends are never compared."""
+    if settings.EMBEDDING_BACKEND == "local":
+        return f"local:{settings.LOCAL_EMBEDDING_DIM}"
+    return f"transformers:{settings.T2V_TRANSFORMERS_URL}"
+
+async def close_embedding_client():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
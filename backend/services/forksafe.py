@@ -0,0 +1,17 @@
+import os
+
+def reset_after_fork(module_globals: dict, **values):
+    """
+    Reset module-level singletons in a forked child process, so a worker
+    forked from a parent that already used them (e.g. gunicorn --preload)
+    builds its own clients, pools and locks instead of sharing sockets or
+    inheriting dead executor threads. Callable values are factories, called
+    in the child; anything else is assigned as is.
+    """
+    def reset():
+        module_globals.update({
+            name: value() if callable(value) else value
+            for name, value in values.items()
+        })
+
+    os.register_at_fork(after_in_child=reset)
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCOPES = ["https://www.googleapis.com/auth/drive"]
+
+class DriveClient:
+    """
+    Long-lived Google Drive client.
+
+    Credentials and the discovery document are loaded once per process.
+    googleapiclient/httplib2 objects are not thread-safe, so each executor
+    thread builds and keeps its own service object; all blocking calls go
+    through the bounded executor via `run()`. The Google client libraries
+    are imported on first use, off the startup path.
+    """
+
+    def __init__(self, creds_path: str, max_workers: int, refresh_margin: int):
+        self._creds_path = creds_path
+        self._refresh_margin = timedelta(seconds=refresh_margin)
+        self._creds = None
+        self._creds_lock = threading.Lock()
+        self._discovery_doc = None
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gdrive")
+
+    def credentials(self):
+        """Service-account credentials, refreshed ahead of expiry."""
+        from google.auth.transport.requests import Request
+        from google.oauth2 import service_account
+        with self._creds_lock:
+            if self._creds is None:
+                self._creds = service_account.Credentials.from_service_account_file(
+                    self._creds_path, scopes=SCOPES
+                )
+            expiry = self._creds.expiry  # naive UTC, None until first refresh
+            if not self._creds.valid or expiry is None or expiry - datetime.utcnow() < self._refresh_margin:
+                self._creds.refresh(Request())
+            return self._creds
+
+    def _discovery(self):
+        from googleapiclient.discovery import build
+        from googleapiclient.discovery_cache import get_static_doc
+        if self._discovery_doc is None:
+            doc = get_static_doc("drive", "v3")
+            if doc is None:
+                # Older client libraries without bundled documents: fetch once
+                doc = build("drive", "v3", credentials=self.credentials())._rootDesc
+            self._discovery_doc = doc
+        return self._discovery_doc
+
+    def service(self):
+        """The Drive service owned by the calling thread."""
+        service = getattr(self._local, "service", None)
+        if service is None:
+            import httplib2
+            import google_auth_httplib2
+            from googleapiclient.discovery import build_from_document
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials(), http=httplib2.Http())
+            service = build_from_document(self._discovery(), http=http)
+            self._local.service = service
+        return service
+
+    def _call(self, fn):
+        self.credentials()  # proactive refresh before the request goes out
+        return fn(self.service())
+
+    async def token(self) -> str:
+        """A current access token, for Drive requests made without googleapiclient."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self.credentials().token)
+
+    async def run(self, fn):
+        """Run `fn(service)` on a Drive worker thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+_drive_client = None
+_drive_client_lock = threading.Lock()
+reset_after_fork(globals(), _drive_client=None, _drive_client_lock=threading.Lock)
+
+def get_drive_client() -> DriveClient:
+    global _drive_client
+    with _drive_client_lock:
+        if _drive_client is None:
+            _drive_client = DriveClient(
+                settings.google_creds_path,
+                max_workers=settings.GDRIVE_MAX_WORKERS,
+                refresh_margin=settings.GDRIVE_TOKEN_REFRESH_MARGIN
+            )
+        return _drive_client
+
+def close_drive_client():
+    global _drive_client
+    with _drive_client_lock:
+        if _drive_client is not None:
+            _drive_client.close()
+            _drive_client = None
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class IdempotencyInProgress(Exception):
+    """Another process is still computing the result for this key."""
+
+def webhook_idempotency_key(header_key, email, message, message_id=None):
+    """
+    Returns (key, ttl). An explicit Idempotency-Key header or a message id
+    identifies a delivery, so its result is kept for IDEMPOTENCY_TTL. Without
+    either, only identical content from the same sender is recognised, and
+    for the much shorter IDEMPOTENCY_CONTENT_TTL (long enough to cover n8n's
+    retries) so a user repeating "thanks" later still gets an answer.
+    """
+    if header_key or message_id:
+        parts, ttl = ["id", email, header_key or "", message_id or ""], settings.IDEMPOTENCY_TTL
+    else:
+        parts, ttl = ["content", email, message], settings.IDEMPOTENCY_CONTENT_TTL
+    digest = hashlib.sha256("\x1f".join(str(p) for p in parts).encode()).hexdigest()
+    return f"n8n:{digest}", ttl
+
+class MemoryResultStore:
+    """Per-process TTL store; single-flight within the process is all the locking it needs."""
+
+    def __init__(self, max_entries: int):
+        self._entries = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._max_entries = max_entries
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        return value
+
+    async def set(self, key, value, ttl):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def acquire(self, key) -> bool:
+        return True
+
+    async def release(self, key):
+        pass
+
+    async def close(self):
+        pass
+
+class RedisResultStore:
+    """Shared store, so duplicates delivered to different processes are coalesced too."""
+
+    def __init__(self, url: str, lock_timeout: float):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._lock_timeout = lock_timeout
+
+    async def get(self, key):
+        raw = await self._redis.get(f"idem:{key}")
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key, value, ttl):
+        await self._redis.set(f"idem:{key}", json.dumps(value), ex=int(ttl))
+
+    async def acquire(self, key) -> bool:
+        return bool(await self._redis.set(f"idem:{key}:lock", "1", nx=True, ex=int(self._lock_timeout)))
+
+    async def release(self, key):
+        await self._redis.delete(f"idem:{key}:lock")
+
+    async def close(self):
+        await self._redis.aclose()
+
+class IdempotencyGuard:
+    """
+    Runs a coroutine function at most once per key. Concurrent callers with
+    the same key share one in-flight computation; later callers get the
+    stored result until it expires. Failures are not stored, so a retry
+    after an error computes again. Results must be JSON-serializable.
+    """
+
+    def __init__(self, store, wait_timeout: float, poll_interval: float = 0.1):
+        self._store = store
+        self._wait_timeout = wait_timeout
+        self._poll_interval = poll_interval
+        self._inflight = {}  # key -> Future resolving to (result, replayed)
+
+    async def _wait_for_other_process(self, key):
+        deadline = time.monotonic() + self._wait_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self._poll_interval)
+            result = await self._store.get(key)
+            if result is not None:
+                return result
+            if await self._store.acquire(key):
+                # The other process gave up without a result; it's ours now
+                await self._store.release(key)
+                return None
+        raise IdempotencyInProgress(key)
+
+    async def _lead(self, key, fn, ttl):
+        while True:
+            result = await self._store.get(key)
+            if result is not None:
+                return result, True
+            if await self._store.acquire(key):
+                break
+            result = await self._wait_for_other_process(key)
+            if result is not None:
+                return result, True
+        try:
+            result = await fn()
+            await self._store.set(key, result, ttl)
+            return result, False
+        finally:
+            await self._store.release(key)
+
+    async def run(self, key, fn, ttl):
+        """Returns (result, replayed)."""
+        inflight = self._inflight.get(key)
+        joined = inflight is not None
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._lead(key, fn, ttl))
+            self._inflight[key] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so a caller going away doesn't cancel the shared computation
+        result, replayed = await asyncio.shield(inflight)
+        return result, replayed or joined
+
+_guard = None
+reset_after_fork(globals(), _guard=None)
+
+def get_idempotency_guard() -> IdempotencyGuard:
+    global _guard
+    if _guard is None:
+        if settings.IDEMPOTENCY_REDIS_URL:
+            store = RedisResultStore(settings.IDEMPOTENCY_REDIS_URL, lock_timeout=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+        else:
+            store = MemoryResultStore(max_entries=settings.IDEMPOTENCY_MAX_ENTRIES)
+        _guard = IdempotencyGuard(store, wait_timeout=settings.IDEMPOTENCY_WAIT_TIMEOUT)
+    return _guard
+
+async def close_idempotency_store():
+    global _guard
+    if _guard is not None:
+        await _guard._store.close()
+        _guard = None
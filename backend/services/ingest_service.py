@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import random
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update, delete
+from backend.config import settings
+from backend.db import AsyncSessionLocal
+from backend.services.embedding_service import embed_text
+from backend.models.memory_outbox import MemoryOutbox
+from backend.services.local_index import get_local_index
+from backend.services.metrics import stage
+from backend.services.weaviate_service import chat_collection, get_weaviate_client, run_in_weaviate_executor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Write-behind pipeline for chat memories.
+#
+# The chat request commits a MemoryOutbox row in the same transaction as its
+# Chat row and hands the memory to a bounded in-process queue. A single worker
+# drains the queue into Weaviate with one insert_many per user tenant,
+# flushing on batch size or age, and deletes outbox rows once Weaviate has
+# accepted them. Anything that never makes it (full queue, exhausted retries,
+# crash) stays in the outbox and is re-queued by the periodic sweep and on
+# the next startup. With several worker processes the sweep only takes rows
+# older than MEMORY_OUTBOX_MIN_AGE, and each memory is written under a UUID
+# derived from its outbox id, so a row picked up twice is overwritten rather
+# than duplicated.
+
+@dataclass
+class PendingMemory:
+    outbox_id: int
+    user_id: int
+    text: str
+    timestamp: datetime
+
+_queue = None
+_worker_task = None
+_sweep_task = None
+_pending_ids = set()  # Outbox ids currently queued or being written
+
+def _format_timestamp(ts: datetime) -> str:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+def memory_uuid(outbox_id) -> uuid.UUID:
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"memory-outbox/{outbox_id}")
+
+def new_outbox_entry(user_id, text) -> MemoryOutbox:
+    return MemoryOutbox(user_id=user_id, text=text, timestamp=datetime.now(timezone.utc))
+
+async def enqueue_memory(entry: MemoryOutbox) -> bool:
+    """
+    Queue a committed outbox row for ingestion. Waits up to
+    MEMORY_ENQUEUE_TIMEOUT for space (backpressure); returns False if the
+    worker is not running or the queue stayed full, in which case the row is
+    picked up later by the outbox sweep.
+    """
+    if _queue is None or entry.id in _pending_ids:
+        return False
+    item = PendingMemory(entry.id, entry.user_id, entry.text, entry.timestamp)
+    _pending_ids.add(item.outbox_id)
+    try:
+        await asyncio.wait_for(_queue.put(item), settings.MEMORY_ENQUEUE_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        _pending_ids.discard(item.outbox_id)
+        logger.warning("Memory ingest queue full, leaving message in outbox")
+        return False
+
+async def _insert_tenant_batch(wclient, user_id, items):
+    from weaviate.classes.data import DataObject
+    objects = [
+        DataObject(
+            properties={
+                "text": item.text,
+                "user_id": str(item.user_id),
+                "timestamp": _format_timestamp(item.timestamp),
+            },
+            uuid=memory_uuid(item.outbox_id),
+        )
+        for item in items
+    ]
+    try:
+        with stage("weaviate_insert"):
+            result = await run_in_weaviate_executor(chat_collection(wclient, user_id).data.insert_many, objects)
+    except Exception as e:
+        logger.warning(f"Weaviate batch insert error for user {user_id}: {e}")
+        return {item.outbox_id for item in items}
+    for index, error in result.errors.items():
+        logger.warning(f"Weaviate rejected memory {items[index].outbox_id}: {error.message}")
+    return {items[index].outbox_id for index in result.errors}
+
+async def _insert_batch(batch):
+    """Returns the outbox ids Weaviate rejected."""
+    wclient = get_weaviate_client()
+    by_user = defaultdict(list)
+    for item in batch:
+        by_user[item.user_id].append(item)
+    # One insert_many per tenant; a failing tenant doesn't fail the others
+    results = await asyncio.gather(*(
+        _insert_tenant_batch(wclient, user_id, items) for user_id, items in by_user.items()
+    ))
+    return set().union(*results)
+
+async def _write_batch(batch):
+    remaining = list(batch)
+    for attempt in range(settings.MEMORY_INGEST_MAX_RETRIES + 1):
+        try:
+            failed_ids = await _insert_batch(remaining)
+        except Exception as e:
+            logger.warning(f"Weaviate batch insert error (attempt {attempt + 1}): {e}")
+            failed_ids = {item.outbox_id for item in remaining}
+        done_ids = [item.outbox_id for item in remaining if item.outbox_id not in failed_ids]
+        if done_ids:
+            async with AsyncSessionLocal() as session:
+                await session.execute(delete(MemoryOutbox).where(MemoryOutbox.id.in_(done_ids)))
+                await session.commit()
+            _pending_ids.difference_update(done_ids)
+        remaining = [item for item in remaining if item.outbox_id in failed_ids]
+        if not remaining:
+            return
+        if attempt < settings.MEMORY_INGEST_MAX_RETRIES:
+            delay = settings.MEMORY_INGEST_RETRY_BASE_DELAY * (2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+    failed_ids = [item.outbox_id for item in remaining]
+    logger.error(f"Giving up on {len(failed_ids)} memories for now, they stay in the outbox")
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(MemoryOutbox)
+            .where(MemoryOutbox.id.in_(failed_ids))
+            .values(attempts=MemoryOutbox.attempts + 1)
+        )
+        await session.commit()
+    _pending_ids.difference_update(failed_ids)
+
+def _index_locally(index, batch, vectors):
+    by_user = defaultdict(lambda: ([], []))
+    for item, vector in zip(batch, vectors):
+        if vector is None:
+            continue  # Vectorizer unavailable; Weaviate still gets it
+        memories, user_vectors = by_user[item.user_id]
+        memories.append({"key": item.outbox_id, "text": item.text, "timestamp": _format_timestamp(item.timestamp)})
+        user_vectors.append(vector)
+    for user_id, (memories, user_vectors) in by_user.items():
+        index.add(user_id, memories, user_vectors)
+
+async def _feed_local_index(batch):
+    """Embed the batch with the configured vectorizer and add it to the local index."""
+    index = get_local_index()
+    if index is None:
+        return
+    vectors = await asyncio.gather(*(embed_text(item.text) for item in batch))
+    await asyncio.to_thread(_index_locally, index, batch, vectors)
+
+async def _next_batch(first=None):
+    batch = [first] if first is not None else [await _queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.MEMORY_INGEST_FLUSH_INTERVAL
+    while len(batch) < settings.MEMORY_INGEST_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def _worker():
+    while True:
+        batch = await _next_batch()
+        try:
+            # The local index is fed first so it can answer while Weaviate is down
+            try:
+                await _feed_local_index(batch)
+            except Exception as e:
+                logger.warning(f"Local memory index error: {e}")
+            await _write_batch(batch)
+        except Exception as e:
+            # Keep the worker alive; the rows are still in the outbox
+            logger.error(f"Memory ingest worker error: {e}")
+            _pending_ids.difference_update(item.outbox_id for item in batch)
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+async def sweep_outbox(limit=None, min_age=None):
+    """Re-queue outbox rows that are not already in flight. Returns the count queued."""
+    limit = limit or settings.MEMORY_INGEST_QUEUE_SIZE
+    if min_age is None:
+        min_age = settings.MEMORY_OUTBOX_MIN_AGE
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age)
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(MemoryOutbox)
+            .where(MemoryOutbox.timestamp <= cutoff)
+            .order_by(MemoryOutbox.id)
+            .limit(limit)
+        )
+        entries = result.scalars().all()
+    queued = 0
+    for entry in entries:
+        if entry.id in _pending_ids:
+            continue
+        if not await enqueue_memory(entry):
+            break
+        queued += 1
+    return queued
+
+async def _sweeper():
+    while True:
+        try:
+            queued = await sweep_outbox()
+            if queued:
+                logger.info(f"Re-queued {queued} memories from the outbox")
+        except Exception as e:
+            logger.warning(f"Memory outbox sweep error: {e}")
+        await asyncio.sleep(settings.MEMORY_OUTBOX_SWEEP_INTERVAL)
+
+def start_ingest_worker():
+    global _queue, _worker_task, _sweep_task
+    if _worker_task is not None:
+        return
+    _queue = asyncio.Queue(maxsize=settings.MEMORY_INGEST_QUEUE_SIZE)
+    _worker_task = asyncio.create_task(_worker())
+    # The first sweep replays anything left behind by a previous process
+    _sweep_task = asyncio.create_task(_sweeper())
+
+async def stop_ingest_worker():
+    """Flush queued memories to Weaviate and stop the worker."""
+    global _queue, _worker_task, _sweep_task
+    if _worker_task is None:
+        return
+    _sweep_task.cancel()
+    try:
+        await asyncio.wait_for(_queue.join(), settings.MEMORY_INGEST_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Memory ingest flush timed out with {_queue.qsize()} queued, they stay in the outbox")
+    _worker_task.cancel()
+    await asyncio.gather(_worker_task, _sweep_task, return_exceptions=True)
+    _queue = _worker_task = _sweep_task = None
+    _pending_ids.clear()
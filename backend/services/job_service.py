@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+import httpx
+from sqlalchemy import and_, delete, exists, func, or_, select, tuple_, update
+from sqlalchemy.orm import aliased
+from backend.config import settings
+from backend.db import AsyncSessionLocal
+from backend.models.user import User
+from backend.models.webhook_job import WebhookJob
+from backend.services.agent_service import process_chat_message
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Worker pool for asynchronous n8n webhook jobs.
+#
+# The webhook commits a WebhookJob row and calls submit() to wake this
+# process's workers. The database is the queue, shared by every server
+# process: a worker claims the oldest unfinished job of a user who has no
+# job running (SELECT ... FOR UPDATE SKIP LOCKED on Postgres), so
+# N8N_JOB_CONCURRENCY workers per process run jobs for different users in
+# parallel while one user's replies are produced strictly in order, whichever
+# process received them. A user with a large backlog holds at most one worker
+# at a time, so the other mailboxes keep moving. Idle workers poll every
+# N8N_JOB_POLL_INTERVAL for jobs queued by other processes. Results are stored
+# on the row (polled via GET /n8n/jobs/{id}) and POSTed to N8N_WEBHOOK_URL when
+# it is set. A job left "running" by a dead process is claimed again once it
+# is N8N_JOB_STALE_AFTER seconds old. Finished jobs are deleted once they are
+# N8N_JOB_RETENTION seconds old.
+
+_wake = None     # asyncio.Event set when there may be a job to claim
+_stop = None     # asyncio.Event set by stop_job_workers
+_workers = []
+_purger = None
+_http = None
+
+def is_running() -> bool:
+    return _wake is not None
+
+async def has_capacity() -> bool:
+    if not is_running():
+        return False
+    async with AsyncSessionLocal() as db:
+        pending = await db.scalar(
+            select(func.count()).select_from(WebhookJob).where(WebhookJob.status == "queued")
+        )
+    return pending < settings.N8N_JOB_MAX_PENDING
+
+def submit(job_id: str, user_id: int) -> bool:
+    """Wake the workers for a committed job. Returns False if the pool is not running."""
+    if _wake is None:
+        return False
+    _wake.set()
+    return True
+
+def job_payload(job: WebhookJob) -> dict:
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "email": job.email,
+        "reply": json.loads(job.result) if job.result else None,
+        "error": job.error,
+    }
+
+async def _deliver(db, job: WebhookJob):
+    global _http
+    if not settings.N8N_WEBHOOK_URL:
+        return
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=settings.N8N_CALLBACK_TIMEOUT)
+    payload = job_payload(job)
+    for attempt in range(settings.N8N_CALLBACK_RETRIES + 1):
+        try:
+            resp = await _http.post(settings.N8N_WEBHOOK_URL, json=payload)
+            job.callback_status = resp.status_code
+            if resp.status_code < 500:
+                break
+        except httpx.HTTPError as e:
+            logger.warning(f"n8n callback error for job {job.id} (attempt {attempt + 1}): {e}")
+        if attempt < settings.N8N_CALLBACK_RETRIES:
+            await asyncio.sleep((2 ** attempt) * random.uniform(0.5, 1.5))
+    await db.commit()
+
+def _unfinished(jobs, stale_before):
+    """Queued, or left running by a process that died."""
+    return or_(jobs.status == "queued", and_(jobs.status == "running", jobs.updated_at < stale_before))
+
+async def _claim_next():
+    """Mark the next runnable job as running and return its id, or None if there is none."""
+    running, earlier = aliased(WebhookJob), aliased(WebhookJob)
+    while True:
+        stale_before = datetime.now(timezone.utc) - timedelta(seconds=settings.N8N_JOB_STALE_AFTER)
+        user_busy = exists().where(
+            running.user_id == WebhookJob.user_id,
+            running.status == "running",
+            running.updated_at >= stale_before
+        )
+        # Also keeps a user's next job back while another worker holds a
+        # row lock on the previous one (skipped, not yet marked running)
+        not_first = exists().where(
+            earlier.user_id == WebhookJob.user_id,
+            _unfinished(earlier, stale_before),
+            tuple_(earlier.created_at, earlier.id) < tuple_(WebhookJob.created_at, WebhookJob.id)
+        )
+        async with AsyncSessionLocal() as db:
+            job_id = await db.scalar(
+                select(WebhookJob.id)
+                .where(_unfinished(WebhookJob, stale_before), ~user_busy, ~not_first)
+                .order_by(WebhookJob.created_at, WebhookJob.id)
+                .limit(1)
+                .with_for_update(skip_locked=True, of=WebhookJob)
+            )
+            if job_id is None:
+                return None
+            claimed = await db.execute(
+                update(WebhookJob)
+                .where(WebhookJob.id == job_id, _unfinished(WebhookJob, stale_before))
+                .values(status="running")
+            )
+            await db.commit()
+        if claimed.rowcount:
+            return job_id
+        # Another worker claimed it first (SQLite has no row locks), look again
+
+async def _run_job(job_id: str):
+    async with AsyncSessionLocal() as db:
+        job = await db.get(WebhookJob, job_id)
+        user = await db.get(User, job.user_id)
+        try:
+            reply = await process_chat_message(db, user, job.message)
+            job.status = "done"
+            job.result = json.dumps(reply)
+        except Exception as e:
+            await db.rollback()
+            await db.refresh(job)
+            logger.warning(f"Webhook job {job_id} failed: {e}")
+            job.status = "failed"
+            job.error = str(getattr(e, "detail", None) or e)
+        await db.commit()
+        await _deliver(db, job)
+
+async def _worker():
+    while True:
+        # Checked and cleared without yielding, so a stop can't be missed
+        if _stop.is_set():
+            return
+        _wake.clear()
+        job_id = None
+        try:
+            job_id = await _claim_next()
+            if job_id is not None:
+                await _run_job(job_id)
+                continue
+        except Exception as e:
+            # Keep the worker alive; a claimed row is retried once stale
+            logger.error(f"Webhook job worker error on {job_id}: {e}")
+        try:
+            await asyncio.wait_for(_wake.wait(), settings.N8N_JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def purge_finished_jobs(now: datetime = None) -> int:
+    """Delete done and failed jobs last updated before N8N_JOB_RETENTION ago. Returns the count."""
+    now = now or datetime.now(timezone.utc)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            delete(WebhookJob).where(
+                WebhookJob.status.in_(("done", "failed")),
+                WebhookJob.updated_at < now - timedelta(seconds=settings.N8N_JOB_RETENTION)
+            )
+        )
+        await db.commit()
+    return result.rowcount
+
+async def _purge_loop():
+    while True:
+        try:
+            purged = await purge_finished_jobs()
+            if purged:
+                logger.info(f"Deleted {purged} finished webhook jobs")
+        except Exception as e:
+            logger.warning(f"Webhook job purge error: {e}")
+        await asyncio.sleep(settings.N8N_JOB_PURGE_INTERVAL)
+
+async def start_job_workers():
+    global _wake, _stop, _workers, _purger
+    if _wake is not None:
+        return
+    _wake, _stop = asyncio.Event(), asyncio.Event()
+    # Unfinished rows from before a restart are claimed like new ones
+    _wake.set()
+    _workers = [asyncio.create_task(_worker()) for _ in range(settings.N8N_JOB_CONCURRENCY)]
+    _purger = asyncio.create_task(_purge_loop())
+
+async def stop_job_workers():
+    """Let running jobs finish, then stop; queued jobs stay in the table for the next worker."""
+    global _wake, _stop, _workers, _purger, _http
+    if _wake is None:
+        return
+    _purger.cancel()
+    await asyncio.gather(_purger, return_exceptions=True)
+    _purger = None
+    _stop.set()
+    _wake.set()
+    done, running = await asyncio.wait(_workers, timeout=settings.N8N_JOB_SHUTDOWN_TIMEOUT)
+    if running:
+        logger.warning("Webhook jobs still running at shutdown, they will be retried once stale")
+    for task in running:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    if _http is not None:
+        await _http.aclose()
+    _wake = _stop = _http = None
+    _workers = []
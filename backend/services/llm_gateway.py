@@ -0,0 +1,443 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+from backend.services.metrics import LLM_REQUEST_SECONDS, registry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Shared entry point for OpenAI chat completions.
+#
+# Every call goes through the same admission path: a client-side token
+# bucket for requests and one for tokens (sized to this process's share of
+# the org's RPM/TPM limits, so bursts queue here instead of coming back as
+# 429s), then a process-wide concurrency cap. The buckets are per process:
+# backend.server passes its worker count in SERVER_PROCESSES and each worker
+# gets an equal share, so together they stay under the org limits even
+# when one worker is busy and the others idle. Admitted calls are retried
+# with jittered backoff on 429/5xx/timeouts, honouring Retry-After, and fall
+# through the LLM_FALLBACK_MODELS chain once a model's retries are used up,
+# until LLM_DEADLINE. Optionally a second, hedged request is sent when the
+# first is slower than the model's recent p95 latency; it is charged to both
+# buckets like any call, and whichever answers first wins.
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+class LLMOverloaded(Exception):
+    """The call could not be admitted within LLM_QUEUE_TIMEOUT."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"LLM capacity exhausted, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """
+    Refills at `per_minute` / 60 per second up to `per_minute`. reserve()
+    always succeeds and returns how long the caller must wait for its share,
+    so concurrent callers are served in reservation order. per_minute <= 0
+    means unlimited.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self._rate = self.capacity / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+        return max(0.0, -self._tokens / self._rate)
+
+    def try_take(self, amount: float) -> bool:
+        if self.capacity <= 0:
+            return True
+        self._refill()
+        if self._tokens < amount:
+            return False
+        self._tokens -= amount
+        return True
+
+    def refund(self, amount: float):
+        if self.capacity > 0:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+class _Slots:
+    """Counting semaphore with FIFO waiters and a timeout on acquire."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def try_acquire(self) -> bool:
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return True
+        return False
+
+    async def acquire(self, timeout: float) -> bool:
+        if self.try_acquire():
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # Handed a slot just as the caller went away
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)  # The slot passes straight to the next caller
+                return
+        self.in_use -= 1
+
+@dataclass
+class ModelStats:
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    fallbacks: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=settings.LLM_LATENCY_WINDOW))
+
+    def percentile(self, pct: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def as_dict(self) -> dict:
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency_p50_s": round(p50, 3) if p50 is not None else None,
+            "latency_p95_s": round(p95, 3) if p95 is not None else None,
+        }
+
+def _is_retryable(error: Exception) -> bool:
+    import openai
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in RETRYABLE_STATUS or status >= 500)
+
+def _retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+class _GatewayStream:
+    """Wraps an upstream stream; returns the concurrency slot and books usage on close."""
+
+    def __init__(self, gateway, model: str, stream, on_close):
+        self.model = model
+        self._gateway = gateway
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                self._gateway._record_usage(self.model, usage)
+            yield chunk
+
+    async def close(self):
+        if self._on_close is None:
+            return
+        on_close, self._on_close = self._on_close, None
+        try:
+            await self._stream.close()
+        finally:
+            on_close()
+
+class LLMGateway:
+    def __init__(self, client, fallback_models=(), rpm_limit=0, tpm_limit=0, max_concurrency=32):
+        self.client = client
+        self.fallback_models = list(fallback_models)
+        self._requests = TokenBucket(rpm_limit)
+        self._tokens = TokenBucket(tpm_limit)
+        self._slots = _Slots(max_concurrency)
+        self._stats = {}
+
+    def _model_stats(self, model: str) -> ModelStats:
+        if model not in self._stats:
+            self._stats[model] = ModelStats()
+        return self._stats[model]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._slots.in_use,
+            "queued": self._slots.waiting,
+            "models": {model: stats.as_dict() for model, stats in self._stats.items()},
+        }
+
+    def _record_usage(self, model: str, usage):
+        stats = self._model_stats(model)
+        stats.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        stats.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+    async def _admit(self, estimated_tokens: int):
+        """Waits for rate budget and a concurrency slot, or raises LLMOverloaded."""
+        deadline = time.monotonic() + settings.LLM_QUEUE_TIMEOUT
+        wait = max(self._requests.reserve(1), self._tokens.reserve(estimated_tokens))
+        if wait > settings.LLM_QUEUE_TIMEOUT:
+            self._requests.refund(1)
+            self._tokens.refund(estimated_tokens)
+            raise LLMOverloaded(retry_after=wait)
+        if wait:
+            await asyncio.sleep(wait)
+        if not await self._slots.acquire(max(0.0, deadline - time.monotonic())):
+            # The call is not made, so its rate budget goes back
+            self._requests.refund(1)
+            self._tokens.refund(estimated_tokens)
+            raise LLMOverloaded(retry_after=settings.LLM_QUEUE_TIMEOUT)
+
+    def _settle_tokens(self, estimated_tokens: int, usage):
+        """Charge the token bucket for what the call actually used instead of the estimate."""
+        actual = getattr(usage, "total_tokens", None)
+        if actual is not None:
+            self._tokens.refund(estimated_tokens - actual)
+
+    def _models(self, model: str):
+        return [model] + [m for m in self.fallback_models if m != model]
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(settings.LLM_RETRY_MAX_DELAY, settings.LLM_RETRY_BASE_DELAY * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, settings.LLM_RETRY_MAX_DELAY))
+        # A retry is another request against the org's limit
+        return max(delay, self._requests.reserve(1))
+
+    async def _with_retries(self, model: str, call):
+        """
+        Runs `call(model)` for each model of the chain, retrying retryable
+        errors with backoff until LLM_MAX_RETRIES or the LLM_DEADLINE is used up.
+        """
+        deadline = time.monotonic() + settings.LLM_DEADLINE
+        last_error = None
+        for index, current in enumerate(self._models(model)):
+            stats = self._model_stats(current)
+            if index:
+                if time.monotonic() >= deadline:
+                    raise last_error
+                stats.fallbacks += 1
+                logger.warning(f"Falling back to {current} after: {last_error}")
+            for attempt in range(settings.LLM_MAX_RETRIES + 1):
+                try:
+                    return current, await call(current)
+                except Exception as e:
+                    stats.errors += 1
+                    if not _is_retryable(e):
+                        raise
+                    last_error = e
+                    if attempt == settings.LLM_MAX_RETRIES:
+                        break
+                    delay = self._backoff(attempt, e)
+                    if time.monotonic() + delay > deadline:
+                        self._requests.refund(1)  # Reserved by _backoff for a retry that won't happen
+                        raise
+                    stats.retries += 1
+                    logger.info(f"{current} error, retry {attempt + 1} in {delay:.2f}s: {e}")
+                    await asyncio.sleep(delay)
+        raise last_error
+
+    def _hedge_delay(self, model: str) -> float:
+        stats = self._model_stats(model)
+        if len(stats.latencies) < settings.LLM_HEDGE_MIN_SAMPLES:
+            return settings.LLM_HEDGE_DELAY
+        return max(settings.LLM_HEDGE_MIN_DELAY, stats.percentile(settings.LLM_HEDGE_PERCENTILE))
+
+    async def _create(self, model: str, kwargs: dict):
+        stats = self._model_stats(model)
+        stats.calls += 1
+        started = time.monotonic()
+        response = await self.client.chat.completions.create(model=model, timeout=settings.LLM_TIMEOUT, **kwargs)
+        stats.latencies.append(time.monotonic() - started)
+        LLM_REQUEST_SECONDS.observe(time.monotonic() - started, model=model)
+        if response.usage is not None:
+            self._record_usage(model, response.usage)
+        return response
+
+    def _admit_hedge(self, estimated_tokens: int) -> bool:
+        """The hedge needs its own rate budget and slot; it is skipped rather than queued."""
+        if not self._slots.try_acquire():
+            return False
+        if not self._requests.try_take(1):
+            self._slots.release()
+            return False
+        if not self._tokens.try_take(estimated_tokens):
+            self._requests.refund(1)
+            self._slots.release()
+            return False
+        return True
+
+    async def _hedged_request(self, model: str, kwargs: dict):
+        self._model_stats(model).hedges += 1
+        try:
+            return await self._create(model, kwargs)
+        finally:
+            self._slots.release()
+
+    async def _create_hedged(self, model: str, kwargs: dict, estimated_tokens: int):
+        primary = asyncio.ensure_future(self._create(model, kwargs))
+        if not settings.LLM_HEDGE_ENABLED:
+            return await primary
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self._hedge_delay(model))
+            if done or not self._admit_hedge(estimated_tokens):
+                return await primary
+            hedge = asyncio.ensure_future(self._hedged_request(model, kwargs))
+            pending.add(hedge)
+            try:
+                error = None
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is not None:
+                            error = task.exception()
+                        else:
+                            if task is hedge:
+                                self._model_stats(model).hedge_wins += 1
+                            return task.result()
+                raise error
+            finally:
+                # The caller settles one estimate against the winner's usage; the loser's goes back
+                self._tokens.refund(estimated_tokens)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def complete(self, messages, model: str, estimated_tokens: int = 0, **kwargs):
+        """
+        Chat completion through the admission queue, retries, hedging and
+        fallback chain. `estimated_tokens` (prompt plus expected reply) is
+        charged against the TPM bucket until the real usage is known.
+        Raises LLMOverloaded, or the last upstream error.
+        """
+        estimated_tokens = estimated_tokens or settings.LLM_COMPLETION_TOKEN_ESTIMATE
+        await self._admit(estimated_tokens)
+        try:
+            _, response = await self._with_retries(
+                model, lambda current: self._create_hedged(current, dict(messages=messages, **kwargs), estimated_tokens)
+            )
+        finally:
+            self._slots.release()
+        self._settle_tokens(estimated_tokens, response.usage)
+        return response
+
+    async def open_stream(self, messages, model: str, estimated_tokens: int = 0, **kwargs):
+        """
+        Streaming completion. Retries and fallback apply until the stream is
+        opened; hedging does not. The concurrency slot is held until the
+        returned stream is closed.
+        """
+        estimated_tokens = estimated_tokens or settings.LLM_COMPLETION_TOKEN_ESTIMATE
+        await self._admit(estimated_tokens)
+
+        async def open_one(current):
+            self._model_stats(current).calls += 1
+            return await self.client.chat.completions.create(
+                model=current, messages=messages, timeout=settings.LLM_TIMEOUT, stream=True,
+                stream_options={"include_usage": True}, **kwargs
+            )
+
+        try:
+            current, stream = await self._with_retries(model, open_one)
+        except BaseException:
+            self._slots.release()
+            raise
+        return _GatewayStream(self, current, stream, on_close=self._slots.release)
+
+    async def close(self):
+        await self.client.close()
+
+_gateway = None
+reset_after_fork(globals(), _gateway=None)
+
+def process_share(org_limit: float) -> float:
+    """This process's part of an org-wide per-minute limit (0 stays unlimited)."""
+    return org_limit / max(1, settings.SERVER_PROCESSES)
+
+def get_llm_gateway() -> LLMGateway:
+    global _gateway
+    if _gateway is None:
+        from openai import AsyncOpenAI  # heavy import, kept off the startup path
+        client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL or None,
+            max_retries=0,  # Retries happen here, where they can see the rate limits
+        )
+        _gateway = LLMGateway(
+            client,
+            fallback_models=[m.strip() for m in settings.LLM_FALLBACK_MODELS.split(",") if m.strip()],
+            rpm_limit=process_share(settings.LLM_RPM_LIMIT),
+            tpm_limit=process_share(settings.LLM_TPM_LIMIT),
+            max_concurrency=settings.LLM_MAX_CONCURRENCY,
+        )
+    return _gateway
+
+_COUNTERS = ("calls", "errors", "retries", "fallbacks", "hedges", "hedge_wins", "prompt_tokens", "completion_tokens")
+
+@registry.collector
+def _gateway_metrics():
+    if _gateway is None:
+        return []
+    stats = _gateway.stats()
+    families = [
+        (f"ccc_llm_{name}_total", "counter", f"LLM gateway {name.replace('_', ' ')} per model.", ("model",),
+         {(model, ): values[name] for model, values in stats["models"].items()})
+        for name in _COUNTERS
+    ]
+    families.append(("ccc_llm_in_flight", "gauge", "Completions running.", (), {(): stats["in_flight"]}))
+    families.append(("ccc_llm_queued", "gauge", "Completions waiting for a slot.", (), {(): stats["queued"]}))
+    return families
+
+async def close_llm_gateway():
+    global _gateway
+    if _gateway is not None:
+        await _gateway.close()
+        _gateway = None
@@ -0,0 +1,312 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np
+from backend.config import settings
+from backend.services.embedding_service import embed_text, embedding_backend_id
+from backend.services.forksafe import reset_after_fork
+from backend.services.weaviate_service import search_relevant_messages
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _older_than(timestamp, cutoff: datetime) -> bool:
+    try:
+        moment = datetime.fromisoformat(str(timestamp).replace("Z", "+00:00"))
+    except ValueError:
+        return False  # No usable timestamp; kept
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment < cutoff
+
+class _UserIndex:
+    """
+    One user's memories: unit vectors appended to `<name>.f32` (read back as
+    a memmap) and their properties appended to `<name>.jsonl`, row for row.
+    Worker processes share the files. Appends and crash repair happen under
+    an exclusive flock on `<name>.lock`; readers follow the files' tails to
+    pick up rows appended elsewhere. Vectors are written before properties,
+    so the shorter file always marks the last complete row. Pruning rewrites
+    both files under the lock and renames them into place; readers notice the
+    new vector file and reload from the start.
+    """
+
+    def __init__(self, root: Path, name: str, dim: int):
+        self._vec_path = root / f"{name}.f32"
+        self._meta_path = root / f"{name}.jsonl"
+        self._lock_path = root / f"{name}.lock"
+        self._dim = dim
+        self._row_bytes = dim * 4
+        self._reset()
+        with self._locked():
+            self._repair()
+            self.sync()
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _reset(self):
+        self._file_id = None   # (st_dev, st_ino) of the vector file loaded from
+        self._meta_offset = 0  # bytes of the properties file already loaded
+        self.meta = []
+        self.keys = set()
+        self.vectors = np.empty((0, self._dim), dtype=np.float32)
+
+    def _current_file_id(self):
+        try:
+            stat = self._vec_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def _rows_on_disk(self) -> int:
+        return self._vec_path.stat().st_size // self._row_bytes if self._vec_path.exists() else 0
+
+    def _repair(self):
+        """Cut both files back to the last complete row left by a crashed writer. Needs the lock."""
+        data = self._meta_path.read_bytes() if self._meta_path.exists() else b""
+        lengths = []
+        for line in data.split(b"\n")[:-1]:
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            lengths.append(len(line) + 1)
+        count = min(self._rows_on_disk(), len(lengths))
+        if self._vec_path.exists() and self._vec_path.stat().st_size != count * self._row_bytes:
+            with open(self._vec_path, "r+b") as fh:
+                fh.truncate(count * self._row_bytes)
+        if len(data) != sum(lengths[:count]):
+            with open(self._meta_path, "r+b") as fh:
+                fh.truncate(sum(lengths[:count]))
+
+    def sync(self):
+        """Load rows appended since the last call, by this or another process."""
+        file_id = self._current_file_id()
+        if file_id != self._file_id:
+            if self._file_id is not None:
+                self._reset()  # Rewritten by prune_before
+            self._file_id = file_id
+        rows = self._rows_on_disk()
+        if rows <= len(self.meta):
+            return
+        with open(self._meta_path, "rb") as fh:
+            fh.seek(self._meta_offset)
+            data = fh.read()
+        added = []
+        for line in data.split(b"\n")[:-1]:  # the last piece is empty or still being written
+            if len(self.meta) + len(added) >= rows:
+                break
+            added.append(json.loads(line))
+            self._meta_offset += len(line) + 1
+        if added:
+            self.meta.extend(added)
+            self.keys.update(item.get("key") for item in added)
+            self.vectors = np.memmap(self._vec_path, dtype=np.float32, mode="r", shape=(len(self.meta), self._dim))
+
+    def append(self, items, vectors):
+        with self._locked():
+            self.sync()
+            fresh = [row for row, item in enumerate(items) if item["key"] not in self.keys]
+            if not fresh:
+                return 0
+            items = [items[row] for row in fresh]
+            vectors = np.stack([vectors[row] for row in fresh]).astype(np.float32)
+            with open(self._vec_path, "ab") as fh:
+                fh.write(vectors.tobytes())
+            with open(self._meta_path, "ab") as fh:
+                fh.write("".join(json.dumps(item) + "\n" for item in items).encode("utf-8"))
+            self.sync()
+        return len(items)
+
+    def prune_before(self, cutoff: datetime) -> int:
+        """Drop memories timestamped before `cutoff`. Returns how many were removed."""
+        with self._locked():
+            self.sync()
+            keep = [row for row, item in enumerate(self.meta) if not _older_than(item.get("timestamp"), cutoff)]
+            removed = len(self.meta) - len(keep)
+            if not removed:
+                return 0
+            vec_tmp = self._vec_path.with_name(self._vec_path.name + ".tmp")
+            meta_tmp = self._meta_path.with_name(self._meta_path.name + ".tmp")
+            with open(vec_tmp, "wb") as fh:
+                fh.write(np.asarray(self.vectors[keep], dtype=np.float32).tobytes())
+            with open(meta_tmp, "wb") as fh:
+                fh.write("".join(json.dumps(self.meta[row]) + "\n" for row in keep).encode("utf-8"))
+            # Properties first: until the vector file is replaced, readers keep
+            # the old pair (they follow the vector file's identity)
+            meta_tmp.replace(self._meta_path)
+            vec_tmp.replace(self._vec_path)
+            self._reset()
+            self.sync()
+        return removed
+
+    def search(self, query: np.ndarray, top_k: int, window: int):
+        start = max(len(self.meta) - window, 0)  # only the newest `window` rows
+        vectors = self.vectors[start:]
+        if not len(vectors) or top_k <= 0:
+            return []
+        scores = vectors @ query
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(start + int(i), float(scores[i])) for i in best]
+
+class LocalVectorIndex:
+    """
+    In-process store of chat memories, one brute-force index per user,
+    persisted under `root` and shared by the worker processes. Callers pass
+    the embeddings (see search_memories), so one index holds one vector
+    space; its dimension is fixed by the first vector added and recorded in
+    `<root>/dim`. Search results have the same shape as Weaviate's
+    (properties + metadata.distance). With `comparable_scores` off the
+    distance is None: the ranking is the index's own, but the scores mean
+    nothing next to Weaviate's.
+    """
+
+    def __init__(self, root: Path, max_per_user: int, cached_users: int, comparable_scores: bool = True):
+        self._root = Path(root)
+        self._root.mkdir(parents=True, exist_ok=True)
+        self._dim_path = self._root / "dim"
+        self._dim = None
+        self._max_per_user = max_per_user
+        self._cached_users = cached_users
+        self._comparable_scores = comparable_scores
+        self._users = OrderedDict()  # user_id -> _UserIndex, least recently used first
+        self._lock = threading.Lock()
+
+    def _known_dim(self):
+        if self._dim is None and self._dim_path.exists():
+            self._dim = int(self._dim_path.read_text())
+        return self._dim
+
+    def _fix_dim(self, dim: int):
+        if self._known_dim() is None:
+            # Every process derives the same value from the same vector space
+            tmp = self._dim_path.with_name(f"dim.{os.getpid()}.tmp")
+            tmp.write_text(str(dim))
+            os.replace(tmp, self._dim_path)
+            self._dim = dim
+        if dim != self._dim:
+            raise ValueError(f"Embedding has {dim} dimensions, the index under {self._root} has {self._dim}")
+
+    def _user(self, user_id) -> _UserIndex:
+        user_id = str(user_id)
+        index = self._users.get(user_id)
+        if index is None:
+            index = _UserIndex(self._root, f"user_{user_id}", self._dim)
+            self._users[user_id] = index
+            while len(self._users) > self._cached_users:
+                self._users.popitem(last=False)
+        self._users.move_to_end(user_id)
+        return index
+
+    def add(self, user_id, memories, vectors):
+        """Append `{"key", "text", "timestamp"}` dicts with their unit vectors; keys already present are skipped."""
+        if not memories:
+            return 0
+        with self._lock:
+            self._fix_dim(len(vectors[0]))
+            return self._user(user_id).append([
+                {"key": str(m["key"]), "text": m["text"], "timestamp": m.get("timestamp", "")}
+                for m in memories
+            ], vectors)
+
+    def prune_before(self, cutoff: datetime) -> int:
+        """Drop every user's memories timestamped before `cutoff` (chat retention). Returns the count."""
+        if self._known_dim() is None:
+            return 0
+        removed = 0
+        for path in sorted(self._root.glob("user_*.f32")):
+            with self._lock:
+                removed += self._user(path.stem[len("user_"):]).prune_before(cutoff)
+        return removed
+
+    def count(self, user_id) -> int:
+        with self._lock:
+            if self._known_dim() is None:
+                return 0
+            index = self._user(user_id)
+            index.sync()
+            return len(index.meta)
+
+    def search(self, user_id, query: np.ndarray, top_k: int = 5):
+        """Memories closest to the unit vector `query`, best first."""
+        with self._lock:
+            if self._known_dim() is None:
+                return []
+            index = self._user(user_id)
+            index.sync()
+            return [
+                SimpleNamespace(
+                    uuid=None,
+                    properties={"text": index.meta[row]["text"], "timestamp": index.meta[row]["timestamp"], "user_id": str(user_id)},
+                    metadata=SimpleNamespace(distance=1.0 - score if self._comparable_scores else None)
+                )
+                for row, score in index.search(query, top_k, self._max_per_user)
+            ]
+
+_local_index = None
+reset_after_fork(globals(), _local_index=None)
+
+def get_local_index():
+    """The process-wide index, or None when LOCAL_INDEX_MODE is "off"."""
+    global _local_index
+    if settings.LOCAL_INDEX_MODE == "off":
+        return None
+    if _local_index is None:
+        # One directory per vector space: switching EMBEDDING_BACKEND starts a new index
+        space = re.sub(r"[^A-Za-z0-9]+", "_", embedding_backend_id()).strip("_")
+        _local_index = LocalVectorIndex(
+            Path(settings.LOCAL_INDEX_DIR) / space,
+            max_per_user=settings.LOCAL_INDEX_MAX_PER_USER,
+            cached_users=settings.LOCAL_INDEX_CACHED_USERS,
+            # Weaviate vectorizes with t2v-transformers; the hashed local
+            # embedding is a degraded fallback whose scores are not ranked against it
+            comparable_scores=settings.EMBEDDING_BACKEND == "transformers"
+        )
+    return _local_index
+
+async def _search_locally(index, user_id, text, top_k):
+    vector = await embed_text(text)
+    if vector is None:
+        logger.warning("Vectorizer unavailable, the local index can't answer either")
+        return []
+    return await asyncio.to_thread(index.search, user_id, vector, top_k)
+
+async def search_memories(wclient, user_id, text, top_k=5):
+    """
+    Relevant memories for `user_id`. In "primary" mode the local index
+    answers whenever it has data for the user; otherwise Weaviate is asked
+    first and the local index takes over if it errors or doesn't answer
+    within LOCAL_INDEX_FAILOVER_TIMEOUT. The query is embedded like the
+    memories were at ingest, with the configured vectorizer (embed_text).
+    """
+    index = get_local_index()
+    if index is None:
+        return await search_relevant_messages(wclient, user_id, text, top_k=top_k)
+    if settings.LOCAL_INDEX_MODE == "primary" and await asyncio.to_thread(index.count, user_id):
+        return await _search_locally(index, user_id, text, top_k)
+    try:
+        return await asyncio.wait_for(
+            search_relevant_messages(wclient, user_id, text, top_k=top_k, raise_errors=True),
+            settings.LOCAL_INDEX_FAILOVER_TIMEOUT
+        )
+    except Exception as e:
+        logger.warning(f"Weaviate search unavailable ({e!r}), using the local index")
+        return await _search_locally(index, user_id, text, top_k)
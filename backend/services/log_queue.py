@@ -0,0 +1,56 @@
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from backend.config import settings
+from backend.services.metrics import registry
+
+# Request handlers only put log records on a bounded queue; a listener
+# thread formats and writes them with the handlers that were configured
+# before. When the queue is full records are dropped and counted rather
+# than blocking the event loop on a slow stdout.
+
+LOG_RECORDS_DROPPED = registry.counter(
+    "ccc_log_records_dropped_total", "Log records dropped because the log queue was full."
+)
+
+payload_logger = logging.getLogger("backend.payloads")
+
+class DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+_listener = None
+_previous_handlers = None
+
+def start_queue_logging():
+    global _listener, _previous_handlers
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    _previous_handlers = list(root.handlers)
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    _listener = QueueListener(log_queue, *_previous_handlers, respect_handler_level=True)
+    root.handlers = [DroppingQueueHandler(log_queue)]
+    _listener.start()
+
+def stop_queue_logging():
+    """Flushes what is queued and puts the original handlers back."""
+    global _listener, _previous_handlers
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().handlers = _previous_handlers
+    _listener = _previous_handlers = None
+
+def log_payload(msg, *args):
+    """
+    Log request payloads for a LOG_PAYLOAD_SAMPLE_RATE share of calls. Args
+    are only formatted for the sampled ones.
+    """
+    rate = settings.LOG_PAYLOAD_SAMPLE_RATE
+    if rate > 0 and random.random() < rate:
+        payload_logger.info(msg, *args)
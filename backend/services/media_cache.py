@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from backend.config import settings
+from backend.services.media_service import MediaService
+from backend.services.forksafe import reset_after_fork
+from backend.services.processes import process_gone
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _touch(path: Path):
+    # Explicit nanoseconds: the kernel's own timestamps are too coarse to order
+    # entries written in quick succession
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+class MediaCache:
+    """
+    Disk cache of Drive file contents, addressed by Drive's md5Checksum.
+
+    Entries live at `<root>/<md5[:2]>/<md5>` and are written to a temp file
+    and renamed into place, so a reader never sees a partial file. Worker
+    processes share the directory: a hit refreshes the file's access time
+    and eviction is LRU over everything in it, so the total stays under
+    max_bytes however many workers fill it. Concurrent misses for the same
+    content in one process share one Drive download.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, max_entry_bytes: int):
+        self._root = Path(root)
+        # Worker processes share the cache; each writes into its own tmp dir
+        self._tmp = self._root / "tmp" / str(os.getpid())
+        self._max_bytes = max_bytes
+        self._max_entry_bytes = max_entry_bytes
+        self._by_gdrive = {}           # gdrive_id -> md5
+        self._inflight = {}            # md5 -> Future resolving to the cached path
+        self._clean_tmp()
+
+    def _clean_tmp(self):
+        self._tmp.mkdir(parents=True, exist_ok=True)
+        for tmp_dir in self._tmp.parent.iterdir():
+            if tmp_dir == self._tmp or not process_gone(tmp_dir.name):
+                continue
+            for leftover in tmp_dir.iterdir():
+                leftover.unlink(missing_ok=True)
+            tmp_dir.rmdir()
+
+    def _path(self, md5: str) -> Path:
+        return self._root / md5[:2] / md5
+
+    def _evict(self):
+        """Drop least recently used entries until the directory fits max_bytes; returns their md5s."""
+        found = []
+        for path in self._root.glob("??/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another worker meanwhile
+            found.append((stat.st_atime_ns, path.name, stat.st_size))
+        total = sum(size for _, _, size in found)
+        dropped = []
+        for _, md5, size in sorted(found):
+            if total <= self._max_bytes:
+                break
+            self._drop(md5)
+            dropped.append(md5)
+            total -= size
+        return dropped
+
+    def _drop(self, md5: str):
+        self._path(md5).unlink(missing_ok=True)
+
+    async def _download(self, gdrive_id: str, md5: str, size: int) -> Path:
+        tmp_path = self._tmp / uuid.uuid4().hex
+        digest = hashlib.md5()
+        try:
+            with open(tmp_path, "wb") as fh:
+                async for chunk in MediaService.stream_from_gdrive(gdrive_id, 0, size - 1):
+                    digest.update(chunk)
+                    await asyncio.to_thread(fh.write, chunk)
+            if digest.hexdigest() != md5:
+                raise ValueError(f"Checksum mismatch for {gdrive_id}")
+            final_path = self._path(md5)
+            final_path.parent.mkdir(exist_ok=True)
+            os.replace(tmp_path, final_path)
+            _touch(final_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        # Stats every entry in the shared directory; kept off the event loop
+        dropped = set(await asyncio.to_thread(self._evict))
+        for gdrive_id in [g for g, m in self._by_gdrive.items() if m in dropped]:
+            del self._by_gdrive[gdrive_id]
+        return final_path
+
+    def _key(self, gdrive_id: str, meta: dict):
+        """The md5 `gdrive_id` is cached under, or None when it can't be cached."""
+        md5 = meta.get("md5Checksum")
+        size = int(meta.get("size", 0))
+        if not md5 or size > self._max_entry_bytes:
+            return None
+        previous = self._by_gdrive.get(gdrive_id)
+        if previous and previous != md5:
+            self.invalidate(gdrive_id)
+        self._by_gdrive[gdrive_id] = md5
+        return md5
+
+    def _cached(self, md5: str):
+        path = self._path(md5)
+        try:
+            _touch(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _fill(self, gdrive_id: str, md5: str, size: int) -> asyncio.Future:
+        inflight = self._inflight.get(md5)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._download(gdrive_id, md5, size))
+            self._inflight[md5] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(md5, None))
+        return inflight
+
+    def lookup(self, gdrive_id: str, meta: dict):
+        """
+        Return the local path with the current content of `gdrive_id`, or
+        None on a miss. `meta` is fresh Drive metadata.
+        """
+        md5 = self._key(gdrive_id, meta)
+        return self._cached(md5) if md5 else None
+
+    def prefetch(self, gdrive_id: str, meta: dict):
+        """Start filling the cache for `gdrive_id` without waiting for it."""
+        md5 = self._key(gdrive_id, meta)
+        if not md5 or self._cached(md5):
+            return
+
+        def log_failure(future):
+            if not future.cancelled() and future.exception():
+                logger.warning(f"Media cache fill failed for {gdrive_id}: {future.exception()}")
+
+        self._fill(gdrive_id, md5, int(meta["size"])).add_done_callback(log_failure)
+
+    def invalidate(self, gdrive_id: str):
+        md5 = self._by_gdrive.pop(gdrive_id, None)
+        if md5 and md5 not in self._by_gdrive.values():
+            self._drop(md5)
+
+_media_cache = None
+reset_after_fork(globals(), _media_cache=None)
+
+def get_media_cache():
+    """The process-wide cache, or None when MEDIA_CACHE_ENABLED is off."""
+    global _media_cache
+    if not settings.MEDIA_CACHE_ENABLED:
+        return None
+    if _media_cache is None:
+        _media_cache = MediaCache(
+            settings.MEDIA_CACHE_DIR,
+            max_bytes=settings.MEDIA_CACHE_MAX_BYTES,
+            max_entry_bytes=settings.MEDIA_CACHE_MAX_ENTRY_BYTES
+        )
+    return _media_cache
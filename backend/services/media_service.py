@@ -1,67 +1,136 @@
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
-from google.oauth2 import service_account
+import asyncio
 import io
+import logging
 from backend.config import settings
+from backend.services.gdrive_client import get_drive_client
+from backend.services.metrics import DRIVE_BYTES, drive_call
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class CountingReader:
+    """
+    File wrapper that records how many bytes the Drive uploader has read,
+    so the size is known once the upload finishes without a separate pass.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._position = fd.tell()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._fd.read(size)
+        self._position += len(data)
+        self.bytes_read = max(self.bytes_read, self._position)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._position = self._fd.seek(offset, whence)
+        return self._position
+
+    def tell(self):
+        return self._position
 
 class MediaService:
     @staticmethod
     def get_gdrive_service():
-        creds = service_account.Credentials.from_service_account_file(
-            settings.google_creds_path,
-            scopes=["https://www.googleapis.com/auth/drive"]
-        )
-        return build("drive", "v3", credentials=creds)
+        # Thread-confined: only use from inside a Drive worker (see DriveClient.run)
+        return get_drive_client().service()
 
     @staticmethod
-    async def upload_to_gdrive(file):
-        service = MediaService.get_gdrive_service()
+    async def _create_gdrive_file(file):
+        """Upload an UploadFile; returns (gdrive_id, size in bytes). Raises on failure."""
+        from googleapiclient.http import MediaIoBaseUpload
         file_metadata = {
             'name': file.filename,
             'parents': [settings.GOOGLE_DRIVE_FOLDER_ID] if settings.GOOGLE_DRIVE_FOLDER_ID else []
         }
         # Stream the file directly to Google Drive (supports large files)
-        media = MediaIoBaseUpload(file.file, mimetype=file.content_type, resumable=True)
-        print("file_metadata", media)
+        reader = CountingReader(file.file)
+        media = MediaIoBaseUpload(reader, mimetype=file.content_type, resumable=True)
+        with drive_call("upload"):
+            gfile = await get_drive_client().run(
+                lambda service: service.files().create(
+                    body=file_metadata,
+                    media_body=media,
+                    fields='id',
+                    supportsAllDrives=True
+                ).execute()
+            )
+        DRIVE_BYTES.inc(reader.bytes_read, direction="upload")
+        logger.debug(f"Uploaded {file.filename} to Drive as {gfile.get('id')}")
+        return gfile.get('id'), reader.bytes_read
+
+    @staticmethod
+    async def upload_to_gdrive(file):
         try:
-            gfile = service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id',
-                supportsAllDrives=True
-            ).execute()
-            print("gfile", gfile)
-            return gfile.get('id')
+            gdrive_id, _ = await MediaService._create_gdrive_file(file)
+            return gdrive_id
         except Exception as e:
-            print(f"Google Drive upload error: {e}")
+            logger.error(f"Google Drive upload error: {e}")
             return None
 
+    @staticmethod
+    async def upload_many(files, concurrency=None):
+        """
+        Upload files to Drive concurrently, at most `concurrency` at a time
+        (MEDIA_UPLOAD_CONCURRENCY by default). Returns one result per file,
+        in input order: {"file", "gdrive_id", "file_size", "error"}.
+        """
+        semaphore = asyncio.Semaphore(concurrency or settings.MEDIA_UPLOAD_CONCURRENCY)
+
+        async def upload(file):
+            result = {"file": file, "gdrive_id": None, "file_size": None, "error": None}
+            async with semaphore:
+                try:
+                    result["gdrive_id"], result["file_size"] = await MediaService._create_gdrive_file(file)
+                    if not result["gdrive_id"]:
+                        result["error"] = "Drive returned no file id"
+                except Exception as e:
+                    logger.error(f"Google Drive upload error for {file.filename}: {e}")
+                    result["error"] = str(e)
+            return result
+
+        return await asyncio.gather(*(upload(file) for file in files))
+
+    @staticmethod
+    async def delete_many_from_gdrive(gdrive_ids):
+        """Best-effort delete, used to roll back a failed batch."""
+        await asyncio.gather(*(MediaService.delete_from_gdrive(gdrive_id) for gdrive_id in gdrive_ids))
+
     @staticmethod
     async def delete_from_gdrive(gdrive_id):
-        print("gdrive_id",gdrive_id)
-        service = MediaService.get_gdrive_service()
         try:
-            service.files().delete(fileId=gdrive_id, supportsAllDrives=True).execute()
+            with drive_call("delete"):
+                await get_drive_client().run(
+                    lambda service: service.files().delete(fileId=gdrive_id, supportsAllDrives=True).execute()
+                )
             return True
         except Exception as e:
-            print(f"Google Drive delete error: {e}")
+            logger.error(f"Google Drive delete error for {gdrive_id}: {e}")
             return False
 
     @staticmethod
     async def rename_gdrive_file(gdrive_id, new_name):
-        service = MediaService.get_gdrive_service()
         try:
             file_metadata = {'name': new_name}
-            result = service.files().update(fileId=gdrive_id, body=file_metadata, supportsAllDrives=True).execute()
+            with drive_call("rename"):
+                await get_drive_client().run(
+                    lambda service: service.files().update(
+                        fileId=gdrive_id, body=file_metadata, supportsAllDrives=True
+                    ).execute()
+                )
             return True
         except Exception as e:
-            print(f"Google Drive rename error: {e}")
+            logger.error(f"Google Drive rename error: {e}")
             return False
 
     @staticmethod
     async def download_from_gdrive(gdrive_id):
-        service = MediaService.get_gdrive_service()
-        try:
+        from googleapiclient.http import MediaIoBaseDownload
+
+        def download(service):
             request = service.files().get_media(fileId=gdrive_id, supportsAllDrives=True)
             fh = io.BytesIO()
             downloader = MediaIoBaseDownload(fh, request)
@@ -70,6 +139,76 @@ class MediaService:
                 status, done = downloader.next_chunk()
             fh.seek(0)
             return fh.read()
+
+        try:
+            with drive_call("download"):
+                data = await get_drive_client().run(download)
+            DRIVE_BYTES.inc(len(data), direction="download")
+            return data
+        except Exception as e:
+            logger.error(f"Google Drive download error: {e}")
+            return None
+
+    @staticmethod
+    async def get_gdrive_metadata(gdrive_id):
+        try:
+            with drive_call("metadata"):
+                return await get_drive_client().run(
+                    lambda service: service.files().get(
+                        fileId=gdrive_id,
+                        fields='id,name,mimeType,size,md5Checksum,sha256Checksum,modifiedTime',
+                        supportsAllDrives=True
+                    ).execute()
+                )
         except Exception as e:
-            print(f"Google Drive download error: {e}")
-            return None 
\ No newline at end of file
+            logger.error(f"Google Drive metadata error: {e}")
+            return None
+
+    @staticmethod
+    async def stream_from_gdrive(gdrive_id, start=0, end=None, chunk_size=None):
+        """
+        Yield bytes `start`..`end` (inclusive, `end=None` for EOF) of a Drive
+        file, one ranged get_media request per chunk. The next chunk is
+        fetched while the current one is being sent, so at most two chunks
+        are held in memory per download.
+        """
+        from googleapiclient.errors import HttpError
+        chunk_size = chunk_size or settings.GDRIVE_DOWNLOAD_CHUNK_SIZE
+        drive = get_drive_client()
+
+        def fetch(service, offset):
+            last = offset + chunk_size - 1
+            if end is not None:
+                last = min(last, end)
+            request = service.files().get_media(fileId=gdrive_id, supportsAllDrives=True)
+            request.headers["range"] = f"bytes={offset}-{last}"
+            try:
+                with drive_call("download_chunk"):
+                    data = request.execute()
+            except HttpError as e:
+                if e.resp.status == 416:  # offset is past EOF
+                    return b""
+                raise
+            DRIVE_BYTES.inc(len(data), direction="download")
+            return data
+
+        def schedule(offset):
+            if end is not None and offset > end:
+                return None
+            return asyncio.ensure_future(drive.run(lambda service: fetch(service, offset)))
+
+        pending = schedule(start)
+        try:
+            offset = start
+            while pending is not None:
+                data = await pending
+                pending = None
+                if not data:
+                    break
+                offset += len(data)
+                if len(data) == chunk_size or (end is not None and offset <= end):
+                    pending = schedule(offset)
+                yield data
+        finally:
+            if pending is not None:
+                pending.cancel()
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import logging
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from backend.models.media_blob import MediaBlob
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Content-addressed, reference-counted media storage.
+#
+# Each distinct content (by SHA-256) is stored on Drive once, as a MediaBlob
+# row whose refcount is the number of Media rows pointing at it. Uploading
+# content that already has a blob adds a reference instead of a transfer;
+# deleting a Media row drops one, and the Drive object is deleted with the
+# last. Counts only change through single UPDATE statements, and a blob is
+# deleted only while its refcount is 0, so concurrent uploads and deletes of
+# the same content can't lose a reference.
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def sha256_file(fd) -> str:
+    """Hash a file object from the start and rewind it for the upload that follows."""
+    digest = hashlib.sha256()
+    fd.seek(0)
+    for block in iter(lambda: fd.read(HASH_BLOCK_SIZE), b""):
+        digest.update(block)
+    fd.seek(0)
+    return digest.hexdigest()
+
+async def hash_upload(file) -> str:
+    return await asyncio.to_thread(sha256_file, file.file)
+
+async def acquire_existing(db, counts: dict) -> dict:
+    """
+    Add `counts[sha256]` references to every blob that already exists.
+    Returns {sha256: (gdrive_id, file_size)} for those; the rest need an upload.
+    """
+    found = {}
+    for sha256, refs in counts.items():
+        result = await db.execute(
+            update(MediaBlob)
+            .where(MediaBlob.sha256 == sha256)
+            .values(refcount=MediaBlob.refcount + refs)
+            .returning(MediaBlob.gdrive_id, MediaBlob.file_size)
+        )
+        row = result.first()
+        if row is not None:
+            found[sha256] = (row.gdrive_id, row.file_size)
+    return found
+
+async def add_blob(db, sha256: str, gdrive_id: str, file_size, refs: int) -> str:
+    """
+    Record a freshly uploaded Drive object holding `refs` references. If a
+    concurrent upload of the same content recorded its blob first, the
+    references go to that one and its gdrive_id is returned; the caller then
+    deletes its own copy from Drive.
+    """
+    try:
+        async with db.begin_nested():
+            db.add(MediaBlob(sha256=sha256, gdrive_id=gdrive_id, file_size=file_size, refcount=refs))
+    except IntegrityError:
+        found = await acquire_existing(db, {sha256: refs})
+        if sha256 not in found:
+            raise
+        return found[sha256][0]
+    return gdrive_id
+
+async def release(db, sha256: str):
+    """
+    Drop one reference. Returns the gdrive_id to delete from Drive once the
+    transaction commits if that was the last reference, else None.
+    """
+    result = await db.execute(
+        update(MediaBlob)
+        .where(MediaBlob.sha256 == sha256)
+        .values(refcount=MediaBlob.refcount - 1)
+        .returning(MediaBlob.refcount, MediaBlob.gdrive_id)
+    )
+    row = result.first()
+    if row is None or row.refcount > 0:
+        return None
+    deleted = await db.execute(
+        delete(MediaBlob).where(MediaBlob.sha256 == sha256, MediaBlob.refcount <= 0)
+    )
+    return row.gdrive_id if deleted.rowcount else None
@@ -0,0 +1,398 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# In-process metrics in the Prometheus text format, served at /metrics.
+#
+# Counters and histograms are updated inline on the hot path (a dict update
+# under a lock). Values owned by other components (pool usage, cache and
+# LLM gateway counters) are read through collectors at scrape time instead.
+# With several worker processes each one writes a snapshot to METRICS_DIR
+# every METRICS_SNAPSHOT_INTERVAL, and the worker answering a scrape writes a
+# fresh one of its own first. The scrape adds up the snapshot files only, and
+# each file only ever moves forward, so summed counters never go down
+# whichever worker answers. Counters of workers that exited are folded into
+# retired.json (under METRICS_DIR/.lock) rather than dropped, for the same
+# reason. Gauges keep a `pid` label there, since adding them up is meaningless.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> dict:
+        with self._lock:
+            return {key: (list(value) if isinstance(value, list) else value) for key, value in self._values.items()}
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    """Values are [count per bucket..., sum, count], buckets not cumulative."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def collector(self, fn):
+        """
+        Register `fn() -> [(name, kind, help, labels, {label_values: value})]`,
+        called at scrape time. Usable as a decorator.
+        """
+        self._collectors.append(fn)
+        return fn
+
+    def snapshot(self) -> dict:
+        """JSON-serializable view of every metric, collectors included."""
+        families = {
+            m.name: {"kind": m.kind, "help": m.help, "labels": list(m.labels),
+                     "buckets": list(getattr(m, "buckets", ())), "samples": m.samples()}
+            for m in self._metrics.values()
+        }
+        for collect in self._collectors:
+            try:
+                for name, kind, help, labels, samples in collect():
+                    families[name] = {"kind": kind, "help": help, "labels": list(labels),
+                                      "buckets": [], "samples": dict(samples)}
+            except Exception as e:
+                logger.warning(f"Metrics collector {getattr(collect, '__name__', collect)} failed: {e}")
+        for family in families.values():
+            family["samples"] = [[list(key), value] for key, value in family["samples"].items()]
+        return families
+
+registry = Registry()
+
+def merge_snapshots(snapshots: dict) -> dict:
+    """Adds up {pid: snapshot} across processes; gauges get a pid label instead."""
+    merged = {}
+    for pid, families in snapshots.items():
+        for name, family in families.items():
+            target = merged.setdefault(name, dict(family, samples={}))
+            gauge = family["kind"] == "gauge"
+            if gauge and "pid" not in target["labels"]:
+                target["labels"] = family["labels"] + ["pid"]
+            for key, value in family["samples"]:
+                key = tuple(key) + ((str(pid),) if gauge else ())
+                current = target["samples"].get(key)
+                if current is None:
+                    target["samples"][key] = value
+                elif isinstance(value, list):
+                    target["samples"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    target["samples"][key] = current + value
+    for family in merged.values():
+        family["samples"] = [[list(key), value] for key, value in family["samples"].items()]
+    return merged
+
+def render(families: dict) -> str:
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        labels = family["labels"]
+        for key, value in sorted(family["samples"], key=lambda s: s[0]):
+            if family["kind"] != "histogram":
+                lines.append(f"{name}{_format_labels(labels, key)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family["buckets"]) + [float("inf")], value):
+                cumulative += count
+                le = (("le", _format_value(float(bound))),)
+                lines.append(f"{name}_bucket{_format_labels(labels, key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels, key)} {_format_value(float(value[-2]))}")
+            lines.append(f"{name}_count{_format_labels(labels, key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+def _snapshot_dir():
+    return Path(settings.METRICS_DIR) if settings.METRICS_DIR else None
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _write_json(path: Path, data):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data))
+    tmp.replace(path)
+
+def _write_snapshot():
+    directory = _snapshot_dir()
+    if directory is None:
+        return
+    directory.mkdir(parents=True, exist_ok=True)
+    _write_json(directory / f"{os.getpid()}.json", registry.snapshot())
+
+@contextmanager
+def _locked(directory: Path):
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / ".lock", "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def _read_json(path: Path):
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+
+def _retire(directory: Path, pid: int):
+    """Fold the counters and histograms of an exited worker into retired.json; call under _locked."""
+    path = directory / f"{pid}.json"
+    snapshot = _read_json(path)
+    if snapshot is not None:
+        baseline = _read_json(directory / "retired.json") or {}
+        final = {name: family for name, family in snapshot.items() if family["kind"] != "gauge"}
+        _write_json(directory / "retired.json", merge_snapshots({"retired": baseline, pid: final}))
+    path.unlink(missing_ok=True)
+
+def collect_all() -> dict:
+    """Every worker's metrics, built from the snapshot files after writing a fresh one of this process."""
+    directory = _snapshot_dir()
+    if directory is None:
+        return registry.snapshot()
+    _write_snapshot()
+    snapshots = {}
+    with _locked(directory):
+        for path in directory.glob("*.json"):
+            if not path.stem.isdigit():
+                continue
+            pid = int(path.stem)
+            if not _process_alive(pid):
+                _retire(directory, pid)
+                continue
+            try:
+                snapshots[pid] = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue  # Being replaced right now; it'll be there next scrape
+        baseline = _read_json(directory / "retired.json")
+    if baseline:
+        snapshots["retired"] = baseline
+    if list(snapshots) == [os.getpid()]:
+        return snapshots[os.getpid()]
+    return merge_snapshots(snapshots)
+
+# Hot-path instruments
+
+CHAT_STAGE_SECONDS = registry.histogram(
+    "ccc_chat_stage_seconds", "Time spent in each stage of the chat pipeline.", labels=("stage",)
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "ccc_http_request_seconds", "HTTP request duration by route.", labels=("method", "route", "status")
+)
+DRIVE_SECONDS = registry.histogram(
+    "ccc_drive_request_seconds", "Google Drive call duration.", labels=("op",)
+)
+DRIVE_BYTES = registry.counter(
+    "ccc_drive_bytes_total", "Bytes moved to and from Google Drive.", labels=("direction",)
+)
+LLM_REQUEST_SECONDS = registry.histogram(
+    "ccc_llm_request_seconds", "Completion latency per upstream request.", labels=("model",)
+)
+EVENT_LOOP_LAG_SECONDS = registry.histogram(
+    "ccc_event_loop_lag_seconds", "How late the event loop ran a timer.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+_tracer = None
+reset_after_fork(globals(), _tracer=None)
+
+def _get_tracer():
+    """The OpenTelemetry tracer when TRACING_ENABLED and the SDK is installed, else None."""
+    global _tracer
+    if not settings.TRACING_ENABLED:
+        return None
+    if _tracer is None:
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            logger.warning("TRACING_ENABLED is set but opentelemetry is not installed, spans are off")
+            _tracer = False
+            return None
+        _tracer = trace.get_tracer("ccc_agent")
+    return _tracer or None
+
+@contextmanager
+def stage(name: str):
+    """Time a chat pipeline stage, and trace it as a span when tracing is on."""
+    with ExitStack() as stack:
+        tracer = _get_tracer()
+        if tracer is not None:
+            stack.enter_context(tracer.start_as_current_span(f"chat.{name}"))
+        stack.enter_context(CHAT_STAGE_SECONDS.time(stage=name))
+        yield
+
+@contextmanager
+def drive_call(op: str):
+    with ExitStack() as stack:
+        tracer = _get_tracer()
+        if tracer is not None:
+            stack.enter_context(tracer.start_as_current_span(f"drive.{op}"))
+        stack.enter_context(DRIVE_SECONDS.time(op=op))
+        yield
+
+def _route_template(scope) -> str:
+    """The path with its parameters put back as {name}, so ids don't explode the label set."""
+    if scope.get("route") is None:
+        return "unmatched"
+    params = {str(value): name for name, value in scope.get("path_params", {}).items()}
+    return "/".join(f"{{{params[part]}}}" if part in params else part for part in scope["path"].split("/"))
+
+class MetricsMiddleware:
+    """Pure ASGI, so streamed responses are timed to the last byte without buffering."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=_route_template(scope),
+                status=status["code"],
+            )
+
+async def _monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    interval = settings.METRICS_LOOP_LAG_INTERVAL
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - expected))
+
+async def _write_snapshots():
+    while True:
+        await asyncio.sleep(settings.METRICS_SNAPSHOT_INTERVAL)
+        try:
+            await asyncio.to_thread(_write_snapshot)
+        except Exception as e:
+            logger.warning(f"Metrics snapshot error: {e}")
+
+_tasks = []
+reset_after_fork(globals(), _tasks=list)
+
+def start_metrics_tasks():
+    _tasks.append(asyncio.create_task(_monitor_loop_lag()))
+    directory = _snapshot_dir()
+    if directory is not None:
+        # A snapshot under this pid was left by an earlier process that reused it
+        with _locked(directory):
+            _retire(directory, os.getpid())
+        _tasks.append(asyncio.create_task(_write_snapshots()))
+
+async def stop_metrics_tasks():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    directory = _snapshot_dir()
+    if directory is not None:
+        _write_snapshot()
+        with _locked(directory):
+            _retire(directory, os.getpid())
@@ -0,0 +1,30 @@
+import math
+import os
+
+def process_gone(pid) -> bool:
+    """Whether no process `pid` is running here; names that are not pids count as alive."""
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, PermissionError):
+        return False
+    return False
+
+def _cgroup_cpu_limit():
+    try:
+        quota, period = open("/sys/fs/cgroup/cpu.max").read().split()
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return max(1, math.ceil(int(quota) / int(period)))
+
+def available_cpus() -> int:
+    """CPUs this process may run on: its affinity mask, capped by the container's cgroup quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    return min(cpus, limit) if limit else cpus
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import random
+import time
+from backend.config import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class Dependency:
+    def __init__(self, name: str, required: bool):
+        self.name = name
+        self.required = required
+        self.status = "starting"  # starting, ready, failed
+        self.attempts = 0
+        self.error = None
+        self.started_at = time.monotonic()
+        self.ready_after = None
+
+    def as_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "required": self.required,
+            "attempts": self.attempts,
+            "error": self.error,
+            "ready_after_s": round(self.ready_after, 3) if self.ready_after is not None else None,
+        }
+
+class Readiness:
+    """
+    Brings dependencies up in background tasks, retrying with capped
+    exponential backoff, so the app serves /healthz immediately and /readyz
+    reports which dependency is still coming up. The app is ready once every
+    required dependency is; optional ones only show up in the report.
+    """
+
+    def __init__(self):
+        self._deps = {}
+        self._tasks = []
+
+    def start(self, name: str, init, required: bool = True, max_attempts: int = None):
+        """Run `await init()` until it succeeds, or `max_attempts` (None: keep trying)."""
+        dep = Dependency(name, required)
+        self._deps[name] = dep
+        self._tasks.append(asyncio.create_task(self._run(dep, init, max_attempts)))
+        return dep
+
+    async def _run(self, dep: Dependency, init, max_attempts):
+        delay = settings.STARTUP_RETRY_BASE_DELAY
+        while True:
+            dep.attempts += 1
+            try:
+                await init()
+            except Exception as e:
+                dep.error = f"{type(e).__name__}: {e}"
+                if max_attempts is not None and dep.attempts >= max_attempts:
+                    dep.status = "failed"
+                    logger.error(f"{dep.name} failed to start after {dep.attempts} attempts: {e}")
+                    return
+                logger.warning(f"{dep.name} not ready (attempt {dep.attempts}), retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+                delay = min(delay * 2, settings.STARTUP_RETRY_MAX_DELAY)
+                continue
+            dep.status = "ready"
+            dep.error = None
+            dep.ready_after = time.monotonic() - dep.started_at
+            logger.info(f"{dep.name} ready after {dep.ready_after:.2f}s")
+            return
+
+    def is_ready(self, name: str) -> bool:
+        dep = self._deps.get(name)
+        return dep is not None and dep.status == "ready"
+
+    def report(self):
+        """Returns (ready, {name: details})."""
+        ready = all(dep.status == "ready" for dep in self._deps.values() if dep.required)
+        return ready, {name: dep.as_dict() for name, dep in self._deps.items()}
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+readiness = Readiness()
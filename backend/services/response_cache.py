@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
+from backend.services.metrics import registry
+
+@dataclass(eq=False)
+class CacheEntry:
+    user_id: int
+    vector: np.ndarray
+    response: str
+    context_key: str
+    expires_at: float
+    hits: int = 0
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+class SemanticResponseCache:
+    """
+    Reuses a stored reply when a user's incoming message is semantically
+    close (cosine similarity >= threshold) to one already answered.
+
+    Entries are scoped per user and tagged with a context key: a fingerprint
+    of what the prompt is built from (configuration, retrieved memories and
+    documents) plus a per-user context version that callers bump (see
+    bump_context) when the user's documents change. Entries expire after
+    `ttl` seconds; the total size is bounded with LRU eviction, and a user's
+    context version is dropped with their last entry.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int, max_per_user: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_per_user = max_per_user
+        self.stats = CacheStats()
+        self._lru = OrderedDict()  # CacheEntry -> None, least recently used first
+        self._by_user = {}         # user_id -> [CacheEntry]
+        self._context_versions = OrderedDict()  # user_id -> version, least recently bumped first
+        self._versions_issued = 0
+        self._lock = threading.Lock()
+
+    def context_key(self, user_id, prompt_fingerprint: str) -> str:
+        version = self._context_versions.get(user_id, 0)
+        return hashlib.sha1(f"{prompt_fingerprint}|{version}".encode()).hexdigest()
+
+    def bump_context(self, user_id):
+        """Invalidate every cached reply of this user."""
+        with self._lock:
+            # Never reused, so a key computed before the bump can't match again
+            self._versions_issued += 1
+            self._context_versions[user_id] = self._versions_issued
+            self._context_versions.move_to_end(user_id)
+            while len(self._context_versions) > self.max_entries:
+                self._context_versions.popitem(last=False)
+            for entry in self._by_user.pop(user_id, []):
+                self._lru.pop(entry, None)
+
+    def _remove(self, entry):
+        self._lru.pop(entry, None)
+        entries = self._by_user.get(entry.user_id)
+        if entries and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self._by_user[entry.user_id]
+                self._context_versions.pop(entry.user_id, None)
+
+    def lookup(self, user_id, vector: np.ndarray, context_key: str):
+        """Return the cached reply for the closest match above the threshold, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entries = self._by_user.get(user_id, [])
+            for entry in [e for e in entries if e.expires_at < now]:
+                self._remove(entry)
+                self.stats.expirations += 1
+            candidates = [e for e in self._by_user.get(user_id, []) if e.context_key == context_key]
+            if candidates:
+                scores = np.stack([e.vector for e in candidates]) @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry = candidates[best]
+                    entry.hits += 1
+                    self._lru.move_to_end(entry)
+                    self.stats.hits += 1
+                    return entry.response
+            self.stats.misses += 1
+            return None
+
+    def store(self, user_id, vector: np.ndarray, response: str, context_key: str):
+        entry = CacheEntry(user_id, vector, response, context_key, time.monotonic() + self.ttl)
+        with self._lock:
+            entries = self._by_user.setdefault(user_id, [])
+            entries.append(entry)
+            self._lru[entry] = None
+            self.stats.stores += 1
+            if len(entries) > self.max_per_user:
+                self._remove(entries[0])
+                self.stats.evictions += 1
+            while len(self._lru) > self.max_entries:
+                oldest = next(iter(self._lru))
+                self._remove(oldest)
+                self.stats.evictions += 1
+
+    def __len__(self):
+        return len(self._lru)
+
+_response_cache = None
+reset_after_fork(globals(), _response_cache=None)
+
+def get_response_cache():
+    """The process-wide cache, or None when SEMANTIC_CACHE_ENABLED is off."""
+    global _response_cache
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return None
+    if _response_cache is None:
+        _response_cache = SemanticResponseCache(
+            threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+            ttl=settings.SEMANTIC_CACHE_TTL,
+            max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+            max_per_user=settings.SEMANTIC_CACHE_MAX_PER_USER
+        )
+    return _response_cache
+
+@registry.collector
+def _cache_metrics():
+    if _response_cache is None:
+        return []
+    stats = _response_cache.stats
+    events = {(name,): getattr(stats, name) for name in ("hits", "misses", "stores", "evictions", "expirations")}
+    return [
+        ("ccc_semantic_cache_events_total", "counter", "Semantic response cache lookups and maintenance.",
+         ("event",), events),
+        ("ccc_semantic_cache_entries", "gauge", "Replies held in the semantic response cache.",
+         (), {(): len(_response_cache._lru)}),
+    ]
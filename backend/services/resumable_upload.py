@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+import httpx
+from sqlalchemy import select, update
+from backend.config import settings
+from backend.db import AsyncSessionLocal
+from backend.models.upload_session import UploadSession
+from backend.services.forksafe import reset_after_fork
+from backend.services.gdrive_client import get_drive_client
+from backend.services.media_service import MediaService
+from backend.services.metrics import DRIVE_BYTES, drive_call
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Relay for resumable uploads (see /media/uploads).
+#
+# Each upload session owns a Google Drive resumable session. A client chunk
+# is streamed straight from the request body into a PUT on the Drive session
+# URI, so nothing is buffered beyond socket reads, whatever the file size.
+# Drive's acknowledged range is the source of truth for the offset; after a
+# dropped connection the client asks for the status (which re-queries Drive)
+# and resumes from there. Drive requires every chunk but the last to be a
+# multiple of 256 KiB. Sessions nobody touched for UPLOAD_SESSION_TTL are
+# expired by a sweep in every worker: the Drive session is cancelled, or the
+# file Drive assembled but nobody completed is deleted.
+
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+CHUNK_GRANULARITY = 256 * 1024
+_CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+_RANGE_RE = re.compile(r"^bytes=0-(\d+)$")
+
+class DriveUploadError(Exception):
+    """Drive refused or failed a resumable upload request; `status` is the HTTP status to answer with."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+_http = None
+reset_after_fork(globals(), _http=None)
+
+def _client() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.UPLOAD_CHUNK_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=settings.UPLOAD_MAX_CONNECTIONS),
+        )
+    return _http
+
+async def _auth_headers() -> dict:
+    token = await get_drive_client().token()
+    return {"Authorization": f"Bearer {token}"}
+
+def parse_content_range(header: str, total: int):
+    """
+    Parse a chunk's `Content-Range: bytes start-end/total` into inclusive
+    (start, end). Raises ValueError if it is malformed or disagrees with the
+    session's total size.
+    """
+    match = _CONTENT_RANGE_RE.match((header or "").strip())
+    if not match:
+        raise ValueError("Content-Range must be 'bytes start-end/total'")
+    start, end, declared = (int(g) for g in match.groups())
+    if declared != total or end < start or end >= total:
+        raise ValueError("Content-Range does not fit the upload size")
+    if end + 1 < total and (end - start + 1) % CHUNK_GRANULARITY:
+        raise ValueError(f"Chunks other than the last must be a multiple of {CHUNK_GRANULARITY} bytes")
+    return start, end
+
+def _acknowledged(resp: httpx.Response) -> int:
+    match = _RANGE_RE.match(resp.headers.get("range", ""))
+    return int(match.group(1)) + 1 if match else 0
+
+def _result(resp: httpx.Response, total: int):
+    """(offset, gdrive_id) from a Drive chunk or status response."""
+    if resp.status_code == 308:
+        return _acknowledged(resp), None
+    if resp.status_code in (200, 201):
+        return total, resp.json()["id"]
+    if resp.status_code in (404, 410):
+        raise DriveUploadError(410, "Drive upload session expired, start a new upload")
+    if resp.status_code >= 500 or resp.status_code == 429:
+        raise DriveUploadError(503, f"Drive unavailable ({resp.status_code}), retry from the current offset")
+    raise DriveUploadError(502, f"Drive rejected the upload ({resp.status_code}): {resp.text[:200]}")
+
+async def create_drive_session(filename: str, filetype: str, size: int) -> str:
+    """Open a Drive resumable session for a file of `size` bytes; returns its session URI."""
+    metadata = {
+        "name": filename,
+        "parents": [settings.GOOGLE_DRIVE_FOLDER_ID] if settings.GOOGLE_DRIVE_FOLDER_ID else []
+    }
+    headers = await _auth_headers()
+    headers.update({"X-Upload-Content-Type": filetype, "X-Upload-Content-Length": str(size)})
+    with drive_call("resumable_start"):
+        resp = await _client().post(
+            DRIVE_UPLOAD_URL,
+            params={"uploadType": "resumable", "supportsAllDrives": "true", "fields": "id"},
+            json=metadata,
+            headers=headers,
+        )
+    if resp.status_code != 200 or "location" not in resp.headers:
+        raise DriveUploadError(502, f"Drive did not open an upload session ({resp.status_code})")
+    return resp.headers["location"]
+
+async def put_chunk(session_uri: str, body, start: int, end: int, total: int):
+    """
+    Stream one chunk (`body` is an async iterator of bytes) to Drive.
+    Returns (offset Drive has acknowledged, gdrive_id once the file is complete).
+    """
+    length = end - start + 1
+    sent = 0
+
+    async def counted():
+        nonlocal sent
+        async for block in body:
+            sent += len(block)
+            yield block
+
+    headers = {"Content-Length": str(length), "Content-Range": f"bytes {start}-{end}/{total}"}
+    try:
+        with drive_call("resumable_chunk"):
+            resp = await _client().put(session_uri, content=counted(), headers=headers)
+    except httpx.HTTPError as e:
+        # Also raised when the client disconnected mid-chunk; Drive keeps what it got
+        raise DriveUploadError(503, f"Chunk relay interrupted, query the status and resume: {e}")
+    finally:
+        DRIVE_BYTES.inc(sent, direction="upload")
+    return _result(resp, total)
+
+async def query_drive_offset(session_uri: str, total: int):
+    """Ask Drive how much of the file it has. Returns (offset, gdrive_id or None)."""
+    try:
+        with drive_call("resumable_status"):
+            resp = await _client().put(
+                session_uri, content=b"", headers={"Content-Range": f"bytes */{total}"}
+            )
+    except httpx.HTTPError as e:
+        raise DriveUploadError(503, f"Drive status query failed: {e}")
+    return _result(resp, total)
+
+async def cancel_drive_session(session_uri: str):
+    """Best effort; Drive answers 499 when the session is cancelled."""
+    try:
+        await _client().delete(session_uri)
+    except httpx.HTTPError as e:
+        logger.warning(f"Drive upload session cancel error: {e}")
+
+async def close_upload_client():
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+async def expire_upload_sessions(now: datetime = None) -> int:
+    """Expire open and uploaded sessions idle for UPLOAD_SESSION_TTL. Returns how many were expired."""
+    now = now or datetime.now(timezone.utc)
+    stale_before = now - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+    expired = 0
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(UploadSession.id, UploadSession.status, UploadSession.drive_session_uri, UploadSession.gdrive_id)
+            .where(UploadSession.status.in_(("open", "uploaded")), UploadSession.updated_at < stale_before)
+        )
+        for upload in result.all():
+            # Conditional on the status read above: a session completed or
+            # cancelled meanwhile (or claimed by another worker's sweep) is left alone
+            claimed = await session.execute(
+                update(UploadSession)
+                .where(UploadSession.id == upload.id, UploadSession.status == upload.status)
+                .values(status="expired")
+            )
+            await session.commit()
+            if claimed.rowcount != 1:
+                continue
+            if upload.status == "open":
+                await cancel_drive_session(upload.drive_session_uri)
+            else:
+                await MediaService.delete_from_gdrive(upload.gdrive_id)
+            expired += 1
+    return expired
+
+async def _upload_sweeper():
+    while True:
+        try:
+            expired = await expire_upload_sessions()
+            if expired:
+                logger.info(f"Expired {expired} abandoned upload sessions")
+        except Exception as e:
+            logger.warning(f"Upload session sweep error: {e}")
+        await asyncio.sleep(settings.UPLOAD_SWEEP_INTERVAL)
+
+_sweeper_task = None
+reset_after_fork(globals(), _sweeper_task=None)
+
+def start_upload_sweeper():
+    global _sweeper_task
+    if _sweeper_task is None:
+        _sweeper_task = asyncio.create_task(_upload_sweeper())
+
+async def stop_upload_sweeper():
+    global _sweeper_task
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+        await asyncio.gather(_sweeper_task, return_exceptions=True)
+        _sweeper_task = None
@@ -1,50 +1,221 @@
 import time
-import weaviate
-from weaviate.classes.config import Property, DataType
+import asyncio
+import functools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import logging
+from backend.config import settings
+from backend.services.forksafe import reset_after_fork
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 client = None  # Global client variable
 
-def setup_schema():
+# The weaviate package takes most of a second to import; it is imported on
+# first use so it stays off the startup path.
+
+# The v4 sync client blocks; run its calls on a bounded pool so a slow
+# query or vectorizer round trip never stalls the event loop.
+def _new_executor():
+    return ThreadPoolExecutor(
+        max_workers=settings.WEAVIATE_MAX_WORKERS,
+        thread_name_prefix="weaviate"
+    )
+
+_executor = _new_executor()
+
+async def run_in_weaviate_executor(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+# Chat memories live in a multi-tenant collection with one tenant per user, so
+# every read and write touches only that user's shard and vector index.
+# Tenants are created and reactivated on first use; the sweep below takes
+# tenants this process hasn't touched for a while out of memory, pruning them
+# to the chat retention cutoff first, so retention never has to wake a cold
+# tenant up.
+_started_at = time.monotonic()
+_tenant_last_used = {}  # tenant name -> monotonic time of last use in this process
+_tenant_pruned_through = {}  # tenant name -> retention cutoff its memories were last pruned to
+_tenant_sweep_task = None
+reset_after_fork(
+    globals(), client=None, _executor=_new_executor, _tenant_last_used=dict, _tenant_pruned_through=dict,
+    _tenant_sweep_task=None
+)
+
+def tenant_name(user_id) -> str:
+    return f"user_{user_id}"
+
+def chat_collection(wclient, user_id):
+    """The chat memory collection scoped to `user_id`'s tenant."""
+    name = tenant_name(user_id)
+    _tenant_last_used[name] = time.monotonic()
+    return wclient.collections.get(settings.CHAT_MEMORY_COLLECTION).with_tenant(name)
+
+def ensure_chat_collection(wclient):
+    from weaviate.classes.config import Configure, Property, DataType
+    if wclient.collections.exists(settings.CHAT_MEMORY_COLLECTION):
+        return
+    logger.info(f"Creating multi-tenant collection {settings.CHAT_MEMORY_COLLECTION}")
+    wclient.collections.create(
+        settings.CHAT_MEMORY_COLLECTION,
+        vectorizer_config=[
+            Configure.NamedVectors.text2vec_transformers(
+                name="text_vector",
+                source_properties=["text"]
+            )
+        ],
+        multi_tenancy_config=Configure.multi_tenancy(
+            enabled=True,
+            auto_tenant_creation=True,
+            auto_tenant_activation=True
+        ),
+        properties=[
+            Property(name="text", data_type=DataType.TEXT),
+            Property(name="user_id", data_type=DataType.TEXT),
+            Property(name="timestamp", data_type=DataType.DATE),
+        ]
+    )
+
+def ensure_file_collection(wclient):
+    from weaviate.classes.config import Configure, Property, DataType, Tokenization
+    if wclient.collections.exists(settings.FILE_INFO_COLLECTION):
+        return
+    logger.info(f"Creating collection {settings.FILE_INFO_COLLECTION}")
+    wclient.collections.create(
+        settings.FILE_INFO_COLLECTION,
+        vectorizer_config=[
+            Configure.NamedVectors.text2vec_transformers(
+                name="text_vector",
+                source_properties=["filename", "filedetail"]
+            )
+        ],
+        properties=[
+            Property(name="filename", data_type=DataType.TEXT, tokenization=Tokenization.FIELD),
+            Property(name="filedetail", data_type=DataType.TEXT),  # One chunk of the extracted text
+            Property(name="user_id", data_type=DataType.TEXT, tokenization=Tokenization.FIELD),
+            Property(name="media_id", data_type=DataType.INT),
+            Property(name="content_hash", data_type=DataType.TEXT, tokenization=Tokenization.FIELD),
+            Property(name="chunk_index", data_type=DataType.INT),
+            Property(name="timestamp", data_type=DataType.DATE),
+        ]
+    )
+
+def deactivate_idle_tenants(wclient, idle_seconds, status="INACTIVE", prune_before: datetime = None):
+    """
+    Move ACTIVE tenants unused for `idle_seconds` to INACTIVE (or OFFLOADED).
+    Tenants never touched by this process count as used at startup. With
+    `prune_before`, memories older than it are deleted from each tenant not
+    yet pruned that far before it is moved. Returns the number of tenants moved.
+    """
+    from weaviate.classes.query import Filter
+    from weaviate.classes.tenants import TenantActivityStatus
+    cutoff = time.monotonic() - idle_seconds
+    memories = wclient.collections.get(settings.CHAT_MEMORY_COLLECTION)
+    tenants = memories.tenants
+    idle = [
+        name for name, tenant in tenants.get().items()
+        if tenant.activity_status == TenantActivityStatus.ACTIVE
+        and _tenant_last_used.get(name, _started_at) < cutoff
+    ]
+    if not idle:
+        return 0
+    if prune_before is not None:
+        where = Filter.by_property("timestamp").less_than(prune_before)
+        for name in idle:
+            if _tenant_pruned_through.get(name) != prune_before:
+                memories.with_tenant(name).data.delete_many(where=where)
+                _tenant_pruned_through[name] = prune_before
+    if status == "OFFLOADED":
+        tenants.offload(idle)
+    else:
+        tenants.deactivate(idle)
+    for name in idle:
+        _tenant_last_used.pop(name, None)
+    return len(idle)
+
+def prune_memories_before(wclient, cutoff: datetime) -> int:
+    """
+    Delete memories older than `cutoff` from every ACTIVE user tenant, and
+    from the pre-tenancy collection while it still exists. Cold tenants are
+    not woken up for it: a cold tenant is only read again after use brings it
+    back, and the idle sweep prunes it before it goes cold again. Returns the
+    number deleted.
+    """
+    from weaviate.classes.query import Filter
+    from weaviate.classes.tenants import TenantActivityStatus
+    where = Filter.by_property("timestamp").less_than(cutoff)
+    memories = wclient.collections.get(settings.CHAT_MEMORY_COLLECTION)
+    deleted = 0
+    for name, tenant in memories.tenants.get().items():
+        if tenant.activity_status == TenantActivityStatus.ACTIVE:
+            deleted += memories.with_tenant(name).data.delete_many(where=where).successful
+            _tenant_pruned_through[name] = cutoff
+    if wclient.collections.exists(settings.LEGACY_CHAT_COLLECTION):
+        deleted += wclient.collections.get(settings.LEGACY_CHAT_COLLECTION).data.delete_many(where=where).successful
+    return deleted
+
+def memory_retention_cutoff(now: datetime = None):
+    """Timestamp memories must be newer than under CHAT_RETENTION_MONTHS, or None when all are kept."""
+    if settings.CHAT_RETENTION_MONTHS <= 0:
+        return None
+    from backend.services.chat_retention import retention_cutoff  # imports this module
+    cutoff = retention_cutoff(now or datetime.now(timezone.utc), settings.CHAT_RETENTION_MONTHS)
+    return datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc)
+
+async def _tenant_sweeper():
+    while True:
+        await asyncio.sleep(settings.WEAVIATE_TENANT_SWEEP_INTERVAL)
+        try:
+            moved = await run_in_weaviate_executor(
+                deactivate_idle_tenants,
+                get_weaviate_client(),
+                settings.WEAVIATE_TENANT_IDLE_SECONDS,
+                settings.WEAVIATE_TENANT_IDLE_STATUS,
+                memory_retention_cutoff()
+            )
+            if moved:
+                logger.info(f"Moved {moved} idle chat tenants to {settings.WEAVIATE_TENANT_IDLE_STATUS}")
+        except Exception as e:
+            logger.warning(f"Weaviate tenant sweep error: {e}")
+
+def start_tenant_sweeper():
+    global _tenant_sweep_task
+    if _tenant_sweep_task is None:
+        _tenant_sweep_task = asyncio.create_task(_tenant_sweeper())
+
+async def stop_tenant_sweeper():
+    global _tenant_sweep_task
+    if _tenant_sweep_task is not None:
+        _tenant_sweep_task.cancel()
+        await asyncio.gather(_tenant_sweep_task, return_exceptions=True)
+        _tenant_sweep_task = None
+
+def connect_weaviate():
+    """One connection attempt plus schema setup; raises if Weaviate is not reachable."""
     global client
-    logger.info("Setting up Weaviate schema...")  
+    import weaviate
+    wclient = weaviate.connect_to_local(host="weaviate", port=8080, skip_init_checks=True)
+    try:
+        ensure_chat_collection(wclient)
+        ensure_file_collection(wclient)
+    except Exception:
+        wclient.close()
+        raise
+    client = wclient
+    return client
+
+def setup_schema():
+    """Blocking connect with retries, for scripts; the app uses connect_weaviate via startup readiness."""
+    logger.info("Setting up Weaviate schema...")
     for i in range(10):
         try:
-            client = weaviate.connect_to_local(host="weaviate", port=8080, skip_init_checks=True)
-            break
+            return connect_weaviate()
         except Exception as e:
             logger.warning(f"Weaviate not ready, retrying in 5s... ({e})")
             time.sleep(5)
-    
-    # if "ChatMessage" not in client.collections.list_all():
-    #     client.collections.create(
-    #         "ChatMessage",
-    #         vectorizer_config=[
-    #             wvc.config.Configure.NamedVectors.text2vec_transformers(
-    #                 name="text_vector",
-    #                 source_properties=["text"]
-    #             )
-    #         ],
-    #         properties=[
-    #             Property(name="text", data_type=DataType.TEXT),
-    #             Property(name="user_id", data_type=DataType.TEXT),
-    #             Property(name="timestamp", data_type=DataType.DATE),
-    #         ]
-    #     )
-    
-    # if "FileInfo" not in client.collections.list_all():
-    #     client.collections.create(
-    #         "FileInfo",
-    #         properties=[
-    #             Property(name="filename", data_type=DataType.TEXT),
-    #             Property(name="filedetail", data_type=DataType.TEXT),
-    #             Property(name="user_id", data_type=DataType.TEXT),
-    #             Property(name="timestamp", data_type=DataType.DATE),
-    #         ]
-    #     )
+    raise RuntimeError("Weaviate did not become ready")
 
 def get_weaviate_client():
     if client is None:
@@ -52,7 +223,8 @@ def get_weaviate_client():
     return client
 
 async def save_message_to_weaviate(wclient, user_id, text):
-    wclient.collections.get("ChatMessage").data.insert(
+    await run_in_weaviate_executor(
+        chat_collection(wclient, user_id).data.insert,
         properties={
             "text": text,
             "user_id": str(user_id),
@@ -60,21 +232,114 @@ async def save_message_to_weaviate(wclient, user_id, text):
         }
     )
 
-async def search_relevant_messages(wclient, text, top_k=5):
+async def search_relevant_messages(wclient, user_id, text, top_k=5, raise_errors=False):
+    """
+    Semantic search over `user_id`'s own memories only. Errors are logged and
+    give no results unless `raise_errors` is set (see local_index.search_memories).
+    """
+    from weaviate.classes.query import MetadataQuery
     try:
-        relevant_objs = wclient.collections.get("ChatMessage").query.near_text(
+        relevant_objs = await run_in_weaviate_executor(
+            chat_collection(wclient, user_id).query.near_text,
             query=text,
             target_vector="text_vector",
-            limit=top_k
+            limit=top_k,
+            return_metadata=MetadataQuery(distance=True)
         )
         return relevant_objs.objects  # List of objects
     except Exception as e:
+        if raise_errors:
+            raise
         logger.warning(f"Weaviate semantic search error: {e}")
         return []
 
+def _document_filter(user_id, **equal):
+    from weaviate.classes.query import Filter
+    where = Filter.by_property("user_id").equal(str(user_id))
+    for name, value in equal.items():
+        where = where & Filter.by_property(name).equal(value)
+    return where
+
+def document_indexed(wclient, user_id, content_hash) -> bool:
+    """Whether `user_id` already has chunks of a file with this content hash."""
+    result = wclient.collections.get(settings.FILE_INFO_COLLECTION).query.fetch_objects(
+        filters=_document_filter(user_id, content_hash=content_hash), limit=1, return_properties=[]
+    )
+    return bool(result.objects)
+
+def document_chunk_uuid(user_id, content_hash, index):
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"fileinfo/{user_id}/{content_hash}/{index}")
+
+def replace_document_chunks(wclient, user_id, filename, media_id, content_hash, chunks) -> int:
+    """
+    Insert the chunks of one file, then delete chunks of earlier versions of
+    the same filename, so searches never see the file missing. Chunk UUIDs
+    derive from the content hash, so a retried insert overwrites instead of
+    duplicating. Returns the number of chunks written.
+    """
+    from weaviate.classes.data import DataObject
+    from weaviate.classes.query import Filter
+    files = wclient.collections.get(settings.FILE_INFO_COLLECTION)
+    timestamp = datetime.now(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+    batch_size = settings.DOCUMENT_INSERT_BATCH_SIZE
+    written = 0
+    for start in range(0, len(chunks), batch_size):
+        objects = [
+            DataObject(
+                properties={
+                    "filename": filename,
+                    "filedetail": chunk,
+                    "user_id": str(user_id),
+                    "media_id": media_id,
+                    "content_hash": content_hash,
+                    "chunk_index": index,
+                    "timestamp": timestamp,
+                },
+                uuid=document_chunk_uuid(user_id, content_hash, index),
+            )
+            for index, chunk in enumerate(chunks[start:start + batch_size], start)
+        ]
+        result = files.data.insert_many(objects)
+        if result.errors:
+            raise RuntimeError(f"Weaviate rejected {len(result.errors)} chunks of {filename}")
+        written += len(objects)
+    files.data.delete_many(
+        where=_document_filter(user_id, filename=filename) & Filter.by_property("content_hash").not_equal(content_hash)
+    )
+    return written
+
+def delete_document_chunks(wclient, user_id, **match) -> int:
+    """
+    Delete `user_id`'s chunks matching every given property (content_hash,
+    or media_id for media without one). Returns how many were removed.
+    """
+    files = wclient.collections.get(settings.FILE_INFO_COLLECTION)
+    result = files.data.delete_many(where=_document_filter(user_id, **match))
+    return result.successful
+
+async def search_documents(wclient, user_id, text, top_k=4, raise_errors=False):
+    """Semantic search over chunks of `user_id`'s own documents; same error handling as search_relevant_messages."""
+    from weaviate.classes.query import MetadataQuery
+    try:
+        result = await run_in_weaviate_executor(
+            wclient.collections.get(settings.FILE_INFO_COLLECTION).query.near_text,
+            query=text,
+            target_vector="text_vector",
+            filters=_document_filter(user_id),
+            limit=top_k,
+            return_metadata=MetadataQuery(distance=True)
+        )
+        return result.objects
+    except Exception as e:
+        if raise_errors:
+            raise
+        logger.warning(f"Weaviate document search error: {e}")
+        return []
+
 def shutdown():
     if client:
         client.close()
+    _executor.shutdown(wait=False, cancel_futures=True)
 
 
 from backend.models.chat import Chat
@@ -88,7 +353,7 @@ async def get_recent_messages(db, user_id, N=10):
     try:
         result = await db.execute(
             select(Chat)
-            .where(user_id == user_id)
+            .where(Chat.user_id == user_id)  # served by ix_chats_user_id_created_at
             .order_by(desc(Chat.created_at))
             .limit(N)
         )
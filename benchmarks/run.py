@@ -0,0 +1,305 @@
+"""
+End-to-end benchmark of the backend against local stand-ins.
+
+Starts a fake OpenAI server, then backend.main:app in a subprocess
+(benchmarks.server) with an in-memory Weaviate, an in-memory Google Drive
+and SQLite (or the Postgres given by --database-url), and drives each
+scenario with a fixed number of concurrent clients. Prints one JSON
+document with throughput, latency percentiles and peak server RSS per
+scenario.
+
+    python -m benchmarks.run --duration 10 --concurrency 16 --output bench.json
+    python -m benchmarks.run --scenarios chat,mixed --llm-latency 0.5
+
+SQLite needs aiosqlite (see benchmarks/requirements.txt).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import httpx
+
+from benchmarks.stubs import FakeOpenAIServer
+
+ADMIN = ("admin@example.com", "admin123")
+USER = ("bench@example.com", "bench-password")
+MESSAGES = [
+    "thanks!",
+    "Can we move our meeting to Thursday at 3pm?",
+    "Confirming the order, please send the invoice.",
+    "What did we agree on for the launch budget?",
+    "I'm out of office until Monday.",
+]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+class RssSampler:
+    """Samples VmRSS of a process (Linux /proc) and keeps the peak, in MiB."""
+
+    def __init__(self, pid, interval=0.05):
+        self._path = Path(f"/proc/{pid}/status")
+        self._interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        try:
+            for line in self._path.read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self._sample()
+            if rss is not None:
+                self.peak_mb = max(self.peak_mb or 0, rss)
+            self._stop.wait(self._interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Context:
+    def __init__(self, client, user_token, admin_token, media_ids, payload):
+        self.client = client
+        self.user_headers = {"Authorization": f"Bearer {user_token}"}
+        self.admin_headers = {"Authorization": f"Bearer {admin_token}"}
+        self.media_ids = media_ids
+        self.payload = payload
+
+
+async def req_login(ctx):
+    return await ctx.client.post("/api/v1/auth/login", data={"username": USER[0], "password": USER[1]})
+
+
+async def req_chat(ctx):
+    return await ctx.client.post("/api/v1/chat", json={"message": random.choice(MESSAGES)}, headers=ctx.user_headers)
+
+
+async def req_chat_stream(ctx):
+    async with ctx.client.stream(
+        "POST", "/api/v1/chat/stream", json={"message": random.choice(MESSAGES)}, headers=ctx.user_headers
+    ) as resp:
+        async for _ in resp.aiter_raw():
+            pass
+    return resp
+
+
+async def req_webhook(ctx):
+    return await ctx.client.post(
+        "/api/v1/n8n/webhook",
+        json={"email": f"Bench User <{USER[0]}>", "message": random.choice(MESSAGES)},
+    )
+
+
+async def req_upload(ctx):
+    return await ctx.client.post(
+        "/api/v1/media/upload",
+        files=[("files", (f"bench-{random.randrange(10**9)}.bin", ctx.payload, "application/octet-stream"))],
+        headers=ctx.admin_headers,
+    )
+
+
+async def req_download(ctx):
+    media_id = random.choice(ctx.media_ids)
+    return await ctx.client.get(f"/api/v1/media/download/{media_id}", headers=ctx.admin_headers)
+
+
+async def req_history(ctx):
+    return await ctx.client.get("/api/v1/chat/history", headers=ctx.user_headers)
+
+
+SCENARIOS = {
+    "login": [(req_login, 1)],
+    "chat": [(req_chat, 1)],
+    "chat_stream": [(req_chat_stream, 1)],
+    "webhook": [(req_webhook, 1)],
+    "upload": [(req_upload, 1)],
+    "download": [(req_download, 1)],
+    "mixed": [
+        (req_chat, 30), (req_webhook, 30), (req_history, 15),
+        (req_download, 15), (req_upload, 5), (req_login, 5),
+    ],
+}
+
+
+async def run_scenario(ctx, name, duration, concurrency):
+    requests, weights = zip(*SCENARIOS[name])
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            request = random.choices(requests, weights)[0]
+            started = time.perf_counter()
+            try:
+                resp = await request(ctx)
+                failed = resp.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - started)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+            "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+        },
+    }
+
+
+async def prepare(client, payload, seed_files):
+    await client.post("/api/v1/auth/register", json={"email": USER[0], "password": USER[1]})
+    user = await client.post("/api/v1/auth/login", data={"username": USER[0], "password": USER[1]})
+    admin = await client.post("/api/v1/auth/login", data={"username": ADMIN[0], "password": ADMIN[1]})
+    user.raise_for_status()
+    admin.raise_for_status()
+    admin_token = admin.json()["access_token"]
+    resp = await client.post(
+        "/api/v1/media/upload",
+        files=[("files", (f"seed-{i}.bin", payload, "application/octet-stream")) for i in range(seed_files)],
+        headers={"Authorization": f"Bearer {admin_token}"},
+    )
+    resp.raise_for_status()
+    return Context(client, user.json()["access_token"], admin_token, [m["id"] for m in resp.json()], payload)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(base_url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Benchmark server exited during startup")
+        try:
+            if httpx.get(f"{base_url}/readyz", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Benchmark server did not start")
+
+
+async def run_all(args, base_url, server_pid):
+    payload = os.urandom(args.file_size)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        ctx = await prepare(client, payload, args.seed_files)
+        results = []
+        for name in args.scenarios:
+            with RssSampler(server_pid) as rss:
+                result = await run_scenario(ctx, name, args.duration, args.concurrency)
+            result["peak_rss_mb"] = round(rss.peak_mb, 1) if rss.peak_mb else None
+            results.append(result)
+            print(f"{name}: {result['throughput_rps']} req/s, p99 {result['latency_ms']['p99']} ms", file=sys.stderr)
+        return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Fake OpenAI time to first byte, seconds")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Fake OpenAI delay per token, seconds")
+    parser.add_argument("--drive-latency", type=float, default=0.05, help="Fake Drive delay per call, seconds")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="Bytes per uploaded/downloaded file")
+    parser.add_argument("--seed-files", type=int, default=5)
+    parser.add_argument("--database-url", help="Defaults to a temporary SQLite database")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    openai = FakeOpenAIServer(tokens=["word "] * 20, latency=args.llm_latency, token_delay=args.token_delay).start()
+    workdir = tempfile.TemporaryDirectory(prefix="ccc-bench-")
+    port = free_port()
+    env = dict(
+        os.environ,
+        BENCH_PORT=str(port),
+        BENCH_DRIVE_LATENCY=str(args.drive_latency),
+        DATABASE_URL=args.database_url or f"sqlite+aiosqlite:///{workdir.name}/bench.db",
+        OPENAI_BASE_URL=openai.base_url,
+        OPENAI_API_KEY="sk-bench",
+        JWT_SECRET_KEY="bench-secret",
+        MEDIA_CACHE_DIR=f"{workdir.name}/media-cache",
+    )
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.server"], env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_for_server(base_url, server)
+        results = asyncio.run(run_all(args, base_url, server.pid))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        openai.stop()
+        workdir.cleanup()
+
+    report = {
+        "config": {
+            "duration_s": args.duration,
+            "concurrency": args.concurrency,
+            "llm_latency_s": args.llm_latency,
+            "token_delay_s": args.token_delay,
+            "drive_latency_s": args.drive_latency,
+            "file_size": args.file_size,
+            "database": "postgres" if args.database_url else "sqlite",
+        },
+        "scenarios": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
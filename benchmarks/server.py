@@ -0,0 +1,38 @@
+"""
+Serve backend.main:app with the external services replaced by the stand-ins
+in benchmarks.stubs. Started as a subprocess by benchmarks.run so that the
+server's RSS can be measured on its own.
+
+Configuration comes from the environment: the usual backend settings
+(DATABASE_URL, OPENAI_BASE_URL, MEDIA_CACHE_DIR, ...) plus
+BENCH_PORT and BENCH_DRIVE_LATENCY (seconds per Drive call).
+"""
+import os
+
+import uvicorn
+
+from benchmarks.stubs import FakeDriveClient, InMemoryWeaviate
+
+
+def install_stubs():
+    import backend.main as main
+    from backend.services import gdrive_client, weaviate_service
+
+    store = InMemoryWeaviate()
+
+    def connect_weaviate():
+        weaviate_service.client = store
+        return store
+
+    main.connect_weaviate = connect_weaviate
+    gdrive_client._drive_client = FakeDriveClient(latency=float(os.environ.get("BENCH_DRIVE_LATENCY", "0")))
+    return main.app
+
+
+def main():
+    app = install_stubs()
+    uvicorn.run(app, host="127.0.0.1", port=int(os.environ["BENCH_PORT"]), log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
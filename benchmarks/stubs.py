@@ -0,0 +1,267 @@
+"""
+Local stand-ins for the backend's external services, shared by the
+benchmark suite and the tests:
+
+- FakeOpenAIServer: an HTTP /v1/chat/completions endpoint, streaming and
+  non-streaming, with configurable latency and injected errors (429s, 5xx).
+- FakeDriveClient: an in-memory drop-in for gdrive_client.DriveClient.
+- InMemoryWeaviate: just enough of the Weaviate v4 client for ChatMessage
+  inserts and near_text queries (scored by word overlap).
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+
+class _FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        model = body.get("model", "gpt-4o")
+        with server.lock:
+            server.requests.append(body)
+            status = server.model_errors.get(model) or (server.errors.pop(0) if server.errors else None)
+            latency = server.latencies.pop(0) if server.latencies else server.latency
+        time.sleep(latency)
+        if status is not None:
+            payload = json.dumps({"error": {"message": f"injected {status}", "type": "fake", "code": None}}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            if status == 429 and server.retry_after is not None:
+                self.send_header("Retry-After", str(server.retry_after))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            try:
+                for token in server.tokens:
+                    time.sleep(server.token_delay)
+                    chunk = {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                server.completed_streams += 1
+            except (BrokenPipeError, ConnectionResetError):
+                server.aborted_streams += 1
+            return
+        time.sleep(server.token_delay * len(server.tokens))
+        payload = json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(server.tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": 10,
+                "completion_tokens": len(server.tokens),
+                "total_tokens": 10 + len(server.tokens),
+            },
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    `latency` delays every response before the first byte; `token_delay`
+    spaces out streamed tokens (and adds up for non-streaming replies).
+
+    Fault injection: `errors` is a list of HTTP statuses answered to the next
+    requests, in order; `model_errors` maps a model to a status it always
+    gets; `latencies` overrides `latency` for the next requests, in order.
+    429s carry `Retry-After: retry_after` unless it is None.
+    """
+    daemon_threads = True
+
+    def __init__(self, tokens=None, latency=0.0, token_delay=0.0):
+        super().__init__(("127.0.0.1", 0), _FakeOpenAIHandler)
+        self.tokens = tokens or ["Hello", ", ", "world", "!"]
+        self.latency = latency
+        self.token_delay = token_delay
+        self.requests = []
+        self.errors = []
+        self.model_errors = {}
+        self.latencies = []
+        self.retry_after = None
+        self.lock = threading.Lock()
+        self.completed_streams = 0
+        self.aborted_streams = 0
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeDriveService:
+    """In-memory subset of the Drive v3 `files()` resource."""
+
+    def __init__(self):
+        self.files_by_id = {}
+        self.lock = threading.Lock()
+
+    def files(self):
+        return self
+
+    def create(self, body, media_body, fields, supportsAllDrives):
+        def execute():
+            data = media_body.getbytes(0, media_body.size())
+            file_id = uuid.uuid4().hex
+            with self.lock:
+                self.files_by_id[file_id] = {
+                    "name": body["name"],
+                    "content": data,
+                    "modifiedTime": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+                }
+            return {"id": file_id, "size": str(len(data))}
+        return SimpleNamespace(execute=execute)
+
+    def get(self, fileId, fields=None, supportsAllDrives=True):
+        def execute():
+            entry = self.files_by_id[fileId]
+            return {
+                "id": fileId,
+                "name": entry["name"],
+                "size": str(len(entry["content"])),
+                "md5Checksum": hashlib.md5(entry["content"]).hexdigest(),
+                "modifiedTime": entry["modifiedTime"],
+            }
+        return SimpleNamespace(execute=execute)
+
+    def get_media(self, fileId, supportsAllDrives=True):
+        request = SimpleNamespace(headers={})
+
+        def execute():
+            content = self.files_by_id[fileId]["content"]
+            byte_range = request.headers.get("range")
+            if not byte_range:
+                return content
+            first, last = byte_range.split("=")[1].split("-")
+            return content[int(first):int(last) + 1]
+
+        request.execute = execute
+        return request
+
+    def update(self, fileId, body, supportsAllDrives=True):
+        def execute():
+            self.files_by_id[fileId]["name"] = body["name"]
+            return {"id": fileId}
+        return SimpleNamespace(execute=execute)
+
+    def delete(self, fileId, supportsAllDrives=True):
+        def execute():
+            with self.lock:
+                self.files_by_id.pop(fileId, None)
+        return SimpleNamespace(execute=execute)
+
+
+class FakeDriveClient:
+    """Drop-in for DriveClient; `latency` is added to every Drive call."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._service = FakeDriveService()
+
+    def service(self):
+        return self._service
+
+    def credentials(self):
+        return SimpleNamespace(token="fake-token", valid=True)
+
+    async def run(self, fn):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await asyncio.to_thread(fn, self._service)
+
+    def close(self):
+        pass
+
+
+class _InMemoryCollection:
+    def __init__(self):
+        self.objects = []
+        self.lock = threading.Lock()
+        self.data = SimpleNamespace(insert=self._insert, insert_many=self._insert_many)
+        self.query = SimpleNamespace(near_text=self._near_text)
+        self.tenants = SimpleNamespace(get=dict)  # tenants are never reported idle
+        self._tenants = {}
+
+    def with_tenant(self, name):
+        with self.lock:
+            return self._tenants.setdefault(name, _InMemoryCollection())
+
+    def _insert(self, properties, **kwargs):
+        with self.lock:
+            self.objects.append(SimpleNamespace(uuid=uuid.uuid4(), properties=dict(properties)))
+
+    def _insert_many(self, objects):
+        for obj in objects:
+            self._insert(obj.properties)
+        return SimpleNamespace(errors={})
+
+    def _near_text(self, query, limit=10, **kwargs):
+        words = set(query.lower().split())
+        scored = []
+        with self.lock:
+            for obj in self.objects:
+                overlap = len(words & set(obj.properties.get("text", "").lower().split()))
+                distance = 1.0 - overlap / (len(words) or 1)
+                scored.append((distance, obj))
+        scored.sort(key=lambda pair: pair[0])
+        return SimpleNamespace(objects=[
+            SimpleNamespace(uuid=obj.uuid, properties=obj.properties, metadata=SimpleNamespace(distance=distance))
+            for distance, obj in scored[:limit]
+        ])
+
+
+class InMemoryWeaviate:
+    def __init__(self):
+        self._collections = {}
+        self.collections = SimpleNamespace(get=self._get)
+
+    def _get(self, name):
+        return self._collections.setdefault(name, _InMemoryCollection())
+
+    def close(self):
+        pass
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from backend.api.v1.auth import get_current_user
+from backend.models.user import User
+from backend.services.auth_service import AuthService, Principal, principal_cache
+
+
+class CountingSession:
+    """Async session stand-in that serves users from a dict and counts lookups."""
+
+    def __init__(self, users):
+        self.users = users
+        self.queries = 0
+
+    async def execute(self, stmt):
+        self.queries += 1
+        email = stmt.whereclause.right.value
+        user = self.users.get(email)
+
+        class Result:
+            def scalars(self):
+                return self
+
+            def first(self):
+                return user
+
+        return Result()
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    principal_cache.clear()
+    yield
+    principal_cache.clear()
+
+
+def _token(email):
+    return AuthService.create_access_token({"sub": email}, role="user")
+
+
+def test_current_user_is_cached_by_subject():
+    db = CountingSession({"a@example.com": User(id=1, email="a@example.com", role="admin", is_active=True)})
+    token = _token("a@example.com")
+
+    async def scenario():
+        first = await get_current_user(token, db)
+        second = await get_current_user(token, db)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == second == Principal(id=1, email="a@example.com", role="admin", is_active=True)
+    assert db.queries == 1
+
+
+def test_inactive_user_is_rejected():
+    db = CountingSession({"a@example.com": User(id=1, email="a@example.com", role="user", is_active=False)})
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(get_current_user(_token("a@example.com"), db))
+    assert exc.value.status_code == 401
+
+
+def test_role_change_and_deactivation_invalidate_cache():
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    with Session(engine) as session:
+        user = User(email="a@example.com", hashed_password="x", role="user", is_active=True)
+        session.add(user)
+        session.commit()
+
+        principal_cache.put("a@example.com", Principal.from_user(user))
+        user.role = "admin"
+        session.commit()
+        assert principal_cache.get("a@example.com") is None
+
+        principal_cache.put("a@example.com", Principal.from_user(user))
+        user.is_active = False
+        session.commit()
+        assert principal_cache.get("a@example.com") is None
+
+
+def test_cache_is_only_invalidated_by_committed_changes():
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    with Session(engine) as session:
+        user = User(email="a@example.com", hashed_password="x", role="admin", is_active=True)
+        session.add(user)
+        session.commit()
+
+        principal_cache.put("a@example.com", Principal.from_user(user))
+        user.role = "user"
+        session.flush()
+        assert principal_cache.get("a@example.com") is not None  # Not committed yet
+        session.rollback()
+        assert principal_cache.get("a@example.com").role == "admin"
+
+        session.delete(user)
+        session.commit()
+        assert principal_cache.get("a@example.com") is None
+
+
+def test_password_hashing_runs_off_the_event_loop():
+    async def scenario():
+        hashed = await AuthService.hash_password_async("secret")
+        return await asyncio.gather(
+            AuthService.verify_password_async("secret", hashed),
+            AuthService.verify_password_async("wrong", hashed),
+        )
+
+    assert asyncio.run(scenario()) == [True, False]
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+import uvicorn
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.api.v1 import chat as chat_api
+from backend.api.v1.auth import get_current_user
+from backend.config import settings
+from backend.db import get_db
+from backend.services import agent_service, llm_gateway, metrics, response_cache
+
+
+class FakeSession:
+    def __init__(self):
+        self.added = []
+        self.commits = 0
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    async def commit(self):
+        self.commits += 1
+
+    async def refresh(self, obj):
+        obj.id = len(self.added)
+
+    async def rollback(self):
+        pass
+
+
+@pytest.fixture
+def chat_client(fake_openai, monkeypatch):
+    session = FakeSession()
+    saved = []
+
+    async def fake_recent(db, user_id, N=10):
+        return []
+
+    async def fake_search(wclient, user_id, text, top_k=5):
+        return []
+
+    async def fake_enqueue(entry):
+        saved.append((entry.user_id, entry.text))
+        return True
+
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", fake_openai.base_url)
+    monkeypatch.setattr(llm_gateway, "_gateway", None)
+    monkeypatch.setattr(agent_service, "wclient", object())
+    monkeypatch.setattr(agent_service, "get_recent_messages", fake_recent)
+    monkeypatch.setattr(agent_service, "search_memories", fake_search)
+    monkeypatch.setattr(agent_service, "search_documents", fake_search)
+    monkeypatch.setattr(agent_service, "enqueue_memory", fake_enqueue)
+
+    async def override_db():
+        yield session
+
+    app = FastAPI()
+    app.include_router(chat_api.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = override_db
+    app.dependency_overrides[get_current_user] = lambda: SimpleNamespace(id=1, email="u@example.com", role="user")
+    client = TestClient(app)
+    client.session = session
+    client.saved = saved
+    return client
+
+
+def parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_chat_stream_forwards_tokens_then_persists(chat_client, fake_openai):
+    resp = chat_client.post("/api/v1/chat/stream", json={"message": "hi"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+
+    events = parse_sse(resp.text)
+    tokens = [data["text"] for event, data in events if event == "token"]
+    assert tokens == fake_openai.tokens
+    assert events[-1][0] == "done"
+    assert events[-1][1]["text"] == "Hello, world!"
+
+    assert fake_openai.requests[0]["stream"] is True
+    assert chat_client.session.commits == 1
+    assert chat_client.session.added[0].response == "Hello, world!"
+    assert chat_client.saved == [(1, "Other:hi, me:Hello, world!")]
+
+
+def test_chat_non_streaming_unchanged(chat_client, fake_openai):
+    resp = chat_client.post("/api/v1/chat", json={"message": "hi"})
+    assert resp.status_code == 200
+    assert resp.json() == {"type": "text", "text": "Hello, world!", "media": None}
+
+
+def test_chat_stream_client_disconnect_cancels_upstream(chat_client, fake_openai):
+    # TestClient buffers the whole response, so run the app under a real server.
+    fake_openai.token_delay = 0.05
+    fake_openai.tokens = ["tok"] * 40
+    config = uvicorn.Config(chat_client.app, host="127.0.0.1", port=0, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        with httpx.stream("POST", f"http://127.0.0.1:{port}/api/v1/chat/stream", json={"message": "hi"}) as resp:
+            for line in resp.iter_lines():
+                if line.startswith("event: token"):
+                    break
+        deadline = time.time() + 5
+        while fake_openai.aborted_streams == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        assert fake_openai.aborted_streams == 1
+        assert fake_openai.completed_streams == 0
+        assert chat_client.session.commits == 0
+        assert chat_client.saved == []
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+
+def test_chat_degrades_when_vector_search_is_slow(chat_client, fake_openai, monkeypatch):
+    async def slow_search(wclient, user_id, text, top_k=5):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(settings, "VECTOR_SEARCH_TIMEOUT", 0.05)
+    monkeypatch.setattr(agent_service, "search_memories", slow_search)
+    started = time.monotonic()
+    resp = chat_client.post("/api/v1/chat", json={"message": "hi"})
+    assert resp.status_code == 200
+    assert resp.json()["text"] == "Hello, world!"
+    assert time.monotonic() - started < 2
+
+
+def test_chat_records_stage_timings(chat_client, fake_openai):
+    def counts():
+        return {key[0]: value[-1] for key, value in metrics.CHAT_STAGE_SECONDS.samples().items()}
+
+    before = counts()
+    assert chat_client.post("/api/v1/chat", json={"message": "hi"}).status_code == 200
+    after = counts()
+    for name in ("recent_history", "vector_search", "prompt_build", "llm", "db_commit"):
+        assert after[name] == before.get(name, 0) + 1
+
+
+def test_chat_answers_503_when_over_the_rate_limit(chat_client, fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_RPM_LIMIT", 1)
+    assert chat_client.post("/api/v1/chat", json={"message": "hi"}).status_code == 200
+    resp = chat_client.post("/api/v1/chat", json={"message": "hi again"})
+    assert resp.status_code == 503
+    assert int(resp.headers["retry-after"]) > 50
+    assert len(fake_openai.requests) == 1
+
+
+@pytest.fixture
+def length_tokenizer(monkeypatch):
+    monkeypatch.setattr(agent_service, "_encoding", False)
+
+
+def _recent(i):
+    return {"text": f"question {i}", "my_message": f"answer {i}", "timestamp": f"2024-01-{i:02d}", "source": "recent"}
+
+
+def _relevant(text, score, day=1):
+    return {"text": text, "timestamp": f"2023-06-{day:02d}", "score": score, "source": "relevant"}
+
+
+def test_prompt_static_prefix_comes_first(length_tokenizer):
+    a = agent_service.build_prompt([_recent(1)], "hello")
+    b = agent_service.build_prompt([_recent(2), _relevant("other", 0.9)], "something else")
+    assert a[0] == b[0] == {"role": "system", "content": agent_service.SYSTEM_INSTRUCTION}
+    assert a[-1] == {"role": "user", "content": "hello"}
+
+
+def test_prompt_dedups_relevant_against_recent(length_tokenizer):
+    history = [
+        _recent(1),
+        _relevant("Other:question 1, me:answer 1", 0.99),
+        _relevant("Deadline is  Friday", 0.8),
+        _relevant("deadline is friday", 0.7),
+    ]
+    context = agent_service.build_prompt(history, "hi")[1]["content"]
+    assert "Other:question 1" not in context
+    assert context.lower().count("deadline is") == 1
+
+
+def test_prompt_respects_token_budget(length_tokenizer):
+    history = [_recent(i) for i in range(1, 29)] + [
+        _relevant(f"memory {i} " + "x" * 200, score=i / 100, day=i) for i in range(1, 20)
+    ]
+    prompt = agent_service.build_prompt(history, "hi", token_budget=400)
+    total = sum(agent_service.count_tokens(m["content"]) for m in prompt)
+    assert total <= 400
+    context = prompt[1]["content"]
+    # Newest recent exchanges and best-scored memories survive truncation
+    assert "question 28" in context and "question 1," not in context
+    assert "memory 19 " in context and "memory 1 " not in context
+
+
+def test_prompt_includes_document_chunks(length_tokenizer):
+    def hit(distance, **properties):
+        return SimpleNamespace(properties=properties, metadata=SimpleNamespace(distance=distance))
+
+    prompt = agent_service._build_prompt_from(
+        [],
+        [hit(0.4, text="Other:hi, me:hello", timestamp="2024-01-01")],
+        "when is the launch?",
+        [hit(0.1, filename="plan.pdf", filedetail="Launch is on March 3", timestamp="2024-02-01")]
+    )
+    context = prompt[1]["content"]
+    assert "{[plan.pdf] Launch is on March 3, 2024-02-01}" in context
+    assert "Other:hi" in context
+
+
+def test_semantic_cache_skips_llm_for_near_duplicates(chat_client, fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "SEMANTIC_CACHE_ENABLED", True)
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "local")
+    monkeypatch.setattr(settings, "SEMANTIC_CACHE_THRESHOLD", 0.9)
+    monkeypatch.setattr(response_cache, "_response_cache", None)
+
+    with chat_client:  # one event loop for all requests, like a running server
+        first = chat_client.post("/api/v1/chat", json={"message": "Thanks, see you at the meeting!"})
+        second = chat_client.post("/api/v1/chat", json={"message": "thanks, see you at the meeting"})
+        third = chat_client.post("/api/v1/chat", json={"message": "Can you send the Q3 invoice?"})
+
+    assert first.json()["text"] == second.json()["text"] == "Hello, world!"
+    assert third.status_code == 200
+    assert len(fake_openai.requests) == 2
+    stats = response_cache.get_response_cache().stats
+    assert (stats.hits, stats.misses) == (1, 2)
+    # Cached replies are still recorded as chats
+    assert chat_client.session.commits == 3
+
+
+def test_semantic_cache_keeps_serving_repeats_of_the_same_context(chat_client, fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "SEMANTIC_CACHE_ENABLED", True)
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "local")
+    monkeypatch.setattr(settings, "SEMANTIC_CACHE_THRESHOLD", 0.9)
+    monkeypatch.setattr(response_cache, "_response_cache", None)
+
+    with chat_client:
+        for _ in range(4):
+            assert chat_client.post("/api/v1/chat", json={"message": "Is the server up?"}).status_code == 200
+
+    assert len(fake_openai.requests) == 1
+    stats = response_cache.get_response_cache().stats
+    assert (stats.hits, stats.misses) == (3, 1)
+
+
+def test_semantic_cache_misses_once_the_conversation_moved_on(chat_client, fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "SEMANTIC_CACHE_ENABLED", True)
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "local")
+    monkeypatch.setattr(settings, "SEMANTIC_CACHE_THRESHOLD", 0.9)
+    monkeypatch.setattr(response_cache, "_response_cache", None)
+
+    async def memories(wclient, user_id, text, top_k=5):
+        # Every saved exchange is relevant, so each one changes what the prompt is built from
+        return [SimpleNamespace(properties={"text": saved}, metadata=SimpleNamespace(distance=0.2))
+                for _, saved in chat_client.saved]
+
+    monkeypatch.setattr(agent_service, "search_memories", memories)
+    with chat_client:
+        for message in ("What did we decide?", "Can you send the Q3 invoice?", "What did we decide?"):
+            assert chat_client.post("/api/v1/chat", json={"message": message}).status_code == 200
+
+    assert len(fake_openai.requests) == 3
+    stats = response_cache.get_response_cache().stats
+    assert (stats.hits, stats.misses) == (0, 3)
@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+import json
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from backend.config import settings
+from backend.models import Base
+from backend.models.chat import Chat
+from backend.models.user import User
+from backend.services import chat_retention, weaviate_service
+
+
+def test_month_arithmetic_and_partition_names():
+    assert chat_retention.add_months(date(2026, 11, 1), 3) == date(2027, 2, 1)
+    assert chat_retention.add_months(date(2026, 1, 1), -1) == date(2025, 12, 1)
+    assert chat_retention.partition_name(date(2026, 3, 1)) == "chats_p2026_03"
+    assert chat_retention.partition_month("chats_p2026_03") == date(2026, 3, 1)
+    assert chat_retention.partition_month("chats_default") is None
+
+
+def test_only_whole_months_before_the_cutoff_expire():
+    cutoff = chat_retention.retention_cutoff(datetime(2026, 10, 17, tzinfo=timezone.utc), 6)
+    assert cutoff == date(2026, 4, 1)
+    names = ["chats_p2026_04", "chats_default", "chats_p2026_03", "chats_p2025_12", "chats_p2026_10"]
+    assert chat_retention.expired_partitions(names, cutoff) == ["chats_p2025_12", "chats_p2026_03"]
+
+
+def test_archive_query_writes_gzip_jsonl(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'chats.db'}")
+    path = tmp_path / "chats_p2024_01.jsonl.gz"
+    monkeypatch.setattr(settings, "EXPORT_BATCH_SIZE", 2)  # several batches
+
+    async def run():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(User.__table__.insert(), [{"id": 1, "email": "a@example.com", "hashed_password": "x"}])
+            await conn.execute(Chat.__table__.insert(), [
+                {"user_id": 1, "message": f"m{i}", "response": f"r{i}", "media_ids": [i],
+                 "created_at": datetime(2024, 1, 1 + i, tzinfo=timezone.utc)}
+                for i in range(5)
+            ])
+        async with engine.connect() as conn:
+            rows = await chat_retention.archive_query(
+                conn, f"SELECT {chat_retention.ARCHIVE_COLUMNS} FROM chats ORDER BY id", path
+            )
+        await engine.dispose()
+        return rows
+
+    assert asyncio.run(run()) == 5
+    with gzip.open(path, "rt") as fh:
+        lines = [json.loads(line) for line in fh]
+    assert [line["message"] for line in lines] == [f"m{i}" for i in range(5)]
+    assert set(lines[0]) == {"id", "user_id", "message", "response", "media_ids", "created_at"}
+    assert not path.with_name(path.name + ".tmp").exists()
+
+
+def test_partition_bounds_are_utc():
+    assert chat_retention.partition_bounds(date(2026, 12, 1)) == (
+        "FROM (timestamptz '2026-12-01 00:00:00+00') TO (timestamptz '2027-01-01 00:00:00+00')"
+    )
+
+
+def test_prune_deletes_old_memories_in_active_tenants(monkeypatch):
+    from weaviate.classes.tenants import TenantActivityStatus
+    calls = []
+
+    def tenant(status):
+        return SimpleNamespace(activity_status=status)
+
+    def delete_many(name):
+        return lambda where: calls.append(("delete", name)) or SimpleNamespace(successful=2)
+
+    tenants = SimpleNamespace(
+        get=lambda: {
+            "1": tenant(TenantActivityStatus.ACTIVE),
+            "2": tenant(TenantActivityStatus.INACTIVE),
+            "3": tenant(TenantActivityStatus.OFFLOADING),
+        },
+        activate=lambda names: calls.append(("activate", names)),
+        deactivate=lambda names: calls.append(("deactivate", names)),
+        offload=lambda names: calls.append(("offload", names)),
+    )
+    memories = SimpleNamespace(
+        tenants=tenants,
+        with_tenant=lambda name: SimpleNamespace(data=SimpleNamespace(delete_many=delete_many(name)))
+    )
+    wclient = SimpleNamespace(collections=SimpleNamespace(get=lambda name: memories, exists=lambda name: False))
+
+    monkeypatch.setattr(weaviate_service, "_tenant_pruned_through", {})
+    cutoff = datetime(2026, 4, 1, tzinfo=timezone.utc)
+    assert weaviate_service.prune_memories_before(wclient, cutoff) == 2
+    # Cold tenants are not woken up
+    assert calls == [("delete", "1")]
+
+    # Tenants are pruned before the idle sweep takes them out of memory, once per cutoff
+    tenants.get = lambda: {"1": tenant(TenantActivityStatus.ACTIVE), "2": tenant(TenantActivityStatus.ACTIVE)}
+    monkeypatch.setattr(weaviate_service, "_started_at", 0.0)
+    monkeypatch.setattr(weaviate_service, "_tenant_last_used", {})
+    calls.clear()
+    assert weaviate_service.deactivate_idle_tenants(wclient, idle_seconds=0, prune_before=cutoff) == 2
+    assert calls == [("delete", "2"), ("deactivate", ["1", "2"])]
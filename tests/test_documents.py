@@ -0,0 +1,180 @@
+import asyncio
+import hashlib
+import io
+from types import SimpleNamespace
+
+import pytest
+
+from backend.services import document_service, response_cache
+
+
+def make_pdf(text):
+    """A one-page PDF showing `text` in Helvetica."""
+    stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{o:010d} 00000 n \n".encode() for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+
+def test_chunks_respect_size_and_overlap():
+    text = " ".join(f"word{i:03d}" for i in range(200))  # 8 characters per word
+    chunks = document_service.chunk_text(text, size=100, overlap=20)
+    assert all(len(c) <= 100 for c in chunks)
+    assert chunks[0].split()[-2:] == chunks[1].split()[:2]
+    # Every word survives, in order, once the overlaps are removed
+    words = chunks[0].split()
+    for chunk in chunks[1:]:
+        words.extend(chunk.split()[2:])
+    assert words == text.split()
+    assert document_service.chunk_text("x" * 250, size=100, overlap=0) == ["x" * 100, "x" * 100, "x" * 50]
+    assert document_service.chunk_text("   ", size=100, overlap=20) == []
+
+
+def test_extracts_pdf_and_html(tmp_path):
+    pdf = tmp_path / "report.pdf"
+    pdf.write_bytes(make_pdf("Quarterly revenue grew"))
+    assert document_service.extract_text(pdf, "report.pdf", "application/pdf") == "Quarterly revenue grew"
+    page = tmp_path / "page.html"
+    page.write_bytes(b"<html><style>p {}</style><p>Fish &amp; chips</p></html>")
+    assert document_service.extract_text(page, "page.html", "text/html").split() == ["Fish", "&", "chips"]
+    assert document_service.is_extractable("notes.MD", None)
+    assert not document_service.is_extractable("photo.png", "image/png")
+
+
+def test_extraction_runs_in_the_process_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(document_service.settings, "DOCUMENT_EXTRACT_WORKERS", 1)
+    pdf = tmp_path / "report.pdf"
+    pdf.write_bytes(make_pdf("Quarterly revenue grew"))
+    pool = document_service._new_pool()
+    try:
+        chunks = pool.submit(document_service.extract_chunks, str(pdf), "report.pdf", "application/pdf", 10, 0).result()
+    finally:
+        pool.shutdown()
+    assert chunks == ["Quarterly", "revenue", "grew"]
+
+
+@pytest.fixture
+def indexer(tmp_path, monkeypatch):
+    """Runs index_document against a fake FileInfo store keyed by (user, content hash)."""
+    store = {}
+    media = {}  # store key -> media_id
+    cache = response_cache.SemanticResponseCache(threshold=0.9, ttl=60, max_entries=10, max_per_user=10)
+
+    def replace_chunks(wclient, user_id, filename, media_id, content_hash, chunks):
+        for key in [k for k in store if k[0] == user_id and store[k][0] == filename]:
+            del store[key]
+        store[(user_id, content_hash)] = (filename, chunks)
+        media[(user_id, content_hash)] = media_id
+        return len(chunks)
+
+    def delete_chunks(wclient, user_id, content_hash=None, media_id=None):
+        removed = 0
+        for key in [k for k in store if k[0] == user_id and (k[1] == content_hash or media.get(k) == media_id)]:
+            removed += len(store.pop(key)[1])
+        return removed
+
+    async def run_inline(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    monkeypatch.setattr(document_service, "get_weaviate_client", lambda: object())
+    monkeypatch.setattr(document_service, "run_in_weaviate_executor", run_inline)
+    monkeypatch.setattr(
+        document_service, "document_indexed", lambda wclient, user_id, content_hash: (user_id, content_hash) in store
+    )
+    monkeypatch.setattr(document_service, "replace_document_chunks", replace_chunks)
+    monkeypatch.setattr(document_service, "delete_document_chunks", delete_chunks)
+    monkeypatch.setattr(document_service, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(document_service.settings, "DOCUMENT_STAGING_DIR", tmp_path / "staging")
+    monkeypatch.setattr(document_service.settings, "DOCUMENT_CHUNK_SIZE", 1000)
+
+    def index(user_id, filename, content, media_id=1):
+        path = tmp_path / "upload"
+        content_hash = document_service.stage_file(io.BytesIO(content), path)
+        job = document_service.DocumentJob(user_id, media_id, filename, "text/plain", path, content_hash)
+        return asyncio.run(document_service.index_document(job))
+
+    return SimpleNamespace(index=index, store=store, cache=cache)
+
+
+def test_reuploads_are_incremental(indexer):
+    assert indexer.index(1, "notes.txt", b"first version") == "indexed"
+    key = indexer.cache.context_key(1, "prompt")
+    assert indexer.index(1, "notes.txt", b"first version") == "unchanged"
+    assert indexer.cache.context_key(1, "prompt") == key
+    assert indexer.index(1, "notes.txt", b"second version") == "indexed"
+    assert indexer.cache.context_key(1, "prompt") != key
+    assert indexer.store == {(1, hashlib.sha256(b"second version").hexdigest()): ("notes.txt", ["second version"])}
+    # Same content for another user is that user's own document
+    assert indexer.index(2, "notes.txt", b"second version") == "indexed"
+    assert indexer.index(2, "empty.txt", b"  \n") == "empty"
+
+
+def test_deleted_media_leaves_search_and_the_reply_cache(indexer):
+    indexer.index(1, "notes.txt", b"keep me", media_id=1)
+    indexer.index(1, "plan.txt", b"delete me", media_id=2)
+    indexer.index(2, "plan.txt", b"delete me", media_id=2)
+    key = indexer.cache.context_key(1, "prompt")
+
+    asyncio.run(document_service.forget_media(1, 2, hashlib.sha256(b"delete me").hexdigest()))
+    assert sorted(indexer.store) == [(1, hashlib.sha256(b"keep me").hexdigest()), (2, hashlib.sha256(b"delete me").hexdigest())]
+    assert indexer.cache.context_key(1, "prompt") != key
+    # Media without a content hash are matched by id
+    asyncio.run(document_service.forget_media(1, 1))
+    assert sorted(indexer.store) == [(2, hashlib.sha256(b"delete me").hexdigest())]
+
+
+def test_files_stored_on_drive_are_downloaded_by_the_indexer(indexer, tmp_path, monkeypatch):
+    from backend.services.media_service import MediaService
+    downloads = []
+
+    async def download(gdrive_id):
+        downloads.append(gdrive_id)
+        return b"from drive"
+
+    monkeypatch.setattr(MediaService, "download_from_gdrive", download)
+    content_hash = hashlib.sha256(b"from drive").hexdigest()
+    job = document_service.DocumentJob(1, 5, "big.txt", "text/plain", tmp_path / "big", content_hash, "g-big")
+    assert asyncio.run(document_service.index_document(job)) == "indexed"
+    assert indexer.store[(1, content_hash)] == ("big.txt", ["from drive"])
+    # Content already indexed is not downloaded again
+    job = document_service.DocumentJob(1, 6, "copy.txt", "text/plain", tmp_path / "copy", content_hash, "g-big")
+    assert asyncio.run(document_service.index_document(job)) == "unchanged"
+    assert downloads == ["g-big"]
+
+
+def test_uploads_are_staged_while_hashed_and_queued(tmp_path, monkeypatch):
+    monkeypatch.setattr(document_service.settings, "DOCUMENT_STAGING_DIR", tmp_path)
+    upload = SimpleNamespace(filename="a.txt", content_type="text/plain", size=5, file=io.BytesIO(b"hello"))
+    image = SimpleNamespace(filename="a.png", content_type="image/png", size=5, file=io.BytesIO(b"hello"))
+
+    async def run():
+        monkeypatch.setattr(document_service, "_queue", asyncio.Queue(maxsize=1))
+        staged = [await document_service.stage_upload(f) for f in (upload, image, upload)]
+        queued = [
+            await document_service.submit_upload(1, media_id, f, h, path)
+            for media_id, f, (h, path) in zip((7, 8, 9), (upload, image, upload), staged)
+        ]  # the last one finds the queue full
+        return staged, queued, document_service._queue.get_nowait()
+
+    staged, queued, job = asyncio.run(run())
+    assert [h for h, _ in staged] == [hashlib.sha256(b"hello").hexdigest()] * 3
+    assert staged[1][1] is None and upload.file.tell() == 0  # rewound for the Drive upload
+    assert queued == [True, False, False]
+    assert job.media_id == 7 and job.content_hash == hashlib.sha256(b"hello").hexdigest()
+    assert job.path.read_bytes() == b"hello"
+    assert list(tmp_path.iterdir()) == [job.path]
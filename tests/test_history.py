@@ -0,0 +1,95 @@
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.api.v1 import chat as chat_api
+from backend.api.v1 import media as media_api
+from backend.api.v1.auth import get_current_user
+from backend.db import get_db
+from backend.models import Base
+from backend.models.chat import Chat
+from backend.models.media import Media
+from backend.models.user import User
+
+
+@pytest.fixture
+def history_client(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'history.db'}")
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    async def startup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with Session() as session:
+            session.add_all([
+                User(id=1, email="admin@example.com", hashed_password="x", role="admin"),
+                User(id=2, email="b@example.com", hashed_password="x"),
+            ])
+            session.add_all(
+                Chat(user_id=1 + i % 2, message=f"m{i}", response=f"r{i}", media_ids=[i] if i % 3 == 0 else [],
+                     created_at=base + timedelta(minutes=i))
+                for i in range(25)
+            )
+            session.add_all(
+                Media(user_id=2, filename=f"f{i}.png", filetype="image/png", gdrive_id=f"g{i}", file_size=i,
+                      created_at=base + timedelta(minutes=i))
+                for i in range(5)
+            )
+            await session.commit()
+
+    async def override_db():
+        async with Session() as session:
+            yield session
+
+    monkeypatch.setattr(chat_api, "AsyncSessionLocal", Session)
+    monkeypatch.setattr(media_api, "AsyncSessionLocal", Session)
+    app = FastAPI(on_startup=[startup], on_shutdown=[engine.dispose])
+    app.include_router(chat_api.router, prefix="/api/v1")
+    app.include_router(media_api.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = override_db
+    app.dependency_overrides[get_current_user] = lambda: SimpleNamespace(id=1, email="admin@example.com", role="admin")
+    with TestClient(app) as client:
+        yield client
+
+
+def test_history_pages_return_typed_rows(history_client):
+    first = history_client.get("/api/v1/chat/history?limit=5")
+    assert first.status_code == 200
+    assert first.headers["content-type"] == "application/json"
+    page = first.json()
+    assert [c["message"] for c in page] == ["m16", "m18", "m20", "m22", "m24"]
+    assert page[0] == {
+        "id": page[0]["id"], "message": "m16", "response": "r16", "media_ids": [], "created_at": page[0]["created_at"]
+    }
+    assert page[-1]["media_ids"] == [24]
+    assert datetime.fromisoformat(page[-1]["created_at"].replace("Z", "+00:00")).minute == 24
+
+    second = history_client.get(f"/api/v1/chat/history?limit=5&cursor={first.headers['x-next-cursor']}")
+    assert [c["message"] for c in second.json()] == ["m6", "m8", "m10", "m12", "m14"]
+
+
+def test_history_export_streams_every_chat_as_ndjson(history_client, monkeypatch):
+    monkeypatch.setattr(chat_api.settings, "EXPORT_BATCH_SIZE", 4)
+    resp = history_client.get("/api/v1/chat/history/export")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in resp.text.splitlines()]
+    assert [r["message"] for r in rows] == [f"m{i}" for i in range(0, 25, 2)]
+    assert rows[3]["media_ids"] == [6]
+
+
+def test_media_list_and_export(history_client):
+    listed = history_client.get("/api/v1/media/list?limit=2")
+    assert [m["filename"] for m in listed.json()] == ["f4.png", "f3.png"]
+    assert listed.json()[0]["owner"] == "b@example.com"
+    assert "x-next-cursor" in listed.headers
+
+    exported = history_client.get("/api/v1/media/export?filetype=image/png")
+    assert [json.loads(line)["gdrive_id"] for line in exported.text.splitlines()] == ["g4", "g3", "g2", "g1", "g0"]
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from backend.services.idempotency import (
+    IdempotencyGuard,
+    IdempotencyInProgress,
+    MemoryResultStore,
+    webhook_idempotency_key,
+)
+
+
+class SharedStore(MemoryResultStore):
+    """MemoryResultStore with a real lock, standing in for Redis shared by two processes."""
+
+    def __init__(self):
+        super().__init__(max_entries=100)
+        self.locks = set()
+
+    async def acquire(self, key):
+        if key in self.locks:
+            return False
+        self.locks.add(key)
+        return True
+
+    async def release(self, key):
+        self.locks.discard(key)
+
+
+def test_concurrent_duplicates_share_one_computation():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"text": "hi"}
+
+    async def scenario():
+        guard = IdempotencyGuard(MemoryResultStore(max_entries=10), wait_timeout=1)
+        results = await asyncio.gather(*(guard.run("k", compute, ttl=60) for _ in range(3)))
+        later = await guard.run("k", compute, ttl=60)
+        return results, later
+
+    results, later = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert [replayed for _, replayed in results] == [False, True, True]
+    assert later == ({"text": "hi"}, True)
+
+
+def test_failures_are_not_stored():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("llm down")
+        return {"ok": True}
+
+    async def scenario():
+        guard = IdempotencyGuard(MemoryResultStore(max_entries=10), wait_timeout=1)
+        with pytest.raises(RuntimeError):
+            await guard.run("k", flaky, ttl=60)
+        return await guard.run("k", flaky, ttl=60)
+
+    assert asyncio.run(scenario()) == ({"ok": True}, False)
+
+
+def test_duplicate_in_another_process_waits_for_the_result():
+    store = SharedStore()
+
+    async def slow():
+        await asyncio.sleep(0.1)
+        return {"n": 1}
+
+    async def never():
+        raise AssertionError("duplicate must not compute")
+
+    async def scenario():
+        # Two guards are two processes sharing the store
+        first = IdempotencyGuard(store, wait_timeout=1, poll_interval=0.01)
+        second = IdempotencyGuard(store, wait_timeout=1, poll_interval=0.01)
+        leader = asyncio.create_task(first.run("k", slow, ttl=60))
+        await asyncio.sleep(0.02)
+        return await asyncio.gather(leader, second.run("k", never, ttl=60))
+
+    assert asyncio.run(scenario()) == [({"n": 1}, False), ({"n": 1}, True)]
+
+
+def test_waiting_on_another_process_times_out():
+    store = SharedStore()
+    store.locks.add("k")
+    guard = IdempotencyGuard(store, wait_timeout=0.05, poll_interval=0.01)
+
+    async def compute():
+        return {}
+
+    with pytest.raises(IdempotencyInProgress):
+        asyncio.run(guard.run("k", compute, ttl=60))
+
+
+def test_content_keys_expire_sooner_than_delivery_ids():
+    by_id, id_ttl = webhook_idempotency_key(None, "a@example.com", "thanks", "msg-1")
+    by_content, content_ttl = webhook_idempotency_key(None, "a@example.com", "thanks")
+    assert by_id != by_content
+    assert content_ttl < id_ttl
+    assert webhook_idempotency_key(None, "b@example.com", "thanks")[0] != by_content
@@ -0,0 +1,170 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from backend.config import settings
+from backend.models.memory_outbox import MemoryOutbox
+from backend.services import ingest_service, weaviate_service
+
+
+class FakeCollection:
+    def __init__(self, fail_first=0):
+        self.batches = []
+        self.tenants = []
+        self.fail_first = fail_first
+
+    def with_tenant(self, name):
+        def insert_many(objects):
+            if self.fail_first:
+                self.fail_first -= 1
+                raise ConnectionError("weaviate unavailable")
+            self.batches.append([obj.properties for obj in objects])
+            self.tenants.append(name)
+            return SimpleNamespace(errors={})
+        return SimpleNamespace(data=SimpleNamespace(insert_many=insert_many))
+
+
+class FakeSession:
+    statements = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt):
+        FakeSession.statements.append(stmt)
+
+    async def commit(self):
+        pass
+
+
+@pytest.fixture
+def ingest(monkeypatch):
+    collection = FakeCollection()
+    wclient = SimpleNamespace(collections=SimpleNamespace(get=lambda name: collection))
+    FakeSession.statements = []
+    monkeypatch.setattr(ingest_service, "get_weaviate_client", lambda: wclient)
+    monkeypatch.setattr(ingest_service, "AsyncSessionLocal", FakeSession)
+    monkeypatch.setattr(settings, "MEMORY_INGEST_BATCH_SIZE", 3)
+    monkeypatch.setattr(settings, "MEMORY_INGEST_FLUSH_INTERVAL", 0.05)
+    monkeypatch.setattr(settings, "MEMORY_INGEST_RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(settings, "MEMORY_OUTBOX_SWEEP_INTERVAL", 3600)
+    monkeypatch.setattr(ingest_service, "sweep_outbox", _no_sweep)
+    return collection
+
+
+async def _no_sweep(limit=None):
+    return 0
+
+
+def _entry(i, user_id=1):
+    entry = MemoryOutbox(user_id=user_id, text=f"m{i}", timestamp=datetime(2024, 1, 1, tzinfo=timezone.utc))
+    entry.id = i
+    return entry
+
+
+def test_memories_are_batched_and_flushed_on_shutdown(ingest):
+    async def scenario():
+        ingest_service.start_ingest_worker()
+        for i in range(1, 6):
+            assert await ingest_service.enqueue_memory(_entry(i))
+        await ingest_service.stop_ingest_worker()
+
+    asyncio.run(scenario())
+    assert [[p["text"] for p in batch] for batch in ingest.batches] == [["m1", "m2", "m3"], ["m4", "m5"]]
+    assert ingest.batches[0][0]["timestamp"] == "2024-01-01T00:00:00Z"
+    # One outbox delete per successful batch
+    assert len(FakeSession.statements) == 2
+
+
+def test_failed_batches_are_retried(ingest):
+    ingest.fail_first = 2
+
+    async def scenario():
+        ingest_service.start_ingest_worker()
+        await ingest_service.enqueue_memory(_entry(1))
+        await ingest_service.stop_ingest_worker()
+
+    asyncio.run(scenario())
+    assert [[p["text"] for p in batch] for batch in ingest.batches] == [["m1"]]
+
+
+def test_memories_are_written_to_their_owners_tenant(ingest):
+    async def scenario():
+        ingest_service.start_ingest_worker()
+        for i, user_id in [(1, 7), (2, 8), (3, 7)]:
+            await ingest_service.enqueue_memory(_entry(i, user_id))
+        await ingest_service.stop_ingest_worker()
+
+    asyncio.run(scenario())
+    written = dict(zip(ingest.tenants, ([p["text"] for p in batch] for batch in ingest.batches)))
+    assert written == {"user_7": ["m1", "m3"], "user_8": ["m2"]}
+    assert len(FakeSession.statements) == 1
+
+
+def test_memories_reach_the_local_index_while_weaviate_is_down(ingest, tmp_path, monkeypatch):
+    from backend.services import local_index
+    from backend.services.embedding_service import embed_local
+
+    ingest.fail_first = 100
+    monkeypatch.setattr(settings, "MEMORY_INGEST_MAX_RETRIES", 0)
+    monkeypatch.setattr(settings, "LOCAL_INDEX_MODE", "failover")
+    monkeypatch.setattr(settings, "LOCAL_INDEX_DIR", tmp_path)
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "local")
+    monkeypatch.setattr(local_index, "_local_index", None)
+
+    async def scenario():
+        ingest_service.start_ingest_worker()
+        await ingest_service.enqueue_memory(_entry(1, user_id=7))
+        await ingest_service.stop_ingest_worker()
+
+    asyncio.run(scenario())
+    assert ingest.batches == []
+    assert local_index.get_local_index().search(7, embed_local("m1"))[0].properties["text"] == "m1"
+
+
+def test_recent_messages_are_filtered_by_user():
+    class RecordingSession:
+        async def execute(self, stmt):
+            self.stmt = stmt
+            return SimpleNamespace(scalars=lambda: SimpleNamespace(all=list))
+
+    db = RecordingSession()
+    asyncio.run(weaviate_service.get_recent_messages(db, 42, N=5))
+    compiled = db.stmt.compile()
+    assert "chats.user_id = :user_id_1" in str(compiled)
+    assert compiled.params["user_id_1"] == 42
+
+
+def test_enqueue_without_worker_defers_to_outbox():
+    assert asyncio.run(ingest_service.enqueue_memory(_entry(1))) is False
+
+
+def test_idle_tenants_are_deactivated(monkeypatch):
+    from weaviate.classes.tenants import TenantActivityStatus
+
+    moved = []
+    tenants = SimpleNamespace(
+        get=lambda: {
+            name: SimpleNamespace(activity_status=status)
+            for name, status in [
+                ("user_1", TenantActivityStatus.ACTIVE),
+                ("user_2", TenantActivityStatus.ACTIVE),
+                ("user_3", TenantActivityStatus.INACTIVE),
+            ]
+        },
+        deactivate=moved.extend,
+    )
+    wclient = SimpleNamespace(collections=SimpleNamespace(get=lambda name: SimpleNamespace(tenants=tenants)))
+    monkeypatch.setattr(weaviate_service, "_started_at", 0.0)
+    monkeypatch.setattr(weaviate_service, "_tenant_last_used", {})
+    weaviate_service.chat_collection(
+        SimpleNamespace(collections=SimpleNamespace(get=lambda name: SimpleNamespace(with_tenant=lambda t: None))), 2
+    )
+
+    assert weaviate_service.deactivate_idle_tenants(wclient, idle_seconds=60) == 1
+    assert moved == ["user_1"]
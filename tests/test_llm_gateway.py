@@ -0,0 +1,178 @@
+import asyncio
+import time
+
+import pytest
+from openai import AsyncOpenAI, RateLimitError
+
+from backend.config import settings
+from backend.services import llm_gateway
+from backend.services.llm_gateway import LLMGateway, LLMOverloaded, TokenBucket
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(settings, "LLM_MAX_RETRIES", 2)
+
+
+def run(fake_openai, scenario, **options):
+    async def main():
+        client = AsyncOpenAI(api_key="sk-test", base_url=fake_openai.base_url, max_retries=0)
+        gateway = LLMGateway(client, **options)
+        try:
+            return await scenario(gateway), gateway.stats()
+        finally:
+            await gateway.close()
+    return asyncio.run(main())
+
+
+def test_429s_are_retried_and_usage_recorded(fake_openai, fast_retries):
+    fake_openai.errors = [429, 429]
+    fake_openai.retry_after = 0
+
+    response, stats = run(fake_openai, lambda gw: gw.complete(MESSAGES, model="gpt-4o"))
+    assert response.choices[0].message.content == "Hello, world!"
+    model = stats["models"]["gpt-4o"]
+    assert model["errors"] == model["retries"] == 2
+    assert model["prompt_tokens"] == 10 and model["completion_tokens"] == 4
+    assert model["latency_p95_s"] is not None
+    assert stats["in_flight"] == 0
+
+
+def test_exhausted_retries_fall_back_to_the_next_model(fake_openai, fast_retries):
+    fake_openai.model_errors = {"gpt-4o": 503}
+    response, stats = run(
+        fake_openai, lambda gw: gw.complete(MESSAGES, model="gpt-4o"), fallback_models=["gpt-4o-mini"]
+    )
+    assert response.model == "gpt-4o-mini"
+    assert [r["model"] for r in fake_openai.requests] == ["gpt-4o"] * 3 + ["gpt-4o-mini"]
+    assert stats["models"]["gpt-4o-mini"]["fallbacks"] == 1
+
+    fake_openai.model_errors = {"gpt-4o": 429, "gpt-4o-mini": 429}
+    with pytest.raises(RateLimitError):
+        run(fake_openai, lambda gw: gw.complete(MESSAGES, model="gpt-4o"), fallback_models=["gpt-4o-mini"])
+
+
+def test_client_errors_are_not_retried(fake_openai, fast_retries):
+    fake_openai.errors = [400]
+    with pytest.raises(Exception) as excinfo:
+        run(fake_openai, lambda gw: gw.complete(MESSAGES, model="gpt-4o"), fallback_models=["gpt-4o-mini"])
+    assert excinfo.value.status_code == 400
+    assert len(fake_openai.requests) == 1
+
+
+def test_slow_request_is_hedged(fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(settings, "LLM_HEDGE_DELAY", 0.3)
+    fake_openai.latencies = [2.0]  # only the first request is slow
+
+    started = time.monotonic()
+    response, stats = run(fake_openai, lambda gw: gw.complete(MESSAGES, model="gpt-4o"))
+    assert time.monotonic() - started < 1.5
+    assert response.choices[0].message.content == "Hello, world!"
+    assert stats["models"]["gpt-4o"]["hedges"] == stats["models"]["gpt-4o"]["hedge_wins"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_hedges_are_charged_to_the_token_bucket(fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(settings, "LLM_HEDGE_DELAY", 0.3)
+
+    async def scenario(gateway, estimate):
+        await gateway.complete(MESSAGES, model="gpt-4o", estimated_tokens=estimate)
+        return gateway._tokens._tokens
+
+    # No room in the TPM bucket for a second estimate: no hedge
+    fake_openai.latencies = [1.0]
+    _, stats = run(fake_openai, lambda gw: scenario(gw, 400), tpm_limit=600)
+    assert stats["models"]["gpt-4o"]["hedges"] == 0
+
+    # The hedge reserves its estimate; once one request wins, the loser's goes back
+    fake_openai.latencies = [1.0]
+    tokens, stats = run(fake_openai, lambda gw: scenario(gw, 200), tpm_limit=600)
+    assert stats["models"]["gpt-4o"]["hedge_wins"] == 1
+    assert tokens > 600 - 200
+
+
+def test_no_fallback_once_the_deadline_passed(fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_DEADLINE", 0.0)
+    monkeypatch.setattr(settings, "LLM_MAX_RETRIES", 0)
+    fake_openai.model_errors = {"gpt-4o": 429}
+    with pytest.raises(RateLimitError):
+        run(fake_openai, lambda gw: gw.complete(MESSAGES, model="gpt-4o"), fallback_models=["gpt-4o-mini"])
+    assert [r["model"] for r in fake_openai.requests] == ["gpt-4o"]
+
+
+def test_admission_queues_then_rejects_beyond_the_timeout(fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_QUEUE_TIMEOUT", 0.2)
+    fake_openai.latency = 0.5
+
+    async def burst(gateway):
+        results = await asyncio.gather(
+            *(gateway.complete(MESSAGES, model="gpt-4o") for _ in range(2)), return_exceptions=True
+        )
+        return [type(r).__name__ for r in results]
+
+    outcomes, stats = run(fake_openai, burst, max_concurrency=1)
+    assert sorted(outcomes) == ["ChatCompletion", "LLMOverloaded"]
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+
+    fake_openai.latency = 0
+    outcomes, _ = run(fake_openai, lambda gw: burst(gw), rpm_limit=2)
+    assert outcomes == ["ChatCompletion", "ChatCompletion"]
+
+    async def over_limit(gateway):
+        await burst(gateway)
+        await gateway.complete(MESSAGES, model="gpt-4o")  # would have to wait ~30s
+
+    with pytest.raises(LLMOverloaded):
+        run(fake_openai, over_limit, rpm_limit=2)
+
+
+def test_token_bucket_reservations_wait_in_order():
+    bucket = TokenBucket(per_minute=600)  # 10 per second
+    assert bucket.reserve(600) == 0
+    assert bucket.reserve(5) == pytest.approx(0.5, abs=0.01)
+    assert bucket.reserve(5) == pytest.approx(1.0, abs=0.01)
+    bucket.refund(10)
+    assert bucket.reserve(1) == pytest.approx(0.1, abs=0.01)
+    assert TokenBucket(per_minute=0).reserve(10 ** 9) == 0
+
+
+def test_rate_budget_is_refunded_for_calls_never_made(fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_QUEUE_TIMEOUT", 0.1)
+    fake_openai.latency = 0.3
+
+    async def slot_timeout(gateway):
+        first = asyncio.ensure_future(gateway.complete(MESSAGES, model="gpt-4o"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(LLMOverloaded):
+            await gateway.complete(MESSAGES, model="gpt-4o", estimated_tokens=100)
+        await first
+        return gateway._requests._tokens, gateway._tokens._tokens
+
+    (requests, tokens), _ = run(fake_openai, slot_timeout, rpm_limit=60, tpm_limit=6000, max_concurrency=1)
+    # Only the first call is charged: one request (refilling at 1/s) and its real usage (14 tokens)
+    assert requests > 58.7
+    assert tokens > 6000 - 50
+
+
+def test_retry_past_the_deadline_is_refunded(fake_openai, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_DEADLINE", 0.0)
+    fake_openai.errors = [503]
+
+    async def scenario(gateway):
+        with pytest.raises(Exception):
+            await gateway.complete(MESSAGES, model="gpt-4o")
+        return gateway._requests._tokens
+
+    requests, _ = run(fake_openai, scenario, rpm_limit=60)
+    assert requests > 58.7
+
+
+def test_org_limits_are_split_between_worker_processes(monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_PROCESSES", 4)
+    assert llm_gateway.process_share(600) == 150
+    assert llm_gateway.process_share(0) == 0
@@ -0,0 +1,149 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from backend.config import settings
+from backend.services import local_index
+from backend.services.embedding_service import embed_local
+from backend.services.local_index import LocalVectorIndex
+
+
+def make_index(root, **overrides):
+    options = dict(max_per_user=100, cached_users=2)
+    options.update(overrides)
+    return LocalVectorIndex(root, **options)
+
+
+# Embedded with the hashed local embedding, as with EMBEDDING_BACKEND="local"
+def add(index, user_id, items):
+    return index.add(user_id, items, [embed_local(m["text"]) for m in items])
+
+
+def search(index, user_id, text, top_k=5):
+    return index.search(user_id, embed_local(text), top_k=top_k)
+
+
+def memories(*texts, start=1):
+    return [{"key": start + i, "text": text, "timestamp": "2024-01-01T00:00:00Z"} for i, text in enumerate(texts)]
+
+
+def test_search_ranks_the_users_own_memories(tmp_path):
+    index = make_index(tmp_path)
+    add(index, 1, memories("dinner on friday at eight", "the invoice is overdue", "call mom"))
+    add(index, 2, memories("friday dinner plans", start=10))
+
+    results = search(index, 1, "what time is dinner on friday?", top_k=2)
+    assert [r.properties["text"] for r in results][0] == "dinner on friday at eight"
+    assert all(r.properties["user_id"] == "1" for r in results)
+    assert results[0].metadata.distance < results[1].metadata.distance
+    assert search(index, 3, "dinner") == []
+
+
+def test_duplicate_keys_are_skipped_and_data_survives_reopen(tmp_path):
+    index = make_index(tmp_path)
+    assert add(index, 1, memories("a", "b")) == 2
+    assert add(index, 1, memories("a", "b", "c")) == 1
+
+    reopened = make_index(tmp_path)
+    assert reopened.count(1) == 3
+    assert search(reopened, 1, "c", top_k=1)[0].properties["text"] == "c"
+
+
+def test_torn_writes_are_truncated_on_load(tmp_path):
+    add(make_index(tmp_path), 1, memories("first", "second"))
+    with open(tmp_path / "user_1.f32", "ab") as fh:
+        fh.write(b"\0" * settings.LOCAL_EMBEDDING_DIM * 4)  # vector written, properties never were
+    with open(tmp_path / "user_1.jsonl", "a") as fh:
+        fh.write('{"key": "3", "te')
+
+    index = make_index(tmp_path)
+    assert index.count(1) == 2
+    add(index, 1, memories("third", start=3))
+    assert make_index(tmp_path).count(1) == 3
+
+
+@pytest.fixture
+def index_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "LOCAL_INDEX_DIR", tmp_path)
+    monkeypatch.setattr(settings, "LOCAL_INDEX_FAILOVER_TIMEOUT", 0.05)
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "local")
+    monkeypatch.setattr(local_index, "_local_index", None)
+    return settings
+
+
+def test_failover_answers_from_local_index(index_settings, monkeypatch):
+    calls = []
+
+    async def down(wclient, user_id, text, top_k=5, raise_errors=False):
+        calls.append(text)
+        raise ConnectionError("weaviate restarting")
+
+    async def slow(wclient, user_id, text, top_k=5, raise_errors=False):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(index_settings, "LOCAL_INDEX_MODE", "failover")
+    add(local_index.get_local_index(), 1, memories("meeting moved to thursday"))
+    monkeypatch.setattr(local_index, "search_relevant_messages", down)
+    results = asyncio.run(local_index.search_memories(None, 1, "when is the meeting"))
+    assert [r.properties["text"] for r in results] == ["meeting moved to thursday"]
+    assert calls == ["when is the meeting"]
+
+    monkeypatch.setattr(local_index, "search_relevant_messages", slow)
+    results = asyncio.run(local_index.search_memories(None, 1, "when is the meeting"))
+    assert len(results) == 1
+
+
+def test_primary_mode_skips_weaviate_when_local_data_exists(index_settings, monkeypatch):
+    async def weaviate(wclient, user_id, text, top_k=5, raise_errors=False):
+        return ["from weaviate"]
+
+    monkeypatch.setattr(index_settings, "LOCAL_INDEX_MODE", "primary")
+    monkeypatch.setattr(local_index, "search_relevant_messages", weaviate)
+    add(local_index.get_local_index(), 1, memories("hello there"))
+
+    assert asyncio.run(local_index.search_memories(None, 1, "hello"))[0].properties["text"] == "hello there"
+    assert asyncio.run(local_index.search_memories(None, 2, "hello")) == ["from weaviate"]
+
+
+def test_worker_processes_share_the_index_files(tmp_path):
+    first, second = make_index(tmp_path), make_index(tmp_path)
+    assert second.count(1) == 0
+    add(first, 1, memories("budget review moved to monday"))
+    add(second, 1, memories("dentist appointment on friday", start=2))
+    # A retried key is skipped even though another process wrote it
+    add(first, 1, memories("budget review moved to monday") + memories("lunch with sam", start=3))
+
+    for index in (first, second, make_index(tmp_path)):
+        assert index.count(1) == 3
+        assert search(index, 1, "dentist friday", top_k=1)[0].properties["text"] == "dentist appointment on friday"
+
+
+def test_prune_drops_old_memories_for_every_process(tmp_path):
+    first, second = make_index(tmp_path), make_index(tmp_path)
+    add(first, 1, [
+        {"key": 1, "text": "old trip to lisbon", "timestamp": "2024-01-15T10:00:00Z"},
+        {"key": 2, "text": "new trip to porto", "timestamp": "2024-03-02T08:00:00Z"},
+    ])
+    add(first, 2, [{"key": 3, "text": "old budget review", "timestamp": "2024-02-28T23:59:59Z"}])
+    assert second.count(1) == 2
+
+    assert second.prune_before(datetime(2024, 3, 1, tzinfo=timezone.utc)) == 2
+    for index in (first, second, make_index(tmp_path)):
+        assert index.count(1) == 1 and index.count(2) == 0
+        assert search(index, 1, "trip", top_k=5)[0].properties["text"] == "new trip to porto"
+    # Appends keep working on the rewritten files
+    add(first, 1, [{"key": 4, "text": "dinner with ana", "timestamp": "2024-03-05T19:00:00Z"}])
+    assert second.count(1) == 2
+
+
+def test_one_index_holds_one_vector_space(tmp_path):
+    index = make_index(tmp_path, comparable_scores=False)
+    assert search(index, 1, "anything") == [] and index.count(1) == 0
+    add(index, 1, memories("standup moved to ten"))
+    with pytest.raises(ValueError):
+        index.add(1, memories("other model", start=2), [embed_local("other model", 64)])
+
+    # Ranked by the hashed embedding, but without a score to compare with Weaviate's
+    result = search(make_index(tmp_path, comparable_scores=False), 1, "standup")[0]
+    assert result.properties["text"] == "standup moved to ten" and result.metadata.distance is None
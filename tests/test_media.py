@@ -0,0 +1,396 @@
+import asyncio
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.api.v1 import media as media_api
+from backend.db import get_db
+from backend.models import Base
+from backend.models.media import Media
+from backend.models.media_blob import MediaBlob
+from backend.models.user import User
+from backend.services import media_cache, media_service
+
+
+class FakeDriveService:
+    """Stands in for the googleapiclient Drive v3 service."""
+
+    def __init__(self, files):
+        self._files = files
+        self.range_requests = []
+        self.deleted = []
+        self.fail_names = set()
+
+    def files(self):
+        return self
+
+    def get(self, fileId, fields, supportsAllDrives):
+        content = self._files[fileId]
+        meta = {
+            "id": fileId,
+            "size": str(len(content)),
+            "md5Checksum": hashlib.md5(content).hexdigest(),
+            "modifiedTime": "2024-05-01T12:00:00.000Z",
+        }
+        return SimpleNamespace(execute=lambda: meta)
+
+    def create(self, body, media_body, fields, supportsAllDrives):
+        def execute():
+            if body["name"] in self.fail_names:
+                raise ConnectionError("upload interrupted")
+            file_id = f"g-{body['name']}"
+            self._files[file_id] = media_body.getbytes(0, media_body.size())
+            return {"id": file_id}
+        return SimpleNamespace(execute=execute)
+
+    def update(self, fileId, body, supportsAllDrives):
+        return SimpleNamespace(execute=lambda: {"id": fileId})
+
+    def delete(self, fileId, supportsAllDrives):
+        return SimpleNamespace(execute=lambda: self.deleted.append(fileId))
+
+    def get_media(self, fileId, supportsAllDrives):
+        service = self
+        request = SimpleNamespace(headers={})
+
+        def execute():
+            first, last = request.headers["range"].split("=")[1].split("-")
+            service.range_requests.append((int(first), int(last)))
+            return self._files[fileId][int(first):int(last) + 1]
+
+        request.execute = execute
+        return request
+
+
+class FakeDriveClient:
+    def __init__(self, service):
+        self.service = service
+
+    async def run(self, fn):
+        return fn(self.service)
+
+
+class FakeResult:
+    def __init__(self, obj):
+        self._obj = obj
+
+    def scalars(self):
+        return self
+
+    def first(self):
+        return self._obj
+
+
+class FakeSession:
+    def __init__(self, media):
+        self.media = media
+        self.added = []
+        self.commits = 0
+
+    async def execute(self, stmt):
+        return FakeResult(self.media)
+
+    def add_all(self, objs):
+        self.added.extend(objs)
+
+    async def commit(self):
+        self.commits += 1
+        for i, obj in enumerate(self.added, start=1):
+            obj.id = i
+
+    async def rollback(self):
+        pass
+
+    async def refresh(self, obj):
+        pass
+
+
+CONTENT = bytes(range(256)) * 40  # 10240 bytes
+
+
+@pytest.fixture
+def drive(monkeypatch):
+    service = FakeDriveService({"g1": CONTENT})
+    monkeypatch.setattr(media_service, "get_drive_client", lambda: FakeDriveClient(service))
+    monkeypatch.setattr(media_service.settings, "GDRIVE_DOWNLOAD_CHUNK_SIZE", 4096)
+    monkeypatch.setattr(media_service.settings, "MEDIA_CACHE_ENABLED", False)
+    return service
+
+
+@pytest.fixture
+def client(drive):
+    media = SimpleNamespace(id=1, gdrive_id="g1", filename="clip.mp4", filetype="video/mp4", content_hash=None)
+
+    session = FakeSession(media)
+
+    async def override_db():
+        yield session
+
+    app = FastAPI()
+    app.include_router(media_api.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = override_db
+    app.dependency_overrides[media_api.admin_required] = lambda: SimpleNamespace(id=1, role="admin")
+    client = TestClient(app)
+    client.session = session
+    return client
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-200", (800, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=0-1,5-9", None),
+    ("items=0-1", None),
+])
+def test_parse_range_header(header, expected):
+    assert media_api.parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5-2", "bytes=-0", "bytes=a-b"])
+def test_parse_range_header_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        media_api.parse_range_header(header, 1000)
+
+
+def test_download_streams_in_chunks(client, drive):
+    resp = client.get("/api/v1/media/download/1")
+    assert resp.status_code == 200
+    assert resp.content == CONTENT
+    assert resp.headers["content-length"] == str(len(CONTENT))
+    assert resp.headers["accept-ranges"] == "bytes"
+    assert drive.range_requests == [(0, 4095), (4096, 8191), (8192, 10239)]
+
+
+def test_download_range_returns_partial_content(client, drive):
+    resp = client.get("/api/v1/media/download/1", headers={"Range": "bytes=5000-5009"})
+    assert resp.status_code == 206
+    assert resp.content == CONTENT[5000:5010]
+    assert resp.headers["content-range"] == f"bytes 5000-5009/{len(CONTENT)}"
+    assert drive.range_requests == [(5000, 5009)]
+
+
+def test_download_if_range_mismatch_serves_full_file(client, drive):
+    resp = client.get("/api/v1/media/download/1", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert resp.status_code == 200
+    assert len(resp.content) == len(CONTENT)
+
+
+def test_download_unsatisfiable_range(client, drive):
+    resp = client.get("/api/v1/media/download/1", headers={"Range": f"bytes={len(CONTENT)}-"})
+    assert resp.status_code == 416
+    assert resp.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+
+@pytest.fixture
+def store_client(drive, tmp_path):
+    """Media API over a real (sqlite) database, for uploads and deletes."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'media.db'}")
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def startup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with Session() as session:
+            session.add(User(id=1, email="admin@example.com", hashed_password="x", role="admin"))
+            await session.commit()
+
+    asyncio.run(startup())
+
+    async def override_db():
+        async with Session() as session:
+            yield session
+
+    async def query(stmt):
+        async with Session() as session:
+            return (await session.execute(stmt)).all()
+
+    app = FastAPI()
+    app.include_router(media_api.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = override_db
+    app.dependency_overrides[media_api.admin_required] = lambda: SimpleNamespace(id=1, role="admin")
+    client = TestClient(app)
+    client.query = lambda stmt: asyncio.run(query(stmt))
+    yield client
+    asyncio.run(engine.dispose())
+
+
+def test_upload_many_files_single_commit(store_client, drive):
+    files = [("files", (f"doc{i}.txt", b"x" * (i + 1), "text/plain")) for i in range(3)]
+    resp = store_client.post("/api/v1/media/upload", files=files)
+    assert resp.status_code == 200
+    body = resp.json()
+    assert [m["filename"] for m in body] == ["doc0.txt", "doc1.txt", "doc2.txt"]
+    assert [m["file_size"] for m in body] == [1, 2, 3]
+    assert len(store_client.query(select(Media.id))) == 3
+    assert drive._files["g-doc2.txt"] == b"xxx"
+
+
+def test_upload_partial_failure_cleans_up_drive(store_client, drive):
+    drive.fail_names = {"bad.txt"}
+    files = [
+        ("files", ("good.txt", b"ok", "text/plain")),
+        ("files", ("bad.txt", b"no", "text/plain")),
+    ]
+    resp = store_client.post("/api/v1/media/upload", files=files)
+    assert resp.status_code == 502
+    statuses = {r["filename"]: r["status"] for r in resp.json()["detail"]["results"]}
+    assert statuses == {"good.txt": "rolled_back", "bad.txt": "failed"}
+    assert drive.deleted == ["g-good.txt"]
+    assert store_client.query(select(Media.id)) == []
+
+
+def test_duplicate_uploads_share_one_drive_object(store_client, drive):
+    first = store_client.post("/api/v1/media/upload", files=[("files", ("a.pdf", b"same", "application/pdf"))])
+    assert first.json()[0]["deduplicated"] is False
+    files = [
+        ("files", ("copy.pdf", b"same", "application/pdf")),
+        ("files", ("new.pdf", b"other", "application/pdf")),
+        ("files", ("new-again.pdf", b"other", "application/pdf")),
+    ]
+    second = store_client.post("/api/v1/media/upload", files=files)
+    assert [m["deduplicated"] for m in second.json()] == [True, False, True]
+    assert sorted(name for name in drive._files if name != "g1") == ["g-a.pdf", "g-new.pdf"]
+
+    rows = dict(store_client.query(select(Media.filename, Media.gdrive_id)))
+    assert rows["copy.pdf"] == "g-a.pdf" and rows["new-again.pdf"] == "g-new.pdf"
+    blobs = dict(store_client.query(select(MediaBlob.sha256, MediaBlob.refcount)))
+    assert blobs == {hashlib.sha256(b"same").hexdigest(): 2, hashlib.sha256(b"other").hexdigest(): 2}
+
+
+def test_drive_object_is_deleted_with_its_last_reference(store_client, drive):
+    ids = [
+        store_client.post("/api/v1/media/upload", files=[("files", (name, b"same", "text/plain"))]).json()[0]["id"]
+        for name in ("a.txt", "b.txt")
+    ]
+    assert store_client.delete(f"/api/v1/media/delete/{ids[0]}").status_code == 200
+    assert drive.deleted == []
+    assert store_client.query(select(MediaBlob.refcount)) == [(1,)]
+    assert store_client.put(f"/api/v1/media/rename/{ids[1]}", params={"new_name": "c.txt"}).status_code == 200
+    assert store_client.delete(f"/api/v1/media/delete/{ids[1]}").status_code == 200
+    assert drive.deleted == ["g-a.txt"]
+    assert store_client.query(select(MediaBlob.sha256)) == []
+
+
+def test_deleting_one_copy_keeps_the_search_chunks(store_client, monkeypatch):
+    from backend.services import document_service
+
+    chunks = {(1, hashlib.sha256(b"same").hexdigest()): ["same"]}  # indexed once, from the first upload
+
+    async def run_inline(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def delete_chunks(wclient, user_id, content_hash=None, media_id=None):
+        return len(chunks.pop((user_id, content_hash), []))
+
+    monkeypatch.setattr(document_service, "get_weaviate_client", lambda: object())
+    monkeypatch.setattr(document_service, "run_in_weaviate_executor", run_inline)
+    monkeypatch.setattr(document_service, "delete_document_chunks", delete_chunks)
+    ids = [
+        store_client.post("/api/v1/media/upload", files=[("files", (name, b"same", "text/plain"))]).json()[0]["id"]
+        for name in ("a.txt", "b.txt")
+    ]
+    assert store_client.delete(f"/api/v1/media/delete/{ids[0]}").status_code == 200
+    assert chunks == {(1, hashlib.sha256(b"same").hexdigest()): ["same"]}
+    assert store_client.delete(f"/api/v1/media/delete/{ids[1]}").status_code == 200
+    assert chunks == {}
+
+
+@pytest.fixture
+def cache(drive, monkeypatch, tmp_path):
+    monkeypatch.setattr(media_service.settings, "MEDIA_CACHE_ENABLED", True)
+    cache = media_cache.MediaCache(tmp_path, max_bytes=3 * len(CONTENT), max_entry_bytes=len(CONTENT))
+    monkeypatch.setattr(media_cache, "_media_cache", cache)
+    return cache
+
+
+def _wait_for_fill(client, cache):
+    async def inflight():
+        await asyncio.gather(*list(cache._inflight.values()))
+
+    client.portal.call(inflight)
+
+
+async def _fill(cache, gdrive_id, meta):
+    """What a download miss does: prefetch, then (here) wait for the shared fill."""
+    cache.prefetch(gdrive_id, meta)
+    await asyncio.gather(*list(cache._inflight.values()))
+    return cache.lookup(gdrive_id, meta)
+
+
+def test_download_cache_hit_skips_drive(client, drive, cache):
+    with client:
+        # A miss streams the requested range from Drive right away and fills the cache on the side
+        first = client.get("/api/v1/media/download/1", headers={"Range": "bytes=0-9"})
+        assert first.status_code == 206 and first.content == CONTENT[:10]
+        assert (0, 9) in drive.range_requests
+        _wait_for_fill(client, cache)
+        fetched = len(drive.range_requests)
+
+        second = client.get("/api/v1/media/download/1", headers={"Range": "bytes=10-19"})
+        assert second.status_code == 206
+        assert second.content == CONTENT[10:20]
+        assert client.get("/api/v1/media/download/1").content == CONTENT
+        assert len(drive.range_requests) == fetched
+
+
+def test_rename_invalidates_cache(client, drive, cache):
+    with client:
+        client.get("/api/v1/media/download/1")
+        _wait_for_fill(client, cache)
+        fetched = len(drive.range_requests)
+        assert client.put("/api/v1/media/rename/1", params={"new_name": "b.mp4"}).status_code == 200
+        client.get("/api/v1/media/download/1")
+        _wait_for_fill(client, cache)
+        assert len(drive.range_requests) == 2 * fetched
+
+
+def test_concurrent_misses_share_one_fetch(drive, cache):
+    meta = drive.files().get(fileId="g1", fields="", supportsAllDrives=True).execute()
+
+    async def scenario():
+        for _ in range(5):
+            cache.prefetch("g1", meta)
+        assert len(cache._inflight) == 1
+        return await asyncio.gather(*(_fill(cache, "g1", meta) for _ in range(5)))
+
+    paths = asyncio.run(scenario())
+    assert len(set(paths)) == 1
+    assert paths[0].read_bytes() == CONTENT
+    assert drive.range_requests == [(0, 4095), (4096, 8191), (8192, 10239)]
+
+
+def test_cache_evicts_least_recently_used(drive, cache):
+    for name in ("a", "b", "c", "d"):
+        drive._files[name] = name.encode() * len(CONTENT)
+
+    async def fill(name):
+        meta = drive.files().get(fileId=name, fields="", supportsAllDrives=True).execute()
+        return await _fill(cache, name, meta)
+
+    paths = [asyncio.run(fill(name)) for name in ("a", "b", "c", "d")]
+    assert not paths[0].exists()
+    assert all(p.exists() for p in paths[1:])
+
+
+def test_eviction_counts_entries_written_by_other_workers(drive, cache, tmp_path):
+    # Another worker process filled the shared directory up to the cap
+    for name in ("aa" + "0" * 30, "bb" + "0" * 30, "cc" + "0" * 30):
+        (tmp_path / name[:2]).mkdir()
+        (tmp_path / name[:2] / name).write_bytes(b"x" * len(CONTENT))
+        media_cache._touch(tmp_path / name[:2] / name)
+
+    async def fill():
+        meta = drive.files().get(fileId="g1", fields="", supportsAllDrives=True).execute()
+        return await _fill(cache, "g1", meta)
+
+    path = asyncio.run(fill())
+    assert path.exists()
+    assert not (tmp_path / "aa" / ("aa" + "0" * 30)).exists()
+    assert sum(p.stat().st_size for p in tmp_path.glob("??/*")) == 3 * len(CONTENT)
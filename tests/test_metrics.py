@@ -0,0 +1,121 @@
+import logging
+import os
+import re
+import subprocess
+import sys
+
+from fastapi.testclient import TestClient
+
+from backend.config import settings
+from backend.services import log_queue, metrics
+from backend.services.metrics import Registry, merge_snapshots, render
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    requests = registry.counter("app_requests_total", "Requests.", labels=("route",))
+    latency = registry.histogram("app_latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    requests.inc(route='/a"b')
+    requests.inc(2, route='/a"b')
+    for value in (0.05, 0.5, 3.0):
+        latency.observe(value)
+    registry.collector(lambda: [("app_queue", "gauge", "Queued.", (), {(): 7})])
+
+    text = render(registry.snapshot())
+    assert '# TYPE app_requests_total counter' in text
+    assert 'app_requests_total{route="/a\\"b"} 3' in text
+    assert 'app_latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'app_latency_seconds_bucket{le="1.0"} 2' in text
+    assert 'app_latency_seconds_bucket{le="+Inf"} 3' in text
+    assert 'app_latency_seconds_count 3' in text
+    assert 'app_latency_seconds_sum 3.55' in text
+    assert 'app_queue 7' in text
+
+
+def test_worker_snapshots_are_summed_and_gauges_keep_the_pid():
+    def snapshot(requests, queued):
+        registry = Registry()
+        registry.counter("app_requests_total", "Requests.").inc(requests)
+        registry.gauge("app_queue", "Queued.").set(queued)
+        return registry.snapshot()
+
+    text = render(merge_snapshots({101: snapshot(2, 1), 102: snapshot(5, 4)}))
+    assert "app_requests_total 7" in text
+    assert 'app_queue{pid="101"} 1' in text
+    assert 'app_queue{pid="102"} 4' in text
+
+
+def test_metrics_endpoint_reports_requests_by_route_template(monkeypatch):
+    from backend import main
+
+    monkeypatch.setattr(settings, "METRICS_DIR", "")
+    client = TestClient(main.app)
+    client.get("/healthz")
+    assert client.get("/api/v1/media/download/42").status_code == 401
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'ccc_http_request_seconds_count{method="GET",route="/healthz",status="200"}' in resp.text
+    assert 'route="/api/v1/media/download/{media_id}",status="401"' in resp.text
+    assert "# TYPE ccc_event_loop_lag_seconds histogram" in resp.text
+
+    monkeypatch.setattr(settings, "METRICS_ENABLED", False)
+    assert client.get("/metrics").status_code == 404
+
+
+def test_payload_logs_are_sampled_and_written_off_thread(monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    records = []
+
+    class Collect(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    root = logging.getLogger()
+    monkeypatch.setattr(root, "handlers", [Collect()])
+    log_queue.start_queue_logging()
+    try:
+        assert isinstance(root.handlers[0], log_queue.DroppingQueueHandler)
+        monkeypatch.setattr(settings, "LOG_PAYLOAD_SAMPLE_RATE", 0)
+        log_queue.log_payload("never %s", "logged")
+        monkeypatch.setattr(settings, "LOG_PAYLOAD_SAMPLE_RATE", 1)
+        log_queue.log_payload("context for user %s", 1)
+    finally:
+        log_queue.stop_queue_logging()
+    assert records == ["context for user 1"]
+    assert isinstance(root.handlers[0], Collect)
+
+
+def test_scrapes_never_go_backwards_whichever_worker_answers(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_DIR", str(tmp_path))
+    other = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    workers = {os.getpid(): Registry(), other.pid: Registry()}
+    counters = {pid: registry.counter("app_requests_total", "Requests.") for pid, registry in workers.items()}
+    for pid, registry in workers.items():
+        registry.gauge("app_queue", "Queued.").set(1)
+
+    def scrape(pid):
+        # Answer as worker `pid`, with its own live registry
+        with monkeypatch.context() as m:
+            m.setattr(metrics, "registry", workers[pid])
+            m.setattr(os, "getpid", lambda: pid)
+            text = render(metrics.collect_all())
+        return int(re.search(r"^app_requests_total (\d+)", text, re.M).group(1)), text
+
+    totals = []
+    counters[other.pid].inc(5)
+    totals.append(scrape(other.pid)[0])
+    counters[os.getpid()].inc(2)
+    counters[other.pid].inc(10)  # Not in its snapshot yet
+    totals.append(scrape(os.getpid())[0])
+    totals.append(scrape(other.pid)[0])
+    counters[os.getpid()].inc(1)
+    totals.append(scrape(os.getpid())[0])
+
+    other.kill()
+    other.wait()
+    total, text = scrape(os.getpid())
+    totals.append(total)
+    assert totals == [5, 7, 17, 18, 18]
+    assert f'pid="{other.pid}"' not in text
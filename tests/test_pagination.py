@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from backend.api.v1.pagination import apply_keyset, decode_cursor, encode_cursor, split_page
+from backend.models.chat import Chat
+from backend.models.user import User
+
+
+def test_cursor_round_trip():
+    ts = datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(ts, 42)) == (ts, 42)
+
+
+def test_invalid_cursor_is_a_client_error():
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor("not-a-cursor")
+    assert exc.value.status_code == 400
+
+
+def test_keyset_pages_cover_every_row_once():
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    Chat.__table__.create(engine)
+    base = datetime(2024, 1, 1)
+    with Session(engine) as session:
+        session.add(User(id=1, email="a@example.com", hashed_password="x"))
+        # Pairs of rows share a timestamp so the id tiebreaker matters
+        session.add_all(
+            Chat(id=i, user_id=1, message=f"m{i}", created_at=base + timedelta(minutes=i // 2))
+            for i in range(1, 12)
+        )
+        session.commit()
+
+        seen, cursor = [], None
+        while True:
+            stmt = apply_keyset(select(Chat).where(Chat.user_id == 1), Chat.created_at, Chat.id, cursor, 4)
+            page, cursor = split_page(session.execute(stmt).scalars().all(), 4)
+            seen.extend(chat.id for chat in page)
+            if cursor is None:
+                break
+
+    assert seen == sorted(range(1, 12), key=lambda i: (i // 2, i), reverse=True)
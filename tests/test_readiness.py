@@ -0,0 +1,74 @@
+import asyncio
+import subprocess
+import sys
+
+from fastapi.testclient import TestClient
+
+from backend.config import settings
+from backend.services.readiness import Readiness
+
+
+def test_dependencies_retry_with_backoff_until_ready(monkeypatch):
+    monkeypatch.setattr(settings, "STARTUP_RETRY_BASE_DELAY", 0.01)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("refused")
+
+    async def broken():
+        raise ConnectionError("refused")
+
+    async def scenario():
+        readiness = Readiness()
+        readiness.start("db", flaky)
+        readiness.start("vectors", broken, required=False, max_attempts=2)
+        assert readiness.report()[0] is False
+        await asyncio.sleep(0.2)
+        report = readiness.report()
+        await readiness.stop()
+        return report
+
+    ready, deps = asyncio.run(scenario())
+    assert ready is True  # optional dependencies don't block readiness
+    assert deps["db"]["status"] == "ready"
+    assert deps["db"]["attempts"] == 3
+    assert deps["db"]["error"] is None
+    assert deps["vectors"]["status"] == "failed"
+    assert deps["vectors"]["error"] == "ConnectionError: refused"
+
+
+def test_app_is_live_before_dependencies_are_ready(monkeypatch):
+    from backend import main
+
+    async def db_down():
+        raise ConnectionError("postgres not accepting connections")
+
+    async def never_ready():
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(main, "init_database", db_down)
+    monkeypatch.setattr(main, "init_weaviate", never_ready)
+    monkeypatch.setattr(main, "shutdown", lambda: None)
+    monkeypatch.setattr(main, "readiness", Readiness())
+
+    with TestClient(main.app) as client:
+        assert client.get("/healthz").json() == {"status": "ok"}
+        resp = client.get("/readyz")
+        assert resp.status_code == 503
+        deps = resp.json()["dependencies"]
+        assert deps["database"]["status"] == "starting"
+        assert deps["database"]["error"] == "ConnectionError: postgres not accepting connections"
+        assert deps["weaviate"] == {
+            "status": "starting", "required": False, "attempts": 1, "error": None, "ready_after_s": None
+        }
+
+
+def test_heavy_clients_are_not_imported_at_startup():
+    code = (
+        "import sys, backend.main; "
+        "print(sorted(m for m in ('openai', 'weaviate', 'googleapiclient') if m in sys.modules))"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip().splitlines()[-1] == "[]"
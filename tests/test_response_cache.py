@@ -0,0 +1,64 @@
+import numpy as np
+
+from backend.services.embedding_service import embed_local
+from backend.services.response_cache import SemanticResponseCache
+
+
+def make_cache(**overrides):
+    options = dict(threshold=0.9, ttl=60, max_entries=100, max_per_user=10)
+    options.update(overrides)
+    return SemanticResponseCache(**options)
+
+
+def test_hits_are_scoped_per_user_and_context():
+    cache = make_cache()
+    vector = embed_local("see you tomorrow")
+    key = cache.context_key(1, "fp")
+    cache.store(1, vector, "Great, see you!", key)
+
+    assert cache.lookup(1, embed_local("See you tomorrow!"), key) == "Great, see you!"
+    assert cache.lookup(2, vector, cache.context_key(2, "fp")) is None
+    assert cache.lookup(1, vector, cache.context_key(1, "other-prompt")) is None
+
+    cache.bump_context(1)
+    assert cache.lookup(1, vector, cache.context_key(1, "fp")) is None
+    assert (cache.stats.hits, cache.stats.misses) == (1, 3)
+
+
+def test_expired_entries_are_not_served():
+    cache = make_cache(ttl=-1)
+    vector = embed_local("hello")
+    key = cache.context_key(1, "fp")
+    cache.store(1, vector, "hi", key)
+    assert cache.lookup(1, vector, key) is None
+    assert cache.stats.expirations == 1
+
+
+def test_size_bounds_evict_oldest():
+    cache = make_cache(max_entries=3, max_per_user=2)
+    for i in range(3):
+        cache.store(1, embed_local(f"user one message {i}"), str(i), "k")
+    cache.store(2, embed_local("user two"), "x", "k")
+    cache.store(3, embed_local("user three"), "y", "k")
+    assert len(cache) == 3
+    assert cache.lookup(1, embed_local("user one message 0"), "k") is None
+    assert cache.stats.evictions == 2
+
+
+def test_local_embedding_is_unit_length_and_similarity_ordered():
+    a, b, c = (embed_local(t) for t in ("meeting on thursday", "Meeting on Thursday?", "invoice overdue"))
+    assert np.isclose(np.linalg.norm(a), 1.0)
+    assert a @ b > 0.95 > a @ c
+
+
+def test_context_versions_are_dropped_with_the_users_entries():
+    cache = make_cache(max_entries=2, max_per_user=1)
+    for user_id in range(5):
+        cache.bump_context(user_id)
+        cache.store(user_id, embed_local(f"user {user_id}"), "reply", cache.context_key(user_id, "fp"))
+    assert len(cache) == 2
+    assert set(cache._context_versions) <= {3, 4}
+
+    key = cache.context_key(4, "fp")
+    cache.bump_context(4)
+    assert cache.context_key(4, "fp") != key
@@ -0,0 +1,58 @@
+import os
+import threading
+
+import pytest
+
+from backend import db, server
+from backend.config import settings
+from backend.services import processes
+from backend.services.forksafe import reset_after_fork
+
+
+def test_worker_count_uses_setting_or_available_cpus(monkeypatch):
+    monkeypatch.setattr(settings, "SERVER_WORKERS", 3)
+    assert server.worker_count() == 3
+
+    monkeypatch.setattr(settings, "SERVER_WORKERS", 0)
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {0, 1, 2, 3, 4, 5, 6, 7}, raising=False)
+    monkeypatch.setattr(processes, "_cgroup_cpu_limit", lambda: None)
+    assert server.worker_count() == 8
+    monkeypatch.setattr(processes, "_cgroup_cpu_limit", lambda: 2)
+    assert server.worker_count() == 2
+
+
+def test_several_workers_need_the_shared_idempotency_store(monkeypatch):
+    monkeypatch.setattr(settings, "IDEMPOTENCY_REDIS_URL", "")
+    monkeypatch.setattr(settings, "SERVER_WORKERS", 0)
+    monkeypatch.setattr(server, "worker_count", lambda: 4)
+    assert server.process_count() == 1
+    monkeypatch.setattr(settings, "SERVER_WORKERS", 4)
+    with pytest.raises(SystemExit):
+        server.process_count()
+    monkeypatch.setattr(settings, "IDEMPOTENCY_REDIS_URL", "redis://redis:6379/0")
+    assert server.process_count() == 4
+
+def test_postgres_engine_gets_pool_and_statement_cache_settings(monkeypatch):
+    monkeypatch.setattr(settings, "DB_POOL_SIZE", 4)
+    monkeypatch.setattr(settings, "DB_STATEMENT_CACHE_SIZE", 0)
+    options = db._engine_options("postgresql+asyncpg://u:p@db/app")
+    assert options["pool_size"] == 4
+    assert options["connect_args"] == {"statement_cache_size": 0}
+    assert "pool_size" not in db._engine_options("sqlite+aiosqlite:///app.db")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_singletons_are_reset_in_forked_children():
+    state = {"client": object(), "lock": threading.Lock()}
+    parent_client, parent_lock = state["client"], state["lock"]
+    reset_after_fork(state, client=None, lock=threading.Lock)
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        fresh = state["client"] is None and state["lock"] is not parent_lock
+        os.write(write, b"1" if fresh else b"0")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b"1"
+    assert state["client"] is parent_client
@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.api.v1 import media as media_api
+from backend.api.v1.auth import get_current_user
+from backend.db import get_db
+from backend.models import Base
+from backend.models.media import Media
+from backend.models.upload_session import UploadSession
+from backend.models.user import User
+from backend.services import resumable_upload
+
+GRANULE = resumable_upload.CHUNK_GRANULARITY
+CONTENT = os.urandom(2 * GRANULE + 1000)
+
+
+class FakeDriveUploads:
+    """A Drive resumable upload endpoint: acknowledges whole 256 KiB granules, like Drive."""
+
+    def __init__(self):
+        self.received = bytearray()
+        self.total = None
+        self.fail_after = None  # Bytes of the next chunk kept before the connection "drops"
+        self.cancelled = False
+        self.file_id = "g-upload"
+
+    def _status(self):
+        if len(self.received) == self.total:
+            return httpx.Response(200, json={"id": self.file_id})
+        headers = {"Range": f"bytes=0-{len(self.received) - 1}"} if self.received else {}
+        return httpx.Response(308, headers=headers)
+
+    async def __call__(self, request: httpx.Request):
+        if request.method == "POST":
+            assert request.headers["authorization"] == "Bearer token"
+            self.total = int(request.headers["x-upload-content-length"])
+            return httpx.Response(200, headers={"Location": "https://drive.test/session/1"})
+        if request.method == "DELETE":
+            self.cancelled = True
+            return httpx.Response(499)
+        body = await request.aread()
+        content_range = request.headers["content-range"]
+        if content_range.startswith("bytes */"):
+            return self._status()
+        start = int(content_range.split()[1].split("-")[0])
+        assert start == len(self.received) and len(body) == int(request.headers["content-length"])
+        if self.fail_after is not None:
+            kept = self.fail_after // GRANULE * GRANULE
+            self.received += body[:kept]
+            self.fail_after = None
+            return httpx.Response(503)
+        self.received += body
+        return self._status()
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'uploads.db'}")
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def startup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with Session() as session:
+            session.add(User(id=1, email="admin@example.com", hashed_password="x", role="admin"))
+            await session.commit()
+
+    asyncio.run(startup())
+    drive = FakeDriveUploads()
+
+    async def auth_headers():
+        return {"Authorization": "Bearer token"}
+
+    monkeypatch.setattr(resumable_upload, "_http", httpx.AsyncClient(transport=httpx.MockTransport(drive)))
+    monkeypatch.setattr(resumable_upload, "_auth_headers", auth_headers)
+    deleted = []
+
+    async def metadata(gdrive_id):
+        return {"id": gdrive_id, "sha256Checksum": hashlib.sha256(CONTENT).hexdigest()}
+
+    async def delete_from_gdrive(gdrive_id):
+        deleted.append(gdrive_id)
+        return True
+
+    monkeypatch.setattr(media_api.MediaService, "get_gdrive_metadata", metadata)
+    monkeypatch.setattr(media_api.MediaService, "delete_from_gdrive", delete_from_gdrive)
+
+    async def override_db():
+        async with Session() as session:
+            yield session
+
+    app = FastAPI()
+    app.include_router(media_api.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = override_db
+    app.dependency_overrides[get_current_user] = lambda: SimpleNamespace(id=1, email="admin@example.com", role="admin")
+    client = TestClient(app)
+    client.drive = drive
+    client.deleted = deleted
+    client.Session = Session
+    yield client
+    asyncio.run(engine.dispose())
+
+
+def _put(client, upload_id, start, end):
+    return client.put(
+        f"/api/v1/media/uploads/{upload_id}",
+        content=CONTENT[start:end + 1],
+        headers={"Content-Range": f"bytes {start}-{end}/{len(CONTENT)}"}
+    )
+
+
+def _create(client):
+    resp = client.post(
+        "/api/v1/media/uploads",
+        json={"filename": "video.mp4", "filetype": "video/mp4", "file_size": len(CONTENT)}
+    )
+    assert resp.status_code == 201
+    return resp.json()
+
+
+def test_resumable_upload_resumes_after_a_dropped_chunk(uploads):
+    upload = _create(uploads)
+    assert upload["offset"] == 0 and upload["status"] == "open"
+
+    assert _put(uploads, upload["id"], 0, GRANULE - 1).json()["offset"] == GRANULE
+
+    # The connection drops part way through the rest of the file
+    uploads.drive.fail_after = GRANULE + 10
+    assert _put(uploads, upload["id"], GRANULE, len(CONTENT) - 1).status_code == 503
+    status = uploads.get(f"/api/v1/media/uploads/{upload['id']}").json()
+    assert status["offset"] == 2 * GRANULE
+
+    incomplete = uploads.post(f"/api/v1/media/uploads/{upload['id']}/complete")
+    assert incomplete.status_code == 409 and incomplete.json()["detail"]["offset"] == 2 * GRANULE
+
+    done = _put(uploads, upload["id"], status["offset"], len(CONTENT) - 1).json()
+    assert done["status"] == "uploaded" and done["offset"] == len(CONTENT)
+    assert bytes(uploads.drive.received) == CONTENT
+
+    media = uploads.post(f"/api/v1/media/uploads/{upload['id']}/complete").json()
+    assert media["filename"] == "video.mp4" and media["file_size"] == len(CONTENT)
+    again = uploads.post(f"/api/v1/media/uploads/{upload['id']}/complete").json()
+    assert again["id"] == media["id"]
+
+    async def stored():
+        async with uploads.Session() as session:
+            return await session.get(Media, media["id"])
+
+    assert asyncio.run(stored()).gdrive_id == "g-upload"
+
+
+def test_completed_upload_is_queued_for_indexing(uploads, monkeypatch):
+    submitted = []
+
+    async def submit_stored_upload(*args):
+        submitted.append(args)
+        return True
+
+    monkeypatch.setattr(media_api, "submit_stored_upload", submit_stored_upload)
+    upload = _create(uploads)
+    _put(uploads, upload["id"], 0, len(CONTENT) - 1)
+    media = uploads.post(f"/api/v1/media/uploads/{upload['id']}/complete").json()
+    uploads.post(f"/api/v1/media/uploads/{upload['id']}/complete")
+    assert submitted == [
+        (1, media["id"], "video.mp4", "video/mp4", len(CONTENT), "g-upload", hashlib.sha256(CONTENT).hexdigest())
+    ]
+
+
+def test_completed_duplicate_reuses_the_stored_drive_object(uploads):
+    media_ids = []
+    for gdrive_id in ("g-first", "g-second"):
+        uploads.drive.received = bytearray()
+        uploads.drive.file_id = gdrive_id
+        upload = _create(uploads)
+        _put(uploads, upload["id"], 0, len(CONTENT) - 1)
+        media_ids.append(uploads.post(f"/api/v1/media/uploads/{upload['id']}/complete").json()["id"])
+
+    async def stored():
+        async with uploads.Session() as session:
+            return [(await session.get(Media, media_id)).gdrive_id for media_id in media_ids]
+
+    assert asyncio.run(stored()) == ["g-first", "g-first"]
+    assert uploads.deleted == ["g-second"]
+
+
+def test_concurrent_completes_create_one_media_row(uploads, monkeypatch):
+    upload = _create(uploads)
+    _put(uploads, upload["id"], 0, len(CONTENT) - 1)
+
+    async def slow_metadata(gdrive_id):
+        await asyncio.sleep(0.2)  # Both /complete calls are past their status check before either claims
+        return {"id": gdrive_id, "sha256Checksum": hashlib.sha256(CONTENT).hexdigest()}
+
+    monkeypatch.setattr(media_api.MediaService, "get_gdrive_metadata", slow_metadata)
+
+    async def complete_twice():
+        transport = httpx.ASGITransport(app=uploads.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*(
+                client.post(f"/api/v1/media/uploads/{upload['id']}/complete") for _ in range(2)
+            ))
+
+    first, second = asyncio.run(complete_twice())
+    assert first.status_code == second.status_code == 200
+    assert first.json()["id"] == second.json()["id"]
+
+    async def media_count():
+        async with uploads.Session() as session:
+            return await session.scalar(select(func.count()).select_from(Media))
+
+    assert asyncio.run(media_count()) == 1
+
+
+def test_abandoned_sessions_expire(uploads, monkeypatch):
+    monkeypatch.setattr(resumable_upload, "AsyncSessionLocal", uploads.Session)
+    monkeypatch.setattr(resumable_upload.MediaService, "delete_from_gdrive", media_api.MediaService.delete_from_gdrive)
+    idle = _create(uploads)
+    uploaded = _create(uploads)
+    _put(uploads, uploaded["id"], 0, len(CONTENT) - 1)
+    fresh = _create(uploads)
+    now = datetime.now(timezone.utc)
+
+    async def age(*upload_ids):
+        async with uploads.Session() as session:
+            await session.execute(
+                update(UploadSession).where(UploadSession.id.in_(upload_ids)).values(updated_at=now - timedelta(days=8))
+            )
+            await session.commit()
+
+    asyncio.run(age(idle["id"], uploaded["id"]))
+    assert asyncio.run(resumable_upload.expire_upload_sessions(now)) == 2
+    assert asyncio.run(resumable_upload.expire_upload_sessions(now)) == 0
+
+    async def statuses():
+        async with uploads.Session() as session:
+            return dict((await session.execute(select(UploadSession.id, UploadSession.status))).all())
+
+    assert asyncio.run(statuses()) == {idle["id"]: "expired", uploaded["id"]: "expired", fresh["id"]: "open"}
+    assert uploads.drive.cancelled and uploads.deleted == ["g-upload"]
+    assert uploads.post(f"/api/v1/media/uploads/{uploaded['id']}/complete").status_code == 409
+
+
+def test_chunks_must_continue_from_the_offset_and_align(uploads):
+    upload = _create(uploads)
+    wrong_offset = _put(uploads, upload["id"], GRANULE, 2 * GRANULE - 1)
+    assert wrong_offset.status_code == 409 and wrong_offset.json()["detail"]["offset"] == 0
+    assert _put(uploads, upload["id"], 0, 999).status_code == 400  # not a whole granule
+    resp = uploads.put(
+        f"/api/v1/media/uploads/{upload['id']}",
+        content=b"x",
+        headers={"Content-Range": f"bytes 0-0/{len(CONTENT) + 1}"}
+    )
+    assert resp.status_code == 400
+    assert uploads.drive.received == bytearray()
+
+
+def test_cancel_closes_the_drive_session(uploads):
+    upload = _create(uploads)
+    resp = uploads.delete(f"/api/v1/media/uploads/{upload['id']}")
+    assert resp.json()["status"] == "cancelled"
+    assert uploads.drive.cancelled
+    assert _put(uploads, upload["id"], 0, GRANULE - 1).status_code == 409
+
+
+def test_parse_content_range():
+    assert resumable_upload.parse_content_range(f"bytes 0-{GRANULE - 1}/{3 * GRANULE}", 3 * GRANULE) == (0, GRANULE - 1)
+    assert resumable_upload.parse_content_range(f"bytes {GRANULE}-{GRANULE + 9}/{GRANULE + 10}", GRANULE + 10) == (
+        GRANULE, GRANULE + 9
+    )
+    for header in ("bytes 0-9", "bytes 5-4/10", "items 0-9/10", f"bytes 0-{GRANULE}/{GRANULE}"):
+        with pytest.raises(ValueError):
+            resumable_upload.parse_content_range(header, GRANULE)
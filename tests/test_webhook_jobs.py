@@ -0,0 +1,222 @@
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.api.v1 import n8n as n8n_api
+from backend.api.v1.auth import get_current_user
+from backend.config import settings
+from backend.db import get_db
+from backend.models import Base
+from backend.models.user import User
+from backend.models.webhook_job import WebhookJob
+from backend.services import idempotency, job_service
+from backend.services.auth_service import Principal
+
+
+@pytest.fixture
+def webhook_client(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    processed = []
+    callbacks = []
+    request_sessions = []
+    process_sessions = []
+
+    async def fake_process(db, user, message):
+        process_sessions.append(db)
+        await asyncio.sleep(random.uniform(0, 0.02))
+        if message == "boom":
+            raise HTTPException(status_code=500, detail="OpenAI error: boom")
+        processed.append((user.email, message))
+        return {"type": "text", "text": f"re: {message}", "media": None}
+
+    def n8n(request):
+        callbacks.append(json.loads(request.content))
+        return httpx.Response(200)
+
+    async def override_db():
+        async with Session() as session:
+            request_sessions.append(session)
+            yield session
+
+    async def startup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with Session() as session:
+            session.add_all([
+                User(email="a@example.com", hashed_password="x"),
+                User(email="b@example.com", hashed_password="x"),
+            ])
+            await session.commit()
+        await job_service.start_job_workers()
+        job_service._http = httpx.AsyncClient(transport=httpx.MockTransport(n8n))
+
+    monkeypatch.setattr(job_service, "AsyncSessionLocal", Session)
+    monkeypatch.setattr(job_service, "process_chat_message", fake_process)
+    monkeypatch.setattr(n8n_api, "process_chat_message", fake_process)
+    monkeypatch.setattr(n8n_api, "AsyncSessionLocal", Session)
+    monkeypatch.setattr(settings, "N8N_WEBHOOK_URL", "http://n8n.test/webhook/reply")
+    monkeypatch.setattr(settings, "N8N_JOB_CONCURRENCY", 4)
+    monkeypatch.setattr(idempotency, "_guard", None)
+
+    app = FastAPI(on_startup=[startup], on_shutdown=[job_service.stop_job_workers])
+    app.include_router(n8n_api.router, prefix="/api/v1")
+    app.dependency_overrides[get_db] = override_db
+    app.dependency_overrides[get_current_user] = lambda: client.principal
+    with TestClient(app) as client:
+        client.principal = Principal(id=0, email="admin@example.com", role="admin", is_active=True)
+        client.processed = processed
+        client.callbacks = callbacks
+        client.request_sessions = request_sessions
+        client.process_sessions = process_sessions
+        yield client
+
+
+def post(client, email, message, mode="async", **extra):
+    return client.post(
+        f"/api/v1/n8n/webhook?mode={mode}",
+        json={"email": f"Someone <{email}>", "message": message, **extra}
+    )
+
+
+def wait_for(client, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f"/api/v1/n8n/jobs/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_async_webhook_returns_202_and_keeps_per_user_order(webhook_client):
+    accepted = []
+    for i in range(5):
+        for email in ("a@example.com", "b@example.com"):
+            resp = post(webhook_client, email, f"{email[0]}{i}")
+            assert resp.status_code == 202
+            assert resp.json()["status"] == "queued"
+            assert resp.json()["status_url"].endswith(f"/api/v1/n8n/jobs/{resp.json()['job_id']}")
+            accepted.append(resp.json()["job_id"])
+
+    jobs = [wait_for(webhook_client, job_id) for job_id in accepted]
+    assert jobs[0]["reply"] == {"type": "text", "text": "re: a0", "media": None}
+    for email in ("a@example.com", "b@example.com"):
+        order = [message for who, message in webhook_client.processed if who == email]
+        assert order == [f"{email[0]}{i}" for i in range(5)]
+    delivered = {c["job_id"]: c for c in webhook_client.callbacks}
+    assert set(delivered) == set(accepted)
+    assert delivered[accepted[0]]["reply"]["text"] == "re: a0"
+
+
+def test_failed_job_reports_the_error(webhook_client):
+    job = wait_for(webhook_client, post(webhook_client, "a@example.com", "boom").json()["job_id"])
+    assert job["status"] == "failed"
+    assert job["error"] == "OpenAI error: boom"
+    assert webhook_client.callbacks[-1]["status"] == "failed"
+
+
+def test_backlog_limit_rejects_with_503(webhook_client, monkeypatch):
+    monkeypatch.setattr(settings, "N8N_JOB_MAX_PENDING", 0)
+    resp = post(webhook_client, "a@example.com", "hi")
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == "5"
+
+
+def test_unknown_job_is_404(webhook_client):
+    assert webhook_client.get("/api/v1/n8n/jobs/nope").status_code == 404
+
+
+def test_jobs_are_only_visible_to_their_user(webhook_client):
+    job_id = post(webhook_client, "a@example.com", "secret").json()["job_id"]
+    wait_for(webhook_client, job_id)
+
+    webhook_client.principal = Principal(id=2, email="b@example.com", role="user", is_active=True)
+    assert webhook_client.get(f"/api/v1/n8n/jobs/{job_id}").status_code == 404
+    webhook_client.principal = Principal(id=1, email="a@example.com", role="user", is_active=True)
+    assert webhook_client.get(f"/api/v1/n8n/jobs/{job_id}").json()["reply"]["text"] == "re: secret"
+
+
+def test_finished_jobs_are_purged_after_retention(webhook_client):
+    job_id = post(webhook_client, "a@example.com", "old").json()["job_id"]
+    wait_for(webhook_client, job_id)
+
+    assert webhook_client.portal.call(job_service.purge_finished_jobs) == 0
+    later = datetime.now(timezone.utc) + timedelta(seconds=settings.N8N_JOB_RETENTION + 60)
+    assert webhook_client.portal.call(job_service.purge_finished_jobs, later) == 1
+    assert webhook_client.get(f"/api/v1/n8n/jobs/{job_id}").status_code == 404
+
+
+def test_duplicate_deliveries_are_processed_once(webhook_client):
+    first = post(webhook_client, "a@example.com", "hello", mode="sync", message_id="m-1")
+    retry = post(webhook_client, "a@example.com", "hello", mode="sync", message_id="m-1")
+    other = post(webhook_client, "a@example.com", "hello", mode="sync", message_id="m-2")
+
+    assert first.json() == retry.json() == {"type": "text", "text": "re: hello", "media": None}
+    assert "idempotent-replayed" not in first.headers
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert other.status_code == 200
+    assert webhook_client.processed == [("a@example.com", "hello")] * 2
+    # The shared computation may outlive the request that started it
+    assert not set(webhook_client.process_sessions) & set(webhook_client.request_sessions)
+
+
+def test_duplicate_async_delivery_returns_the_same_job(webhook_client):
+    first = post(webhook_client, "b@example.com", "ping")
+    retry = post(webhook_client, "b@example.com", "ping")
+    assert first.status_code == retry.status_code == 202
+    assert first.json()["job_id"] == retry.json()["job_id"]
+    wait_for(webhook_client, first.json()["job_id"])
+    assert webhook_client.processed == [("b@example.com", "ping")]
+
+
+def test_claims_serialize_each_user_across_processes(tmp_path, monkeypatch):
+    """Claims come from the table, so the order holds whichever process received the jobs."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'claims.db'}")
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    monkeypatch.setattr(job_service, "AsyncSessionLocal", Session)
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with Session() as session:
+            session.add_all([User(id=1, email="a@example.com", hashed_password="x"),
+                             User(id=2, email="b@example.com", hashed_password="x")])
+            jobs = [WebhookJob(user_id=user_id, email="x", message=m) for user_id, m in ((1, "a0"), (1, "a1"), (2, "b0"))]
+            for job in jobs:
+                session.add(job)
+                await session.flush()
+            # A job left running by a process that died an hour ago
+            stale = WebhookJob(user_id=2, email="x", message="b-stale", status="running",
+                               created_at=datetime.now(timezone.utc) - timedelta(hours=1),
+                               updated_at=datetime.now(timezone.utc) - timedelta(hours=1))
+            session.add(stale)
+            await session.commit()
+
+        async def messages(*claims):
+            async with Session() as session:
+                return [(await session.get(WebhookJob, job_id)).message if job_id else None for job_id in claims]
+
+        first = await messages(await job_service._claim_next(), await job_service._claim_next(),
+                               await job_service._claim_next())
+        async with Session() as session:
+            await session.execute(update(WebhookJob).where(WebhookJob.message == "a0").values(status="done"))
+            await session.commit()
+        second = await messages(await job_service._claim_next(), await job_service._claim_next())
+        await engine.dispose()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    # b0 waits behind the recovered stale job, a1 behind a0
+    assert first == ["b-stale", "a0", None]
+    assert second == ["a1", None]